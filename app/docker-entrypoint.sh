@@ -3,6 +3,8 @@ set -e
 
 if [ "$DJANGO_MANAGEPY_MIGRATE" = 'on' ]; then
     python manage.py migrate --noinput
+    python manage.py refresh_routing_edges --if-empty
+    python manage.py refresh_simplified_routes --if-empty
 fi
 
 exec "$@"
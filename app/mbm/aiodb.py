@@ -0,0 +1,162 @@
+"""
+A small asyncio driver for Postgres, built on psycopg2's asynchronous
+connections, for the async route API.
+
+Django's database layer is synchronous, so async views can't use
+`connection.cursor()` without handing every query off to a thread. Instead,
+they borrow connections from a `Pool`, which opens at most
+`ASYNC_DB_POOL_SIZE` connections and makes callers wait for a free one beyond
+that, so that a single process can have many route queries in flight at once
+without swamping the database. Queries take the same `%s` placeholders as
+Django's cursors, so the views can share their SQL with the sync views.
+"""
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+from django.conf import settings
+from django.db import connections
+
+from mbm import metrics
+
+
+async def wait(conn):
+    """Wait for the pending operation on the async connection `conn`."""
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        if state == extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError(f'Unexpected poll state {state}')
+
+        ready = loop.create_future()
+        fd = conn.fileno()
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+
+class Connection:
+    """An asynchronous connection to Postgres, which is always in autocommit mode."""
+    def __init__(self, conn):
+        self._conn = conn
+
+    @classmethod
+    async def connect(cls, **params):
+        conn = psycopg2.connect(async_=True, **params)
+        await wait(conn)
+        return cls(conn)
+
+    @property
+    def closed(self):
+        return bool(self._conn.closed)
+
+    def close(self):
+        self._conn.close()
+
+    async def execute(self, sql, params=None):
+        """Execute `sql` and return the cursor that holds its results."""
+        cursor = self._conn.cursor()
+        cursor.execute(sql, params)
+        await wait(self._conn)
+        return cursor
+
+    async def fetchone(self, sql, params=None):
+        return (await self.execute(sql, params)).fetchone()
+
+    async def fetchall(self, sql, params=None):
+        return (await self.execute(sql, params)).fetchall()
+
+
+class Pool:
+    """
+    A bounded pool of `Connection`s for a single event loop. Connections are
+    opened as they're needed, up to `maxsize`, and kept open for reuse.
+    """
+    def __init__(self, maxsize, **params):
+        self.maxsize = maxsize
+        self.params = params
+        self.in_use = 0
+        self._idle = []
+        self._semaphore = asyncio.Semaphore(maxsize)
+
+    @property
+    def size(self):
+        return self.in_use + len(self._idle)
+
+    @asynccontextmanager
+    async def connection(self):
+        """
+        Borrow a connection, waiting for one to be returned if `maxsize` are
+        already in use. A connection that raised an error, or whose query
+        was cancelled, is closed rather than returned to the pool, since it
+        may be left in the middle of a query.
+        """
+        async with self._semaphore:
+            conn = None
+            while self._idle and conn is None:
+                conn = self._idle.pop()
+                if conn.closed:
+                    conn = None
+            self.in_use += 1
+            try:
+                if conn is None:
+                    conn = await Connection.connect(**self.params)
+                yield conn
+            except BaseException:
+                if conn is not None:
+                    conn.close()
+                raise
+            else:
+                if not conn.closed:
+                    self._idle.append(conn)
+            finally:
+                self.in_use -= 1
+
+    async def fetchone(self, sql, params=None):
+        async with self.connection() as conn:
+            return await conn.fetchone(sql, params)
+
+    async def fetchall(self, sql, params=None):
+        async with self.connection() as conn:
+            return await conn.fetchall(sql, params)
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+
+# Pools by the event loop that they belong to, since asyncio connections
+# can't be shared between loops
+_pools = weakref.WeakKeyDictionary()
+
+
+def get_pool():
+    """Return the connection pool for the running event loop, to the default database."""
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        params = connections['default'].get_connection_params()
+        pool = _pools[loop] = Pool(settings.ASYNC_DB_POOL_SIZE, **params)
+    return pool
+
+
+metrics.Collected(
+    'mbm_async_db_connections',
+    'Open connections in the async database pools, by whether they are in use.',
+    lambda: [
+        ({'state': 'in_use'}, sum(pool.in_use for pool in list(_pools.values()))),
+        ({'state': 'idle'}, sum(pool.size - pool.in_use for pool in list(_pools.values()))),
+    ],
+    labels=('state',)
+)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class DjangoAppConfig(AppConfig):
     name = 'mbm'
+
+    def ready(self):
+        # Connect signal handlers
+        from mbm import signals  # noqa: F401
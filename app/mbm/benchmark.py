@@ -0,0 +1,323 @@
+"""
+Route latency benchmarks against a synthetic street network.
+
+`SyntheticCity` generates a street grid in the `chicago_ways` and
+`chicago_ways_vertices_pgr` schema that osm2pgrouting produces, along with
+mellow routes over it, so that routing performance can be measured on a
+local database without importing OSM data. The grid is loosely modelled on
+Chicago:
+
+- Residential side streets every block, alternating between one-way
+  directions, with an arterial every `arterial_spacing` blocks
+- A mellow street every `mellow_spacing` blocks in each direction
+- An off-street lakefront path along the east edge
+- A river that can only be crossed at bridges every `bridge_spacing` blocks,
+  so that trips across the river between bridges need a bigger bounding box
+  than their endpoints suggest, or the full graph
+
+Run it with the `benchmark_routes` management command. The
+`benchmark_statements` command compares the routing queries as ad hoc
+queries and as prepared statements, over either this network or real data.
+"""
+import json
+import math
+import random
+import time
+
+import numpy as np
+
+from mbm.costs import CYCLEWAY_TAG_IDS, RESIDENTIAL_STREET_TAG_IDS
+from mbm.views import BBOX_MAX_EXPANSIONS
+
+# Southwest corner of the grid, and the size of a block, which is about 200m
+# in each direction
+ORIGIN_LNG = -87.75
+ORIGIN_LAT = 41.75
+BLOCK_LNG = 0.0024
+BLOCK_LAT = 0.0018
+
+RESIDENTIAL_TAG_ID = RESIDENTIAL_STREET_TAG_IDS[1]
+CYCLEWAY_TAG_ID = CYCLEWAY_TAG_IDS[-1]
+# Any tag that isn't residential or a cycleway gets the full street cost
+ARTERIAL_TAG_ID = 0
+
+# Straight-line distance ranges of each class of trip, in meters
+TRIP_CLASSES = {
+    'short': (500, 2000),
+    'medium': (3000, 6000),
+    'cross_city': (10000, math.inf),
+}
+
+# How the route was found, by the value of its `bbox_expansions` property,
+# which is null for routes found in process by the `memory` and `ch` backends
+SEARCH_OUTCOMES = {
+    None: 'graph',
+    0: 'bbox_hit',
+    **{expansions: 'bbox_expanded' for expansions in range(1, BBOX_MAX_EXPANSIONS + 1)},
+    BBOX_MAX_EXPANSIONS + 1: 'fallback',
+}
+
+PERCENTILES = (50, 95, 99)
+
+
+class SyntheticCity:
+    """
+    A synthetic street grid with `rows` east-west streets and `cols`
+    north-south streets. Vertex IDs are positive, and OSM IDs are negative
+    so that synthetic ways can't be mistaken for real ones.
+    """
+    def __init__(
+        self,
+        rows=100,
+        cols=100,
+        arterial_spacing=8,
+        mellow_spacing=4,
+        bridge_spacing=20,
+        river_col=None,
+    ):
+        self.rows = rows
+        self.cols = cols
+        self.arterial_spacing = arterial_spacing
+        self.mellow_spacing = mellow_spacing
+        self.bridge_spacing = bridge_spacing
+        # The river runs north-south between this column and the next
+        self.river_col = cols * 3 // 5 if river_col is None else river_col
+
+    def vertex_id(self, row, col):
+        return row * self.cols + col + 1
+
+    def coordinates(self, row, col):
+        return (ORIGIN_LNG + col * BLOCK_LNG, ORIGIN_LAT + row * BLOCK_LAT)
+
+    def vertices(self):
+        """Return a list of `(id, lng, lat)` tuples for every vertex."""
+        return [
+            (self.vertex_id(row, col), *self.coordinates(row, col))
+            for row in range(self.rows)
+            for col in range(self.cols)
+        ]
+
+    def _is_arterial(self, line):
+        return line % self.arterial_spacing == 0
+
+    def _is_mellow(self, line):
+        return not self._is_arterial(line) and line % self.mellow_spacing == 2
+
+    def _way_id(self, direction, line, segment):
+        # Streets are split into separate ways at each arterial
+        return -(((direction * 10000) + line) * 1000 + segment + 1)
+
+    def edges(self):
+        """
+        Return a list of dicts describing every edge, with the columns of
+        `chicago_ways` plus a `mellow` key with the type of mellow route that
+        the edge's way belongs to, if any.
+        """
+        edges = []
+        for direction, lines, length in ((0, self.rows, self.cols), (1, self.cols, self.rows)):
+            for line in range(lines):
+                for i in range(length - 1):
+                    if direction == 0:
+                        (source, target) = ((line, i), (line, i + 1))
+                        crosses_river = i == self.river_col
+                        is_bridge = line % self.bridge_spacing == 0
+                        if crosses_river and not is_bridge:
+                            continue
+                    else:
+                        (source, target) = ((i, line), (i + 1, line))
+                    edges.append(self._edge(direction, line, i, source, target))
+
+        for gid, edge in enumerate(edges, start=1):
+            edge['gid'] = gid
+        return edges
+
+    def _edge(self, direction, line, i, source, target):
+        (x1, y1), (x2, y2) = self.coordinates(*source), self.coordinates(*target)
+        length = math.hypot(x2 - x1, y2 - y1)
+        length_m = (BLOCK_LNG * 83000) if direction == 0 else (BLOCK_LAT * 111000)
+        lakefront = direction == 1 and line == self.cols - 1
+
+        if lakefront:
+            tag_id, name, mellow = CYCLEWAY_TAG_ID, 'Lakefront Trail', 'path'
+        elif self._is_arterial(line):
+            tag_id, name, mellow = ARTERIAL_TAG_ID, f'Arterial {direction}-{line}', None
+        else:
+            tag_id = RESIDENTIAL_TAG_ID
+            name = f'Street {direction}-{line}'
+            mellow = 'street' if self._is_mellow(line) else None
+
+        # Side streets alternate between one-way directions, except for
+        # mellow streets, which are two-way
+        oneway = 'NO'
+        reverse_cost = length
+        if tag_id == RESIDENTIAL_TAG_ID and mellow is None:
+            oneway = 'YES'
+            if line % 2:
+                source, target = target, source
+                (x1, y1), (x2, y2) = (x2, y2), (x1, y1)
+            reverse_cost = -length
+
+        return {
+            'osm_id': self._way_id(direction, line, i // self.arterial_spacing),
+            'tag_id': tag_id,
+            'length': length,
+            'length_m': length_m,
+            'name': name,
+            'source': self.vertex_id(*source),
+            'target': self.vertex_id(*target),
+            'cost': length,
+            'reverse_cost': reverse_cost,
+            'oneway': oneway,
+            'the_geom': f'LINESTRING({x1} {y1}, {x2} {y2})',
+            'mellow': mellow,
+        }
+
+    def mellow_ways(self, edges):
+        """Return a dict mapping each mellow route type to the osm_ids of
+        its ways."""
+        ways = {}
+        for edge in edges:
+            if edge['mellow']:
+                ways.setdefault(edge['mellow'], set()).add(edge['osm_id'])
+        return {type: sorted(osm_ids) for type, osm_ids in ways.items()}
+
+    def trips(self, trips_per_class, seed=0, max_attempts=100000):
+        """
+        Return a list of `(trip_class, source_coord, target_coord)` tuples,
+        with `trips_per_class` random trips in each of TRIP_CLASSES that the
+        grid is big enough for. Coordinates are `lng,lat` strings, offset from
+        the grid so that they have to be snapped.
+        """
+        rng = random.Random(seed)
+        trips = []
+        for trip_class, (min_m, max_m) in TRIP_CLASSES.items():
+            found = 0
+            for _ in range(max_attempts):
+                if found == trips_per_class:
+                    break
+                source = (rng.randrange(self.rows), rng.randrange(self.cols))
+                target = (rng.randrange(self.rows), rng.randrange(self.cols))
+                dist = math.hypot(
+                    (source[0] - target[0]) * BLOCK_LAT * 111000,
+                    (source[1] - target[1]) * BLOCK_LNG * 83000,
+                )
+                if min_m <= dist < max_m:
+                    trips.append((trip_class, self._jitter(rng, *source), self._jitter(rng, *target)))
+                    found += 1
+        return trips
+
+    def _jitter(self, rng, row, col):
+        lng, lat = self.coordinates(row, col)
+        lng += rng.uniform(-0.3, 0.3) * BLOCK_LNG
+        lat += rng.uniform(-0.3, 0.3) * BLOCK_LAT
+        # Route requests take coordinates as lat,lng
+        return f'{lat:.6f},{lng:.6f}'
+
+
+def summarize(latencies):
+    """Return summary statistics for a list of latencies in seconds, in
+    milliseconds."""
+    latencies_ms = np.asarray(latencies, dtype=np.float64) * 1000
+    if not len(latencies_ms):
+        return {'count': 0}
+    summary = {'count': len(latencies_ms)}
+    for percentile in PERCENTILES:
+        summary[f'p{percentile}_ms'] = round(float(np.percentile(latencies_ms, percentile)), 3)
+    summary['mean_ms'] = round(float(latencies_ms.mean()), 3)
+    summary['max_ms'] = round(float(latencies_ms.max()), 3)
+    return summary
+
+
+def search_outcome(properties):
+    """Return how a route was found, from SEARCH_OUTCOMES, given its
+    properties, or 'unknown' if they don't say."""
+    if 'bbox_expansions' not in properties:
+        return 'unknown'
+    return SEARCH_OUTCOMES.get(properties['bbox_expansions'], 'unknown')
+
+
+def run_trips(route, trips, repeat=1, clear_cache=None):
+    """
+    Time `route(source, target)` for each trip in `trips`, `repeat` times,
+    and return a dict mapping each group name to a summary of its latencies.
+    `route` must return the properties of the route it found.
+
+    Trips are grouped by their class and by how their route was found, as
+    well as all together. `clear_cache`, if given, is called before each
+    request so that every request does the full amount of work.
+    """
+    groups = {'all': []}
+    for _ in range(repeat):
+        for trip_class, source, target in trips:
+            if clear_cache is not None:
+                clear_cache()
+            start = time.perf_counter()
+            properties = route(source, target)
+            elapsed = time.perf_counter() - start
+
+            outcome = search_outcome(properties)
+            for group in ('all', f'trip:{trip_class}', f'search:{outcome}'):
+                groups.setdefault(group, []).append(elapsed)
+
+    return {group: summarize(latencies) for group, latencies in sorted(groups.items())}
+
+
+def compare(results, baseline):
+    """
+    Return a list of `(group, stat, baseline_ms, result_ms, change)` rows
+    comparing the latency percentiles of two benchmark results, where
+    `change` is the relative change from the baseline.
+    """
+    rows = []
+    for group, summary in results['groups'].items():
+        baseline_summary = baseline['groups'].get(group)
+        if not baseline_summary:
+            continue
+        for percentile in PERCENTILES:
+            stat = f'p{percentile}_ms'
+            if stat in summary and baseline_summary.get(stat):
+                change = summary[stat] / baseline_summary[stat] - 1
+                rows.append((group, stat, baseline_summary[stat], summary[stat], change))
+    return rows
+
+
+def explain_timings(cursor, sql, params=None):
+    """Run `sql` under EXPLAIN ANALYZE and return a tuple `(planning,
+    execution)` of the time in seconds that Postgres reports spending on
+    planning and executing it."""
+    cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Planning Time'] / 1000, plan[0]['Execution Time'] / 1000
+
+
+def compare_statements(conn, cases, repeat=1):
+    """
+    Time each case in `cases` both as an ad hoc query and as a prepared
+    statement on the `PreparedConnection` `conn`, `repeat` times, and return
+    a dict mapping `{case}:{mode}` groups to summaries of the time spent
+    planning, executing and in total.
+
+    `cases` is a list of `(case, (sql, params), statement, statement_params)`
+    tuples, where `sql` is the ad hoc version of `statement`.
+    """
+    timings = {}
+    with conn.cursor() as cursor:
+        for _ in range(repeat):
+            for case, (sql, params), statement, statement_params in cases:
+                conn.prepare(statement)
+                for mode, run_sql, run_params in (
+                    ('adhoc', sql, params),
+                    ('prepared', statement.execute_sql, statement_params),
+                ):
+                    planning, execution = explain_timings(cursor, run_sql, run_params)
+                    group = timings.setdefault(f'{case}:{mode}', {'planning': [], 'execution': [], 'total': []})
+                    group['planning'].append(planning)
+                    group['execution'].append(execution)
+                    group['total'].append(planning + execution)
+
+    return {
+        group: {stage: summarize(values) for stage, values in stages.items()}
+        for group, stages in sorted(timings.items())
+    }
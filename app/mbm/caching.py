@@ -0,0 +1,345 @@
+"""
+In-process caches, and helpers for caching artifacts of the mellow data.
+"""
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import connection
+
+from mbm import metrics
+from mbm.models import DataVersion, MellowChange
+from mbm.tiered_cache import TieredCache
+
+
+class LRUCache:
+    """
+    A thread-safe, size-bounded mapping that evicts the least recently used
+    entry once it holds `maxsize` entries, and counts its hits, misses and
+    evictions.
+
+    Cached values are shared between callers, so they must not be mutated.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def rekey(self, keys):
+        """
+        Move the entry under each key of the dict `keys` to the key that it
+        maps to, or drop it if that's None, without changing how recently it
+        was used. Entries that aren't in `keys` are left as they are.
+        """
+        with self._lock:
+            data = OrderedDict()
+            for key, value in self._data.items():
+                new_key = keys.get(key, key)
+                if new_key is not None:
+                    data[new_key] = value
+            self._data = data
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+# Route results keyed by `(source_vertex_id, target_vertex_id, show_bbox,
+# compact, polyline, mellow data version)`. Since the version is part of the
+# key, entries for old versions of the mellow data are never read again and
+# age out of the cache on their own, unless `carry_over` moves them to the
+# new version.
+route_cache = LRUCache(settings.ROUTE_CACHE_SIZE)
+
+# Isochrones keyed by `(source_vertex_id, minutes, hull, mellow data
+# version)`, like `route_cache`. They're kept in process rather than in the
+# site cache, so that a wide spread of sources and limits can't fill it with
+# large documents.
+isochrone_cache = LRUCache(settings.ISOCHRONE_CACHE_SIZE)
+
+metrics.Collected(
+    'mbm_route_cache_lookups_total',
+    'Lookups in the in-process route cache, by result.',
+    lambda: [({'result': 'hit'}, route_cache.hits), ({'result': 'miss'}, route_cache.misses)],
+    labels=('result',),
+    type='counter'
+)
+metrics.Collected(
+    'mbm_route_cache_evictions_total',
+    'Routes evicted from the in-process route cache.',
+    lambda: [({}, route_cache.evictions)],
+    type='counter'
+)
+metrics.Collected(
+    'mbm_route_cache_size',
+    'Number of routes in the in-process route cache.',
+    lambda: [({}, len(route_cache))]
+)
+
+
+class SingleFlight:
+    """
+    Runs at most one call at a time for each key across the threads of a
+    process. Threads that ask for a key while a call for it is in flight
+    wait for that call and share its result, or its exception.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._flights)
+
+    def do(self, key, compute):
+        """Return a tuple `(value, shared)` of the result of `compute()` for
+        `key`, and whether it came from another thread's call."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+        try:
+            flight.value = compute()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value, False
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class AsyncSingleFlight:
+    """Like `SingleFlight`, for coroutines running on an event loop."""
+    def __init__(self):
+        self._flights = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    async def do(self, key, compute):
+        """Return a tuple `(value, shared)` of the result of `await
+        compute()` for `key`, and whether it came from another task's call.
+        If that call is cancelled, a waiting task makes the call itself."""
+        while key in self._flights:
+            future = self._flights[key]
+            try:
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+
+        future = self._flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Don't warn that the exception was never retrieved when nothing
+            # was waiting for it
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            return value, False
+        finally:
+            del self._flights[key]
+
+
+# Route searches in flight, keyed like `route_cache`, so that concurrent
+# requests for the same route only search for it once
+route_flights = SingleFlight()
+async_route_flights = AsyncSingleFlight()
+
+# Route requests that shared a search with another request, by whether it
+# ran in this process or another worker
+ROUTE_REQUESTS_COALESCED = metrics.Counter(
+    'mbm_route_requests_coalesced_total',
+    'Route requests that shared the result of a concurrent search for the same route, by scope.',
+    labels=('scope',)
+)
+
+
+def shared_cache():
+    """Return the cache that every process shares, bypassing the in-memory
+    tier of the default cache, if it has one."""
+    default = caches['default']
+    return default.shared if isinstance(default, TieredCache) else default
+
+
+@contextmanager
+def advisory_lock(name):
+    """
+    Hold a Postgres advisory lock on `name` on the default connection,
+    waiting for any other process that holds it, and yield whether there
+    was such a process. The lock is released when the connection closes, so
+    workers that die while holding it don't leave it held.
+    """
+    key = int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), 'big', signed=True)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', [key])
+        waited = not cursor.fetchone()[0]
+        if waited:
+            cursor.execute('SELECT pg_advisory_lock(%s)', [key])
+    try:
+        yield waited
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', [key])
+
+
+# Lookups in `get_versioned`, by the prefix of the cache key and whether the
+# value was current, kept from an older version, or computed
+VERSIONED_CACHE_LOOKUPS = metrics.Counter(
+    'mbm_versioned_cache_lookups_total',
+    'Lookups of versioned artifacts in the site cache, by result.',
+    labels=('cache', 'result')
+)
+
+
+def get_versioned(key, compute, bounds=None, timeout=None):
+    """
+    Return the value cached in the site cache under `key` for the current
+    version of the mellow data, calling `compute()` to build and cache it
+    on a miss.
+
+    If `bounds` is a `(min_lng, min_lat, max_lng, max_lat)` box that the
+    value depends on, a value cached for an older version is kept as long as
+    none of the changes since then touched `bounds`. Otherwise, any change
+    to the mellow data invalidates it.
+    """
+    version, found, value = _lookup_versioned(key, bounds, timeout)
+    if found:
+        return value
+    value = compute()
+    cache.set(key, (version, value), timeout)
+    return value
+
+
+async def get_versioned_async(key, compute, bounds=None, timeout=None):
+    """
+    Like `get_versioned`, for async views, where `compute` is a coroutine
+    function. The site cache and the mellow data version are read through
+    Django's synchronous database layer in a worker thread. Both are safe to
+    use from any thread, so lookups don't queue up behind each other on the
+    single thread that thread-sensitive calls share.
+    """
+    version, found, value = await sync_to_async(_lookup_versioned, thread_sensitive=False)(key, bounds, timeout)
+    if found:
+        return value
+    value = await compute()
+    await sync_to_async(cache.set, thread_sensitive=False)(key, (version, value), timeout)
+    return value
+
+
+def _lookup_versioned(key, bounds, timeout):
+    """
+    Look up `key` for `get_versioned`, and return a tuple `(version, found,
+    value)` of the current version of the mellow data, whether a usable
+    value was cached, and the value.
+    """
+    version = DataVersion.get(DataVersion.MELLOW)
+    name = key.split(':', 1)[0]
+    entry = cache.get(key)
+    if entry is not None:
+        cached_version, value = entry
+        if cached_version == version:
+            VERSIONED_CACHE_LOOKUPS.inc(cache=name, result='hit')
+            return version, True, value
+        if bounds is not None:
+            changes = MellowChange.since(cached_version, version)
+            if changes is not None and not any(change.intersects(bounds) for change in changes):
+                VERSIONED_CACHE_LOOKUPS.inc(cache=name, result='kept')
+                cache.set(key, (version, value), timeout)
+                return version, True, value
+
+    VERSIONED_CACHE_LOOKUPS.inc(cache=name, result='miss')
+    return version, False, None
+
+
+def carry_over(lru_cache, version, get_bounds):
+    """
+    Move the entries of the LRUCache `lru_cache`, whose keys end with the
+    version of the mellow data that they were built from, to mellow data
+    version `version` if none of the changes since then touched them, and
+    drop the rest of the entries for older versions. `get_bounds(keys)` must return a list with the `(min_lng,
+    min_lat, max_lng, max_lat)` box that each entry depends on, or None if
+    it can't be kept.
+    """
+    keys = [key for key in lru_cache.keys() if key[-1] < version]
+    if not keys:
+        return
+    changes = {
+        cached_version: MellowChange.since(cached_version, version)
+        for cached_version in {key[-1] for key in keys}
+    }
+    new_keys = {}
+    for key, bounds in zip(keys, get_bounds(keys)):
+        key_changes = changes[key[-1]]
+        if key_changes is None or bounds is None or any(change.intersects(bounds) for change in key_changes):
+            new_keys[key] = None
+        else:
+            new_keys[key] = key[:-1] + (version,)
+    lru_cache.rekey(new_keys)
@@ -0,0 +1,418 @@
+"""
+Contraction hierarchy over the mellow-weighted routing graph.
+
+Building a contraction hierarchy (CH) is an offline step: vertices are
+contracted one by one in order of importance, and shortcut arcs are added
+wherever contracting a vertex would otherwise lose a shortest path. A query
+then only has to run two small Dijkstra searches that each move "upward" in
+the hierarchy, which makes long cross-city trips about as cheap as short ones.
+
+The hierarchy is built from the mellow data as of a particular `DataVersion`
+and is ignored as soon as that version changes, since shortcuts can't be
+patched for new costs the way the plain graph's arcs can. Routes are then
+found with `pgr_dijkstra` until the `build_contraction_hierarchy` management
+command rebuilds it.
+"""
+import heapq
+import logging
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from mbm.models import DataVersion
+
+logger = logging.getLogger(__name__)
+
+# Limits for the local witness searches that decide whether a shortcut is
+# needed. Lower limits make preprocessing faster at the cost of adding some
+# shortcuts that aren't strictly necessary, which never affects correctness.
+WITNESS_SETTLE_LIMIT = 500
+WITNESS_HOP_LIMIT = 8
+
+# Hop limit for the witness searches that estimate how many shortcuts
+# contracting a vertex would add, to decide which vertex to contract next.
+# Priorities are checked again every time a vertex comes up in the queue, so
+# these searches only look one hop past the vertex's neighbors. They
+# overestimate the shortcuts somewhat, but order vertices nearly as well as
+# full searches, for a fraction of the work.
+PRIORITY_WITNESS_HOP_LIMIT = 1
+
+# Marker for arcs that don't have a middle vertex, i.e. that aren't shortcuts
+NO_MIDDLE = -1
+
+
+class ContractionHierarchy:
+    """
+    A contraction hierarchy stored as two CSR graphs.
+
+    The upward graph stores, for each vertex, the arcs leading to
+    higher-ranked vertices. The downward graph stores, for each vertex, the
+    arcs arriving from higher-ranked vertices, indexed by their head so that
+    it can be searched backward from the target. Each arc records its
+    `middle` vertex if it's a shortcut, or the `chicago_ways` gid of the edge
+    it represents otherwise.
+    """
+    ARRAYS = (
+        'vertex_ids',
+        'up_indptr', 'up_targets', 'up_costs', 'up_middle', 'up_edge_ids',
+        'down_indptr', 'down_sources', 'down_costs', 'down_middle', 'down_edge_ids',
+    )
+
+    def __init__(self, version=None, **arrays):
+        self.version = version
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def build(cls, graph, version=None, log=None):
+        """
+        Contract every vertex of the RoutingGraph `graph` and return the
+        resulting hierarchy. `log` is an optional callable for progress
+        messages.
+        """
+        n = graph.num_vertices
+
+        # Working adjacency used during contraction. Each entry maps a
+        # neighbor to a `(cost, middle, edge_id)` tuple, keeping only the
+        # cheapest of any parallel arcs.
+        out_adj = [dict() for _ in range(n)]
+        in_adj = [dict() for _ in range(n)]
+        indptr = graph.indptr.tolist()
+        targets = graph.targets.tolist()
+        costs = graph.costs.tolist()
+        edge_ids = graph.edge_ids.tolist()
+        for u in range(n):
+            for arc in range(indptr[u], indptr[u + 1]):
+                v = targets[arc]
+                if v == u:
+                    continue
+                existing = out_adj[u].get(v)
+                if existing is None or costs[arc] < existing[0]:
+                    entry = (costs[arc], NO_MIDDLE, edge_ids[arc])
+                    out_adj[u][v] = entry
+                    in_adj[v][u] = entry
+
+        contracted_neighbors = [0] * n
+        queue = [
+            (cls._priority(v, out_adj, in_adj, contracted_neighbors), v)
+            for v in range(n)
+        ]
+        heapq.heapify(queue)
+
+        # Arcs to higher-ranked vertices, recorded when a vertex is contracted
+        up = [None] * n
+        down = [None] * n
+        rank = 0
+        while queue:
+            _, v = heapq.heappop(queue)
+            if up[v] is not None:
+                continue
+
+            # Lazy update: if the priority of this vertex has gone up since
+            # it was queued, requeue it and try the next one
+            priority = cls._priority(v, out_adj, in_adj, contracted_neighbors)
+            if queue and priority > queue[0][0]:
+                heapq.heappush(queue, (priority, v))
+                continue
+
+            up[v] = [(w, c, m, e) for w, (c, m, e) in out_adj[v].items()]
+            down[v] = [(u, c, m, e) for u, (c, m, e) in in_adj[v].items()]
+
+            for u, w, cost in list(cls._shortcuts(v, out_adj, in_adj, WITNESS_HOP_LIMIT)):
+                existing = out_adj[u].get(w)
+                if existing is None or cost < existing[0]:
+                    entry = (cost, v, NO_MIDDLE)
+                    out_adj[u][w] = entry
+                    in_adj[w][u] = entry
+
+            for w in out_adj[v]:
+                del in_adj[w][v]
+                contracted_neighbors[w] += 1
+            for u in in_adj[v]:
+                del out_adj[u][v]
+                contracted_neighbors[u] += 1
+            out_adj[v] = in_adj[v] = None
+
+            rank += 1
+            if log and rank % 100000 == 0:
+                log(f'Contracted {rank} of {n} vertices')
+
+        up_arrays = cls._to_csr(up)
+        down_arrays = cls._to_csr(down)
+        return cls(
+            version=version,
+            vertex_ids=graph.vertex_ids,
+            up_indptr=up_arrays[0],
+            up_targets=up_arrays[1],
+            up_costs=up_arrays[2],
+            up_middle=up_arrays[3],
+            up_edge_ids=up_arrays[4],
+            down_indptr=down_arrays[0],
+            down_sources=down_arrays[1],
+            down_costs=down_arrays[2],
+            down_middle=down_arrays[3],
+            down_edge_ids=down_arrays[4],
+        )
+
+    @classmethod
+    def _priority(cls, v, out_adj, in_adj, contracted_neighbors):
+        """
+        Return the contraction priority of vertex `v`: the edge difference
+        (shortcuts added minus arcs removed) plus the number of neighbors that
+        have already been contracted, which spreads contraction evenly across
+        the graph.
+        """
+        num_shortcuts = sum(
+            1 for _ in cls._shortcuts(v, out_adj, in_adj, PRIORITY_WITNESS_HOP_LIMIT)
+        )
+        edge_difference = num_shortcuts - len(out_adj[v]) - len(in_adj[v])
+        return edge_difference + contracted_neighbors[v]
+
+    @classmethod
+    def _shortcuts(cls, v, out_adj, in_adj, hop_limit):
+        """
+        Yield `(u, w, cost)` for each shortcut that contracting `v` requires,
+        i.e. for each pair of neighbors whose shortest path runs through `v`,
+        as far as witness searches limited to `hop_limit` hops can tell.
+        """
+        outgoing = out_adj[v]
+        if not outgoing:
+            return
+        max_out = max(c for c, _, _ in outgoing.values())
+        for u, (cost_in, _, _) in in_adj[v].items():
+            witness = cls._witness_search(
+                out_adj,
+                u,
+                excluded=v,
+                max_cost=cost_in + max_out,
+                targets=outgoing.keys(),
+                hop_limit=hop_limit
+            )
+            for w, (cost_out, _, _) in outgoing.items():
+                if w == u:
+                    continue
+                cost = cost_in + cost_out
+                if witness.get(w, float('inf')) > cost:
+                    yield u, w, cost
+
+    @staticmethod
+    def _witness_search(out_adj, source, excluded, max_cost, targets, hop_limit=WITNESS_HOP_LIMIT):
+        """
+        Run a Dijkstra search from `source` that avoids `excluded`, bounded by
+        `max_cost`, `WITNESS_SETTLE_LIMIT` and `hop_limit`, and return the
+        distances it found.
+        """
+        remaining = set(targets)
+        dist = {source: 0.0}
+        hops = {source: 0}
+        heap = [(0.0, source)]
+        settled = 0
+        while heap and remaining:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            if d > max_cost:
+                break
+            remaining.discard(u)
+            settled += 1
+            if settled > WITNESS_SETTLE_LIMIT or hops[u] >= hop_limit:
+                continue
+            for x, (c, _, _) in out_adj[u].items():
+                if x == excluded:
+                    continue
+                nd = d + c
+                if nd < dist.get(x, float('inf')):
+                    dist[x] = nd
+                    hops[x] = hops[u] + 1
+                    heapq.heappush(heap, (nd, x))
+        return dist
+
+    @staticmethod
+    def _to_csr(rows):
+        counts = np.array([len(row) for row in rows], dtype=np.int64)
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        flat = [arc for row in rows for arc in row]
+        return (
+            indptr,
+            np.array([arc[0] for arc in flat], dtype=np.int32),
+            np.array([arc[1] for arc in flat], dtype=np.float64),
+            np.array([arc[2] for arc in flat], dtype=np.int32),
+            np.array([arc[3] for arc in flat], dtype=np.int64),
+        )
+
+    def save(self, path):
+        """
+        Write the hierarchy to `path`. The file is written to a temporary
+        location first and then moved into place, so that processes never
+        read a partially written hierarchy.
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                version=np.array(-1 if self.version is None else self.version),
+                **{name: getattr(self, name) for name in self.ARRAYS}
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            version = int(data['version'])
+            return cls(
+                version=None if version < 0 else version,
+                **{name: data[name] for name in cls.ARRAYS}
+            )
+
+    def vertex_index(self, vertex_id):
+        idx = int(np.searchsorted(self.vertex_ids, vertex_id))
+        if idx < len(self.vertex_ids) and self.vertex_ids[idx] == vertex_id:
+            return idx
+        return None
+
+    def shortest_path(self, source_vertex_id, target_vertex_id):
+        """
+        Return the list of `chicago_ways` gids along the cheapest path
+        between two vertex IDs, or an empty list if no path exists.
+        """
+        source = self.vertex_index(source_vertex_id)
+        target = self.vertex_index(target_vertex_id)
+        if source is None or target is None or source == target:
+            return []
+
+        up_indptr = memoryview(self.up_indptr)
+        up_targets = memoryview(self.up_targets)
+        up_costs = memoryview(self.up_costs)
+        down_indptr = memoryview(self.down_indptr)
+        down_sources = memoryview(self.down_sources)
+        down_costs = memoryview(self.down_costs)
+
+        # Each direction is a Dijkstra search over the arcs that lead upward
+        # in the hierarchy. `pred` maps a vertex to the vertex and arc that it
+        # was reached from.
+        searches = (
+            ({source: 0.0}, {}, [(0.0, source)], up_indptr, up_targets, up_costs),
+            ({target: 0.0}, {}, [(0.0, target)], down_indptr, down_sources, down_costs),
+        )
+        best = float('inf')
+        meeting = None
+        while any(heap and heap[0][0] < best for _, _, heap, *_ in searches):
+            for i, (dist, pred, heap, indptr, heads, costs) in enumerate(searches):
+                if not heap or heap[0][0] >= best:
+                    continue
+                d, u = heapq.heappop(heap)
+                if d > dist[u]:
+                    continue
+                other_dist = searches[1 - i][0]
+                if u in other_dist and d + other_dist[u] < best:
+                    best = d + other_dist[u]
+                    meeting = u
+                for arc in range(indptr[u], indptr[u + 1]):
+                    v = heads[arc]
+                    nd = d + costs[arc]
+                    if nd < dist.get(v, float('inf')):
+                        dist[v] = nd
+                        pred[v] = (u, arc)
+                        heapq.heappush(heap, (nd, v))
+
+        if meeting is None:
+            return []
+
+        forward_pred, backward_pred = searches[0][1], searches[1][1]
+        arcs = []
+        v = meeting
+        while v != source:
+            u, arc = forward_pred[v]
+            arcs.append((u, v, self.up_middle[arc], self.up_edge_ids[arc]))
+            v = u
+        arcs.reverse()
+        v = meeting
+        while v != target:
+            w, arc = backward_pred[v]
+            arcs.append((v, w, self.down_middle[arc], self.down_edge_ids[arc]))
+            v = w
+
+        path = []
+        for arc in arcs:
+            self._unpack(arc, path)
+        return path
+
+    def _unpack(self, arc, path):
+        """
+        Recursively expand the arc `(tail, head, middle, edge_id)` into the
+        gids of the original edges it represents, appending them to `path`.
+        """
+        stack = [arc]
+        while stack:
+            u, w, middle, edge_id = stack.pop()
+            if middle == NO_MIDDLE:
+                path.append(int(edge_id))
+                continue
+            # A shortcut u -> w through m replaced the arcs u -> m and m -> w
+            # when m was contracted. Since u and w both outrank m, those arcs
+            # are stored as a downward arc and an upward arc of m
+            stack.append(self._find_arc(middle, w, upward=True))
+            stack.append(self._find_arc(middle, u, upward=False))
+
+    def _find_arc(self, vertex, neighbor, upward):
+        if upward:
+            indptr, heads = self.up_indptr, self.up_targets
+            middle, edge_ids = self.up_middle, self.up_edge_ids
+        else:
+            indptr, heads = self.down_indptr, self.down_sources
+            middle, edge_ids = self.down_middle, self.down_edge_ids
+        for arc in range(indptr[vertex], indptr[vertex + 1]):
+            if heads[arc] == neighbor:
+                if upward:
+                    return (vertex, neighbor, middle[arc], edge_ids[arc])
+                return (neighbor, vertex, middle[arc], edge_ids[arc])
+        raise ValueError(
+            f'Contraction hierarchy is missing an arc between vertex indexes '
+            f'{vertex} and {neighbor}'
+        )
+
+
+_hierarchy = None
+_hierarchy_mtime = None
+# The stale hierarchy that this process last warned about, so that it only
+# warns once per hierarchy rather than on every request
+_stale_hierarchy = None
+_hierarchy_lock = threading.Lock()
+
+
+def get_contraction_hierarchy():
+    """
+    Return the contraction hierarchy for this process, or None if it hasn't
+    been built or if the mellow data has changed since it was built.
+    """
+    global _hierarchy, _hierarchy_mtime, _stale_hierarchy
+    path = settings.ROUTING_CH_PATH
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    if mtime != _hierarchy_mtime:
+        with _hierarchy_lock:
+            if mtime != _hierarchy_mtime:
+                _hierarchy = ContractionHierarchy.load(path)
+                _hierarchy_mtime = mtime
+
+    hierarchy = _hierarchy
+    current_version = DataVersion.get(DataVersion.MELLOW)
+    if hierarchy.version != current_version:
+        if _stale_hierarchy is not hierarchy:
+            _stale_hierarchy = hierarchy
+            logger.warning(
+                'Ignoring stale contraction hierarchy built from mellow data '
+                'version %s (current version is %s). Run the '
+                'build_contraction_hierarchy command to rebuild it.',
+                hierarchy.version,
+                current_version
+            )
+        return None
+    return hierarchy
@@ -0,0 +1,55 @@
+"""
+The mellow cost model shared by every routing backend.
+
+Edges in `chicago_ways` carry an osm2pgrouting `cost` and `reverse_cost`.
+We discount those costs for ways that are mellow or otherwise bike-friendly so
+that the shortest path prefers them. Both the pgRouting SQL and the in-process
+graph build their costs from the expressions in this module, so that the two
+backends always agree on what the "best" route is.
+"""
+
+# osm2pgrouting tag IDs for indexing specific types of streets. For docs, see:
+# https://github.com/pgRouting/osm2pgrouting/blob/8491929fc4037d308f271e84d59bb96da3c28aa2/mapconfig_for_bicycles.xml
+
+RESIDENTIAL_STREET_TAG_IDS = (
+    507,  # living_street
+    509,  # residential
+)
+
+CYCLEWAY_TAG_IDS = (
+    101,  # cycleway:track
+    201,  # cycleway:right:track
+    301,  # cycleway:left:track
+    501,  # highway:cycleway
+)
+
+SIDEWALK_TAG_IDS = (
+    503,  # highway:pedestrian
+    504,  # highway:footway
+)
+
+# Multipliers applied to the cost of an edge, in order of precedence
+PATH_MULTIPLIER = 0.1
+STREET_MULTIPLIER = 0.25
+BIKE_FRIENDLY_MULTIPLIER = 0.5
+ONEWAY_MULTIPLIER = 0.75
+
+
+def cost_sql(column, quote="'"):
+    """
+    Return a SQL CASE expression that applies the mellow multipliers to the
+    cost column `column` of a relation with `type`, `tag_id` and `oneway`
+    columns.
+
+    Use `quote="''"` when the expression will be embedded in a string literal,
+    as is the case for the edges SQL that we pass to pgRouting functions.
+    """
+    return f"""
+        CASE
+            WHEN type = {quote}path{quote} THEN {column} * {PATH_MULTIPLIER}
+            WHEN type = {quote}street{quote} THEN {column} * {STREET_MULTIPLIER}
+            WHEN tag_id IN {CYCLEWAY_TAG_IDS} OR tag_id IN {RESIDENTIAL_STREET_TAG_IDS} THEN {column} * {BIKE_FRIENDLY_MULTIPLIER}
+            WHEN oneway = {quote}YES{quote} THEN {column} * {ONEWAY_MULTIPLIER}
+            ELSE {column}
+        END
+    """
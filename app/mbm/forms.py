@@ -1,28 +1,53 @@
 import json
 
 from django import forms
-from django.db import connection
+from django.urls import reverse
 from django_geomultiplechoice.widgets import GeoMultipleChoiceWidget
 from leaflet.forms.widgets import LeafletWidget
 
-from mbm.models import MellowRoute, fetchall
+from mbm.models import Edge, MellowRoute
+from mbm.signals import batched_refresh
 
 DEFAULT_CENTER = (41.88, -87.7)
 SPATIAL_EXTENT = (-87.3, 41.5, -88, 42.15)
 
+# Zoom level of the tiles that the way picker loads ways in, and the lowest
+# map zoom level that it loads them at, so that a screenful of the map only
+# needs a handful of tiles
+WAY_TILE_ZOOM = 14
+WAY_PICKER_MIN_ZOOM = 14
+
 
 class MellowRouteMultipleChoiceWidget(GeoMultipleChoiceWidget):
+    """
+    Map widget for picking the ways of a mellow route.
+
+    Only the selected ways are rendered into the page. The rest are loaded
+    from the way tile endpoint as the map is panned and zoomed, and the
+    options of the underlying select input are added and removed as ways
+    are picked, so the selection doesn't depend on which tiles are loaded.
+    """
+    template_name = 'mbm/widgets/way_picker.html'
+
+    def get_context(self, name, value, attrs):
+        # The choices are exactly the current selection, so that a value
+        # that fails validation is still shown when the form is redisplayed
+        selected = self.format_value(value)
+        self.choices = [(osm_id, osm_id) for osm_id in selected]
+        self.features = Edge.way_features(selected)
+
+        context = super().get_context(name, value, attrs)
+        context['way_tiles'] = json.dumps({
+            'url': reverse('way-tile', kwargs={'z': 0, 'x': 0, 'y': 0}).replace(
+                '/0/0/0.json', '/{z}/{x}/{y}.json'
+            ),
+            'zoom': WAY_TILE_ZOOM,
+            'min_zoom': WAY_PICKER_MIN_ZOOM,
+        })
+        return context
+
     def get_features(self):
-        return [
-            {
-                'type': 'Feature',
-                'geometry': json.loads(choice['geom']),
-                'properties': {
-                    'id': choice_id,
-                }
-            }
-            for choice_id, choice in self.choices
-        ]
+        return self.features
 
 
 class MellowRouteCreateForm(forms.ModelForm):
@@ -43,20 +68,22 @@ class MellowRouteCreateForm(forms.ModelForm):
         }
 
     def save(self):
-        # Create instances for all three route types
-        street_instance = super().save()
-
-        # Copy the instance by setting its pk to None
-        # See: https://docs.djangoproject.com/en/3.1/topics/db/queries/#copying-model-instances
-        route_instance = street_instance
-        route_instance.pk = None
-        route_instance.type = MellowRoute.Type.ROUTE
-        route_instance.save()
-
-        path_instance = route_instance
-        path_instance.pk = None
-        path_instance.type = MellowRoute.Type.PATH
-        path_instance.save()
+        # Create instances for all three route types, and refresh the data
+        # derived from them once they're all saved, in the same transaction
+        with batched_refresh():
+            street_instance = super().save()
+
+            # Copy the instance by setting its pk to None
+            # See: https://docs.djangoproject.com/en/3.1/topics/db/queries/#copying-model-instances
+            route_instance = street_instance
+            route_instance.pk = None
+            route_instance.type = MellowRoute.Type.ROUTE
+            route_instance.save()
+
+            path_instance = route_instance
+            path_instance.pk = None
+            path_instance.type = MellowRoute.Type.PATH
+            path_instance.save()
 
         return path_instance
 
@@ -94,41 +121,12 @@ class MellowRouteEditForm(forms.ModelForm):
                 bounding_box.centroid.coords[1],
                 bounding_box.centroid.coords[0],
             )
-            # Retrieve ways with raw query for speed
-            way_query = """
-                SELECT
-                    osm_id::varchar AS id,
-                    ST_AsGeoJSON(ST_Union(the_geom)) AS geom
-                FROM chicago_ways
-                WHERE the_geom && (
-                    SELECT bounding_box
-                    FROM mbm_mellowroute
-                    WHERE slug = %s
-                    AND type = %s
-                )
-                GROUP BY osm_id
-            """
-            way_query_params = [self.instance.slug, self.instance.type]
         else:
             bounding_box_centroid = DEFAULT_CENTER
-            way_query = """
-                SELECT
-                    osm_id::varchar AS id,
-                    ST_AsGeoJSON(ST_Union(the_geom)) AS geom
-                FROM chicago_ways
-                WHERE the_geom && ST_MakeEnvelope(%s, %s, %s, %s)
-                GROUP BY osm_id
-            """
-            way_query_params = SPATIAL_EXTENT
-
-        with connection.cursor() as cursor:
-            cursor.execute(way_query, way_query_params)
-            choices = fetchall(cursor)
 
         self.fields['ways'].widget = MellowRouteMultipleChoiceWidget(
-            choices=[(choice['id'], choice) for choice in choices],
             settings_overrides={
-                'DEFAULT_ZOOM': 13,
+                'DEFAULT_ZOOM': WAY_PICKER_MIN_ZOOM,
                 'DEFAULT_CENTER': bounding_box_centroid,
                 'MAP_HEIGHT': '500px',
                 'MAP_WIDTH': '100%',
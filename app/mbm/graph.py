@@ -0,0 +1,648 @@
+"""
+In-process routing graph.
+
+As an alternative to running `pgr_dijkstra` in Postgres for every request, the
+mellow-weighted edge list can be loaded once per process into compact arrays
+in compressed sparse row (CSR) layout and searched in Python. Postgres is then
+only needed to fetch the geometry of the edges along the resulting path.
+
+Loading the graph from Postgres takes a while and gives every process its own
+copy of it. Instead, the `build_graph_snapshot` management command can write
+the graph to a snapshot directory of raw arrays, which processes map into
+memory with `numpy.load(mmap_mode='r')`. Every process on a machine then
+shares the same page cache pages, and starts routing as soon as the arrays are
+mapped.
+"""
+import heapq
+import logging
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from mbm.models import DataVersion, MellowChange
+
+logger = logging.getLogger(__name__)
+
+# Number of rows to pull from the server-side cursor at a time when loading
+# the graph
+LOAD_BATCH_SIZE = 50000
+
+# Length of a degree of latitude, or of longitude at the equator, in meters
+METERS_PER_DEGREE = 111320
+
+# Name of the file in the snapshot directory that holds the name of the
+# current snapshot
+CURRENT_SNAPSHOT_FILE = 'CURRENT'
+
+
+class RoutingGraph:
+    """
+    A directed graph of routing edges stored in CSR layout.
+
+    Vertices are identified externally by their `chicago_ways_vertices_pgr` ID
+    and internally by their position in the sorted `vertex_ids` array. The
+    outgoing arcs of the vertex at index `i` are stored at positions
+    `indptr[i]:indptr[i + 1]` of the `targets`, `costs`, `lengths` and
+    `edge_ids` arrays. Every edge in `chicago_ways` contributes one arc for
+    each direction in which it can be traversed.
+
+    If they're known, the coordinates of each vertex are stored in the
+    `lngs` and `lats` arrays, in the same order as `vertex_ids`.
+    """
+    ARRAYS = ('vertex_ids', 'indptr', 'targets', 'costs', 'lengths', 'edge_ids')
+    COORDINATE_ARRAYS = ('lngs', 'lats')
+
+    def __init__(self, vertex_ids, indptr, targets, costs, lengths, edge_ids, lngs=None, lats=None):
+        self.vertex_ids = vertex_ids
+        self.indptr = indptr
+        self.targets = targets
+        self.costs = costs
+        self.lengths = lengths
+        self.edge_ids = edge_ids
+        self.lngs = lngs
+        self.lats = lats
+
+    @classmethod
+    def from_edges(cls, edges):
+        """
+        Build a graph from a sequence of `(gid, source, target, cost,
+        reverse_cost, length_m)` rows. Following the pgRouting convention,
+        a negative cost means that the edge can't be traversed in that
+        direction.
+        """
+        edges = np.asarray(edges, dtype=np.float64).reshape(-1, 6)
+        gids = edges[:, 0].astype(np.int64)
+        sources = edges[:, 1].astype(np.int64)
+        targets = edges[:, 2].astype(np.int64)
+        costs, reverse_costs, lengths = edges[:, 3], edges[:, 4], edges[:, 5]
+
+        forward = costs >= 0
+        backward = reverse_costs >= 0
+        arc_sources = np.concatenate([sources[forward], targets[backward]])
+        arc_targets = np.concatenate([targets[forward], sources[backward]])
+        arc_costs = np.concatenate([costs[forward], reverse_costs[backward]])
+        arc_lengths = np.concatenate([lengths[forward], lengths[backward]])
+        arc_gids = np.concatenate([gids[forward], gids[backward]])
+
+        return cls.from_arcs(
+            arc_sources,
+            arc_targets,
+            arc_costs,
+            arc_lengths,
+            arc_gids
+        )
+
+    @classmethod
+    def from_arcs(cls, sources, targets, costs, lengths, edge_ids):
+        """Build a graph from parallel arrays of directed arcs."""
+        vertex_ids = np.unique(np.concatenate([sources, targets]))
+        source_idx = np.searchsorted(vertex_ids, sources)
+        target_idx = np.searchsorted(vertex_ids, targets)
+
+        order = np.argsort(source_idx, kind='stable')
+        counts = np.bincount(source_idx, minlength=len(vertex_ids))
+        indptr = np.zeros(len(vertex_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        return cls(
+            vertex_ids=vertex_ids.astype(np.int64),
+            indptr=indptr,
+            targets=target_idx[order].astype(np.int32),
+            costs=np.asarray(costs, dtype=np.float64)[order],
+            lengths=np.asarray(lengths, dtype=np.float64)[order],
+            edge_ids=np.asarray(edge_ids, dtype=np.int64)[order],
+        )
+
+    @property
+    def num_vertices(self):
+        return len(self.vertex_ids)
+
+    @property
+    def num_arcs(self):
+        return len(self.targets)
+
+    def vertex_index(self, vertex_id):
+        """
+        Return the internal index of the vertex with ID `vertex_id`, or None
+        if the vertex is not part of the graph.
+        """
+        idx = int(np.searchsorted(self.vertex_ids, vertex_id))
+        if idx < self.num_vertices and self.vertex_ids[idx] == vertex_id:
+            return idx
+        return None
+
+    def shortest_path(self, source_vertex_id, target_vertex_id):
+        """
+        Run Dijkstra's algorithm between two vertex IDs and return the list
+        of `chicago_ways` gids along the cheapest path, in order.
+
+        Returns an empty list if no path exists.
+        """
+        source = self.vertex_index(source_vertex_id)
+        target = self.vertex_index(target_vertex_id)
+        if source is None or target is None or source == target:
+            return []
+
+        # Python-level indexing into memoryviews is much faster than indexing
+        # into numpy arrays, and doesn't copy the underlying buffers
+        indptr = memoryview(self.indptr)
+        targets = memoryview(self.targets)
+        costs = memoryview(self.costs)
+
+        dist = {source: 0.0}
+        pred_arc = {}
+        settled = set()
+        heap = [(0.0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            if u == target:
+                break
+            settled.add(u)
+            for arc in range(indptr[u], indptr[u + 1]):
+                v = targets[arc]
+                nd = d + costs[arc]
+                if nd < dist.get(v, float('inf')):
+                    dist[v] = nd
+                    pred_arc[v] = arc
+                    heapq.heappush(heap, (nd, v))
+        else:
+            return []
+
+        edge_ids = memoryview(self.edge_ids)
+        path = []
+        v = target
+        while v != source:
+            arc = pred_arc[v]
+            path.append(edge_ids[arc])
+            # The source vertex of an arc is the row of the CSR array that
+            # contains it
+            v = int(np.searchsorted(self.indptr, arc, side='right')) - 1
+        path.reverse()
+        return path
+
+    def path_lengths(self, source_vertex_id, target_vertex_ids):
+        """
+        Run Dijkstra's algorithm from `source_vertex_id` until every vertex in
+        `target_vertex_ids` has been reached, and return a dict mapping each
+        reachable target to the length in meters of its cheapest path.
+        """
+        source = self.vertex_index(source_vertex_id)
+        if source is None:
+            return {}
+        remaining = {}
+        for vertex_id in target_vertex_ids:
+            idx = self.vertex_index(vertex_id)
+            if idx is not None:
+                remaining[idx] = vertex_id
+
+        indptr = memoryview(self.indptr)
+        targets = memoryview(self.targets)
+        costs = memoryview(self.costs)
+        lengths = memoryview(self.lengths)
+
+        dist = {source: 0.0}
+        length = {source: 0.0}
+        settled = set()
+        found = {}
+        heap = [(0.0, source)]
+        while heap and remaining:
+            d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+            if u in remaining:
+                found[remaining.pop(u)] = length[u]
+            for arc in range(indptr[u], indptr[u + 1]):
+                v = targets[arc]
+                nd = d + costs[arc]
+                if nd < dist.get(v, float('inf')):
+                    dist[v] = nd
+                    length[v] = length[u] + lengths[arc]
+                    heapq.heappush(heap, (nd, v))
+        return found
+
+    def reachable_edges(self, source_vertex_id, max_length):
+        """
+        Run Dijkstra's algorithm from `source_vertex_id`, following the
+        cheapest paths, and return a dict mapping the gid of every edge that
+        can be ridden in full within `max_length` meters along them to the
+        length in meters of the ride to its far end.
+
+        The search follows costs, like a route search, but is bounded by
+        length, so vertices are only expanded while the length of their
+        cheapest path is within `max_length`.
+        """
+        source = self.vertex_index(source_vertex_id)
+        if source is None:
+            return {}
+
+        indptr = memoryview(self.indptr)
+        targets = memoryview(self.targets)
+        costs = memoryview(self.costs)
+        lengths = memoryview(self.lengths)
+        edge_ids = memoryview(self.edge_ids)
+
+        dist = {source: 0.0}
+        length = {source: 0.0}
+        settled = set()
+        reached = {}
+        heap = [(0.0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+            for arc in range(indptr[u], indptr[u + 1]):
+                arc_length = length[u] + lengths[arc]
+                if arc_length > max_length:
+                    continue
+                edge_id = edge_ids[arc]
+                if arc_length < reached.get(edge_id, float('inf')):
+                    reached[edge_id] = arc_length
+                v = targets[arc]
+                nd = d + costs[arc]
+                if nd < dist.get(v, float('inf')):
+                    dist[v] = nd
+                    length[v] = arc_length
+                    heapq.heappush(heap, (nd, v))
+        return reached
+
+    def strong_components(self):
+        """
+        Return an array labelling each vertex with its strongly connected
+        component, i.e. the set of vertices that can all reach each other
+        when one-way edges are respected. Components are numbered in
+        descending order of size, so the main street network is component 0.
+        """
+        n = self.num_vertices
+        indptr = memoryview(self.indptr)
+        targets = memoryview(self.targets)
+
+        # Iterative version of Tarjan's algorithm, since the recursive version
+        # would blow the stack on a graph this size
+        index = [-1] * n
+        low = [0] * n
+        on_stack = [False] * n
+        labels = [-1] * n
+        stack = []
+        counter = 0
+        num_components = 0
+        for root in range(n):
+            if index[root] != -1:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = True
+            work = [(root, indptr[root])]
+            while work:
+                v, arc = work[-1]
+                if arc < indptr[v + 1]:
+                    work[-1] = (v, arc + 1)
+                    w = targets[arc]
+                    if index[w] == -1:
+                        index[w] = low[w] = counter
+                        counter += 1
+                        stack.append(w)
+                        on_stack[w] = True
+                        work.append((w, indptr[w]))
+                    elif on_stack[w] and index[w] < low[v]:
+                        low[v] = index[w]
+                    continue
+
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    if low[v] < low[u]:
+                        low[u] = low[v]
+                if low[v] == index[v]:
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        labels[w] = num_components
+                        if w == v:
+                            break
+                    num_components += 1
+
+        return _number_by_size(np.array(labels, dtype=np.int64))
+
+    def weak_components(self):
+        """
+        Return an array labelling each vertex with its weakly connected
+        component, i.e. the set of vertices that are connected when edge
+        direction is ignored. Components are numbered in descending order of
+        size.
+        """
+        parent = list(range(self.num_vertices))
+
+        def find(v):
+            root = v
+            while parent[root] != root:
+                root = parent[root]
+            while parent[v] != root:
+                parent[v], v = root, parent[v]
+            return root
+
+        sources = np.repeat(
+            np.arange(self.num_vertices),
+            np.diff(self.indptr)
+        ).tolist()
+        for u, v in zip(sources, self.targets.tolist()):
+            root_u, root_v = find(u), find(v)
+            if root_u != root_v:
+                parent[root_u] = root_v
+
+        labels = [find(v) for v in range(self.num_vertices)]
+        return _number_by_size(np.array(labels, dtype=np.int64))
+
+    def copy(self):
+        """
+        Return a graph that shares the arrays of this one. Since
+        `update_costs` swaps in a new costs array rather than writing to it,
+        updating the costs of the copy leaves this graph alone, and a copy of
+        a mapped snapshot only holds its own costs in memory.
+        """
+        return RoutingGraph(**{
+            array_name: getattr(self, array_name)
+            for array_name in self.ARRAYS + self.COORDINATE_ARRAYS
+        })
+
+    def update_costs(self, edges):
+        """
+        Replace the costs of the arcs for each of a sequence of `(gid,
+        source, cost, reverse_cost)` edges.
+
+        The costs array is copied and swapped in whole, so that searches
+        running in other threads never see a mix of old and new costs.
+        Changes to the mellow data only scale costs, so they never change
+        which directions an edge can be traversed in.
+        """
+        edges = np.asarray(edges, dtype=np.float64).reshape(-1, 4)
+        if not len(edges):
+            return
+        gids = edges[:, 0].astype(np.int64)
+        order = np.argsort(gids)
+        gids = gids[order]
+        sources, costs, reverse_costs = edges[order, 1], edges[order, 2], edges[order, 3]
+
+        arcs = np.flatnonzero(np.isin(self.edge_ids, gids))
+        edge_idx = np.searchsorted(gids, self.edge_ids[arcs])
+        # An arc runs forward along its edge if it leaves the edge's source
+        arc_sources = self.vertex_ids[np.searchsorted(self.indptr, arcs, side='right') - 1]
+        forward = arc_sources == sources[edge_idx].astype(np.int64)
+
+        new_costs = np.array(self.costs)
+        new_costs[arcs] = np.where(forward, costs[edge_idx], reverse_costs[edge_idx])
+        self.costs = new_costs
+
+    def save_snapshot(self, directory, version):
+        """
+        Write the graph to a new snapshot in `directory` for the mellow data
+        version `version`, make it the current snapshot, and return its path.
+
+        The snapshot is written in full before the current snapshot file is
+        atomically replaced to point to it, so processes never map a
+        partially written snapshot. Older snapshots are deleted, which is safe
+        even while other processes have them mapped.
+        """
+        if self.lngs is None or self.lats is None:
+            raise ValueError('Graph snapshots require vertex coordinates')
+
+        name = f'v{version}-{time.time_ns()}'
+        path = os.path.join(directory, name)
+        os.makedirs(path)
+        for array_name in self.ARRAYS + self.COORDINATE_ARRAYS:
+            np.save(os.path.join(path, f'{array_name}.npy'), getattr(self, array_name))
+        with open(os.path.join(path, 'version'), 'w') as f:
+            f.write(str(version))
+
+        current_path = os.path.join(directory, CURRENT_SNAPSHOT_FILE)
+        with open(f'{current_path}.tmp', 'w') as f:
+            f.write(name)
+        os.replace(f'{current_path}.tmp', current_path)
+
+        for old_name in os.listdir(directory):
+            old_path = os.path.join(directory, old_name)
+            if old_name != name and os.path.isdir(old_path):
+                shutil.rmtree(old_path, ignore_errors=True)
+        return path
+
+    @classmethod
+    def open_snapshot(cls, path):
+        """
+        Map the snapshot at `path` into memory and return a tuple `(graph,
+        version)`. The arrays of the graph are read-only.
+        """
+        with open(os.path.join(path, 'version')) as f:
+            version = int(f.read())
+        arrays = {
+            array_name: np.load(os.path.join(path, f'{array_name}.npy'), mmap_mode='r')
+            for array_name in cls.ARRAYS + cls.COORDINATE_ARRAYS
+        }
+        return cls(**arrays), version
+
+
+def _number_by_size(labels):
+    """
+    Renumber an array of component labels so that the largest component is
+    0, the next largest is 1, and so on.
+    """
+    if not len(labels):
+        return labels
+    _, labels = np.unique(labels, return_inverse=True)
+    sizes = np.bincount(labels)
+    order = np.argsort(-sizes, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return rank[labels]
+
+
+def load_graph():
+    """
+    Load the mellow-weighted routing graph from the routing edge table.
+    """
+    query = """
+        SELECT gid, source, target, cost, reverse_cost, length_m
+        FROM mbm_routingedge
+    """
+    batches = []
+    # Use a server-side cursor and convert each batch to an array as we go,
+    # so that we never hold 1m+ edges in memory as Python tuples
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(LOAD_BATCH_SIZE)
+            if not rows:
+                break
+            batches.append(np.array(rows, dtype=np.float64))
+    edges = np.concatenate(batches) if batches else np.empty((0, 6))
+    return RoutingGraph.from_edges(edges)
+
+
+def load_edge_costs(osm_ids):
+    """
+    Load the `(gid, source, cost, reverse_cost)` of every routing edge along
+    the ways in `osm_ids`.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT gid, source, cost, reverse_cost
+            FROM mbm_routingedge
+            WHERE osm_id = ANY(%s::bigint[])
+        """, [list(osm_ids)])
+        return cursor.fetchall()
+
+
+def load_vertex_coordinates(vertex_ids):
+    """
+    Return a tuple of arrays `(lngs, lats)` with the coordinates of each of
+    the sorted `vertex_ids`. Vertices that can't be found get NaN
+    coordinates.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT id, ST_X(the_geom), ST_Y(the_geom)
+            FROM chicago_ways_vertices_pgr
+            WHERE id = ANY(%s::bigint[])
+        """, [vertex_ids.tolist()])
+        rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 3)
+
+    lngs = np.full(len(vertex_ids), np.nan)
+    lats = np.full(len(vertex_ids), np.nan)
+    idx = np.searchsorted(vertex_ids, rows[:, 0].astype(np.int64))
+    lngs[idx] = rows[:, 1]
+    lats[idx] = rows[:, 2]
+    return lngs, lats
+
+
+_snapshot = None
+_snapshot_version = None
+_snapshot_key = None
+_snapshot_lock = threading.Lock()
+
+
+def get_graph_snapshot():
+    """
+    Return a tuple `(graph, version)` with the current graph snapshot for
+    this process, or `(None, None)` if no snapshot has been built. The
+    snapshot is remapped whenever the current snapshot file changes.
+    """
+    global _snapshot, _snapshot_version, _snapshot_key
+    directory = settings.ROUTING_SNAPSHOT_DIR
+    current_path = os.path.join(directory, CURRENT_SNAPSHOT_FILE)
+    try:
+        stat = os.stat(current_path)
+    except OSError:
+        return None, None
+
+    # os.replace() gives the current snapshot file a new inode, so this
+    # changes whenever a new snapshot is swapped in
+    key = (stat.st_ino, stat.st_mtime_ns)
+    if key != _snapshot_key:
+        with _snapshot_lock:
+            if key != _snapshot_key:
+                with open(current_path) as f:
+                    name = f.read().strip()
+                _snapshot, _snapshot_version = RoutingGraph.open_snapshot(
+                    os.path.join(directory, name)
+                )
+                _snapshot_key = key
+    return _snapshot, _snapshot_version
+
+
+_graph = None
+_graph_version = None
+# The snapshot that `_graph` was patched from, if any
+_graph_snapshot = None
+_graph_lock = threading.Lock()
+
+
+def get_graph():
+    """
+    Return the routing graph for this process, loading it on first use and
+    updating it whenever the mellow data changes.
+
+    If a graph snapshot has been built, the graph is the mapped snapshot, so
+    that it's shared between processes. Once the mellow data changes, the
+    logged changes since the snapshot was built are applied over it, so
+    each process only holds its own copy of the costs until the snapshot is
+    rebuilt.
+    """
+    global _graph, _graph_version, _graph_snapshot
+    version = DataVersion.get(DataVersion.MELLOW)
+
+    snapshot, snapshot_version = get_graph_snapshot()
+    if snapshot is not None and snapshot_version >= version:
+        if _graph is not None:
+            with _graph_lock:
+                _graph, _graph_version, _graph_snapshot = None, None, None
+        return snapshot
+
+    if _graph is None or _graph_snapshot is not snapshot or _graph_version != version:
+        with _graph_lock:
+            if _graph is None or _graph_snapshot is not snapshot:
+                _graph = _load_graph_over(snapshot, snapshot_version, version)
+                _graph_snapshot = snapshot
+            elif _graph_version != version and not apply_changes(_graph, _graph_version, version):
+                _graph = load_graph()
+            _graph_version = version
+    return _graph
+
+
+def _load_graph_over(snapshot, snapshot_version, version):
+    """
+    Return the graph for mellow data version `version`, patched over the
+    stale `snapshot` of version `snapshot_version` if possible, or loaded
+    from the database otherwise.
+    """
+    if snapshot is None:
+        return load_graph()
+
+    graph = snapshot.copy()
+    if apply_changes(graph, snapshot_version, version):
+        logger.info(
+            'Applied mellow data changes since version %s over the graph '
+            'snapshot (current version is %s). Run the build_graph_snapshot '
+            'command to share the new costs between processes.',
+            snapshot_version,
+            version
+        )
+        return graph
+
+    logger.warning(
+        'Loading the graph instead of the snapshot built from mellow data '
+        'version %s, since the street network changed or the change log is '
+        'missing changes since then (current version is %s). Run the '
+        'build_graph_snapshot command to rebuild it.',
+        snapshot_version,
+        version
+    )
+    return load_graph()
+
+
+def apply_changes(graph, from_version, to_version):
+    """
+    Update the costs of `graph` from mellow data version `from_version` to
+    `to_version` using the change log, and return whether it succeeded.
+    Returns False if the log is missing any of the changes in between, or if
+    any of them changed the street network, in which case the graph has to
+    be reloaded.
+    """
+    changes = MellowChange.since(from_version, to_version)
+    # Edges and vertices can only be patched in place if the street network
+    # itself hasn't changed
+    if changes is None or any(change.topology_changed for change in changes):
+        return False
+    osm_ids = set()
+    for change in changes:
+        osm_ids.update(change.osm_ids)
+    if osm_ids:
+        graph.update_costs(load_edge_costs(osm_ids))
+    return True
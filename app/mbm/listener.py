@@ -0,0 +1,120 @@
+"""
+Live propagation of mellow data changes.
+
+Every change to the mellow data is announced with a NOTIFY on the
+`MellowChange.CHANNEL` channel. A `MellowChangeListener` thread in each app
+process listens for these and applies them straight away, so that the first
+request after an edit doesn't pay for it. Everything it updates also checks
+the mellow data version on use, so a process that misses a notification is
+never served stale data.
+"""
+import logging
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from mbm.caching import carry_over, isochrone_cache, route_cache
+from mbm.graph import get_graph
+from mbm.models import MellowChange
+from mbm.snapping import get_vertex_index
+from mbm.views import Isochrone, Route
+
+logger = logging.getLogger(__name__)
+
+# How long to wait for a notification before checking that the connection is
+# still alive, and how long to wait before reconnecting after an error, in
+# seconds
+POLL_TIMEOUT = 60
+RECONNECT_DELAY = 5
+
+
+class MellowChangeListener(threading.Thread):
+    """
+    A daemon thread that listens for mellow data changes and applies them to
+    the caches of this process.
+    """
+    def __init__(self):
+        super().__init__(name='mellow-change-listener', daemon=True)
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                logger.exception('Mellow change listener failed, reconnecting')
+                connection.close()
+                time.sleep(RECONNECT_DELAY)
+
+    def listen(self):
+        # Django gives each thread its own connection, and runs it in
+        # autocommit mode, so LISTEN takes effect immediately
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {MellowChange.CHANNEL}')
+        pg_connection = connection.connection
+        while True:
+            if select.select([pg_connection], [], [], POLL_TIMEOUT) == ([], [], []):
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                continue
+            pg_connection.poll()
+            versions = []
+            while pg_connection.notifies:
+                versions.append(int(pg_connection.notifies.pop(0).payload))
+            if versions:
+                topology_changed = MellowChange.objects.filter(
+                    version__in=versions,
+                    topology_changed=True
+                ).exists()
+                apply_change(max(versions), topology_changed=topology_changed)
+
+
+def apply_change(version, topology_changed=False):
+    """
+    Bring the caches of this process up to date with mellow data version
+    `version`. If `topology_changed`, the street network itself changed since
+    the last version this process applied.
+    """
+    if topology_changed:
+        # Vertices may have moved or disappeared, so the cached routes and
+        # isochrones between them can't be kept
+        route_cache.clear()
+        isochrone_cache.clear()
+        if settings.SNAPPING_BACKEND == 'memory':
+            # Reloads the vertex index for the new street network
+            get_vertex_index()
+    else:
+        # Cached routes and isochrones are keyed by version, so carry the
+        # ones that the change didn't touch over to the new version, and
+        # drop the rest rather than waiting for them to be evicted
+        carry_over(
+            route_cache,
+            version,
+            lambda keys: Route().get_search_bounds([key[:2] for key in keys])
+        )
+        carry_over(
+            isochrone_cache,
+            version,
+            lambda keys: Isochrone().get_reach_bounds([(key[0], max(key[1])) for key in keys])
+        )
+    if settings.ROUTING_BACKEND == 'memory':
+        # Applies just the changed edge costs to the in-process graph
+        get_graph()
+    logger.info('Applied mellow data version %s', version)
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def start_listener():
+    """Start the mellow change listener for this process, if it isn't already
+    running."""
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            _listener = MellowChangeListener()
+            _listener.start()
+    return _listener
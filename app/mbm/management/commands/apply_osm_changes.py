@@ -0,0 +1,52 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mbm.osm import apply_osm_changes
+
+
+class Command(BaseCommand):
+    """
+    Apply an OSM change file to the street network without reimporting it,
+    for example:
+
+        ./manage.py apply_osm_changes changes.osc --output report.json
+
+    Only the ways in the change file and the ways that share nodes with them
+    are split into edges again. The report lists the IDs of the edges and
+    vertices that changed.
+    """
+    help = 'Apply an OSM change file (.osc) to the routing tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Path to an OSM change file')
+        parser.add_argument('--output', help='Path to write the report of changed IDs to as JSON')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['path'], 'rb') as f:
+                report = apply_osm_changes(f)
+        except OSError as e:
+            raise CommandError(f'Could not read {options["path"]}: {e}')
+        except SyntaxError as e:
+            raise CommandError(f'Invalid change file: {e}')
+
+        self.stdout.write(
+            f'Rebuilt {len(report["ways"]["affected"])} ways '
+            f'({len(report["ways"]["changed"])} in the change file)'
+        )
+        self.stdout.write('edges: ' + ' '.join(f'{key}={len(ids)}' for key, ids in report['edges'].items()))
+        self.stdout.write('vertices: ' + ' '.join(f'{key}={len(ids)}' for key, ids in report['vertices'].items()))
+        if report['ways']['skipped']:
+            self.stdout.write(self.style.WARNING(
+                f'Skipped {len(report["ways"]["skipped"])} ways with unknown nodes or tags: '
+                + ', '.join(str(osm_id) for osm_id in report['ways']['skipped'])
+            ))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote report to {options["output"]}'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Successfully applied changes as mellow data version {report["version"]}.'
+        ))
@@ -0,0 +1,192 @@
+import datetime
+import json
+import subprocess
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+
+from mbm.benchmark import SyntheticCity, compare, run_trips
+from mbm.caching import route_cache
+from mbm.models import MellowRoute, RoutingEdge, SimplifiedRoute
+from mbm.views import Route
+
+
+class Command(BaseCommand):
+    """
+    Measure the latency of /api/route/ requests over a synthetic street
+    network. Run it with --setup against an empty local database to load the
+    network first, for example:
+
+        ./manage.py benchmark_routes --setup --output benchmark.json
+
+    and pass the results of an earlier run with --baseline to compare them.
+    """
+    help = 'Benchmark route requests against a synthetic street network.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--setup',
+            action='store_true',
+            help=(
+                'Load the synthetic street network and mellow routes before '
+                'benchmarking. Refuses to overwrite real OSM data.'
+            )
+        )
+        parser.add_argument('--rows', type=int, default=100, help='Number of east-west streets')
+        parser.add_argument('--cols', type=int, default=100, help='Number of north-south streets')
+        parser.add_argument('--trips', type=int, default=50, help='Number of trips of each length')
+        parser.add_argument('--repeat', type=int, default=3, help='Number of times to request each trip')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for picking trips')
+        parser.add_argument(
+            '--use-cache',
+            action='store_true',
+            help='Keep the route cache between requests instead of clearing it'
+        )
+        parser.add_argument('--output', help='Path to write the results to as JSON')
+        parser.add_argument('--baseline', help='Path to earlier results to compare against')
+
+    def handle(self, *args, **options):
+        city = SyntheticCity(rows=options['rows'], cols=options['cols'])
+        if options['setup']:
+            self.setup(city)
+
+        trips = city.trips(options['trips'], seed=options['seed'])
+        if not trips:
+            raise CommandError('The grid is too small for any of the trip lengths')
+
+        factory = RequestFactory()
+        view = Route.as_view()
+
+        def route(source, target):
+            response = view(factory.get('/api/route/', {'source': source, 'target': target}))
+            if response.status_code != 200:
+                raise CommandError(f'Route from {source} to {target} failed: {response.content}')
+            return json.loads(response.content)['route']['properties']
+
+        # Warm up connections and any in-process indexes before timing
+        route(trips[0][1], trips[0][2])
+
+        groups = run_trips(
+            route,
+            trips,
+            repeat=options['repeat'],
+            clear_cache=None if options['use_cache'] else route_cache.clear,
+        )
+        results = {
+            'commit': self.get_commit(),
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'settings': {
+                'ROUTING_BACKEND': settings.ROUTING_BACKEND,
+                'SNAPPING_BACKEND': settings.SNAPPING_BACKEND,
+                'use_cache': options['use_cache'],
+            },
+            'city': {'rows': city.rows, 'cols': city.cols},
+            'trips': len(trips),
+            'repeat': options['repeat'],
+            'groups': groups,
+        }
+
+        for group, summary in groups.items():
+            stats = ' '.join(f'{key}={value}' for key, value in summary.items())
+            self.stdout.write(f'{group}: {stats}')
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            self.stdout.write(f'\nCompared to {baseline.get("commit") or options["baseline"]}:')
+            for group, stat, before, after, change in compare(results, baseline):
+                self.stdout.write(f'{group} {stat}: {before} -> {after} ({change:+.1%})')
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote results to {options["output"]}'))
+
+    def get_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', 'HEAD'],
+                capture_output=True,
+                text=True,
+                check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def setup(self, city):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('chicago_ways') IS NOT NULL")
+            if cursor.fetchone()[0]:
+                cursor.execute('SELECT EXISTS (SELECT 1 FROM chicago_ways WHERE osm_id > 0)')
+                if cursor.fetchone()[0]:
+                    raise CommandError(
+                        'chicago_ways contains real OSM data. Run the benchmark '
+                        'against a separate database.'
+                    )
+
+        edges = city.edges()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("""
+                DROP TABLE IF EXISTS chicago_ways, chicago_ways_vertices_pgr;
+                CREATE TABLE chicago_ways_vertices_pgr (
+                    id bigint PRIMARY KEY,
+                    the_geom geometry(Point, 4326)
+                );
+                CREATE TABLE chicago_ways (
+                    gid bigint PRIMARY KEY,
+                    osm_id bigint,
+                    tag_id integer,
+                    length double precision,
+                    length_m double precision,
+                    name text,
+                    source bigint,
+                    target bigint,
+                    cost double precision,
+                    reverse_cost double precision,
+                    one_way integer,
+                    oneway text,
+                    the_geom geometry(LineString, 4326)
+                );
+            """)
+            cursor.executemany("""
+                INSERT INTO chicago_ways_vertices_pgr (id, the_geom)
+                VALUES (%s, ST_SetSRID(ST_MakePoint(%s, %s), 4326))
+            """, city.vertices())
+            cursor.executemany("""
+                INSERT INTO chicago_ways (
+                    gid, osm_id, tag_id, length, length_m, name, source,
+                    target, cost, reverse_cost, one_way, oneway, the_geom
+                )
+                VALUES (
+                    %(gid)s, %(osm_id)s, %(tag_id)s, %(length)s, %(length_m)s,
+                    %(name)s, %(source)s, %(target)s, %(cost)s,
+                    %(reverse_cost)s, %(one_way)s, %(oneway)s,
+                    ST_GeomFromText(%(the_geom)s, 4326)
+                )
+            """, [dict(edge, one_way=1 if edge['oneway'] == 'YES' else 2) for edge in edges])
+            cursor.execute("""
+                CREATE INDEX ON chicago_ways(osm_id);
+                CREATE INDEX ON chicago_ways(source);
+                CREATE INDEX ON chicago_ways(target);
+                CREATE INDEX ON chicago_ways USING GIST(the_geom);
+                CREATE INDEX ON chicago_ways_vertices_pgr USING GIST(the_geom);
+            """)
+
+            # Create the mellow routes without sending save signals, and
+            # refresh everything derived from them once at the end
+            MellowRoute.objects.all().delete()
+            MellowRoute.objects.bulk_create([
+                MellowRoute(slug='synthetic', name='Synthetic City', type=type, ways=ways)
+                for type, ways in city.mellow_ways(edges).items()
+            ])
+            RoutingEdge.refresh()
+            SimplifiedRoute.refresh()
+
+        call_command('build_components', stdout=self.stdout)
+        self.stdout.write(
+            f'Loaded synthetic city with {city.rows * city.cols} vertices and '
+            f'{len(edges)} edges'
+        )
@@ -0,0 +1,108 @@
+import json
+
+import psycopg2
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from mbm.benchmark import compare_statements
+from mbm.statements import PreparedConnection
+from mbm.views import Route
+
+
+class Command(BaseCommand):
+    """
+    Compare the time that Postgres spends planning and executing the
+    snapping and route queries of /api/route/ as ad hoc queries and as
+    prepared statements, between random pairs of vertices, for example:
+
+        ./manage.py benchmark_statements --pairs 50 --output statements.json
+
+    Postgres plans the first few executions of a prepared statement with
+    its parameters before it settles on a generic plan, so use --repeat to
+    see the steady state.
+    """
+    help = 'Compare ad hoc and prepared routing queries.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pairs', type=int, default=50, help='Number of vertex pairs to route between')
+        parser.add_argument('--repeat', type=int, default=3, help='Number of times to run each query')
+        parser.add_argument('--seed', type=float, default=0, help='Random seed between -1 and 1 for picking vertices')
+        parser.add_argument('--output', help='Path to write the results to as JSON')
+
+    def handle(self, *args, **options):
+        conn = psycopg2.connect(
+            connection_factory=PreparedConnection,
+            **connections['default'].get_connection_params()
+        )
+        try:
+            cases = self.get_cases(conn, options['pairs'], options['seed'])
+            if not cases:
+                raise CommandError('There are no routing vertices to benchmark with')
+            groups = compare_statements(conn, cases, repeat=options['repeat'])
+        finally:
+            conn.close()
+
+        results = {'groups': groups, 'planning_saved_ms': {}}
+        for group, stages in groups.items():
+            stats = ' '.join(
+                f'{stage}_p50_ms={summary["p50_ms"]}' for stage, summary in stages.items()
+            )
+            self.stdout.write(f'{group}: {stats}')
+
+        for case in sorted({group.split(':')[0] for group in groups}):
+            saved = (
+                groups[f'{case}:adhoc']['planning']['mean_ms']
+                - groups[f'{case}:prepared']['planning']['mean_ms']
+            )
+            results['planning_saved_ms'][case] = round(saved, 3)
+            self.stdout.write(self.style.SUCCESS(
+                f'{case}: prepared statements save {saved:.3f}ms of planning per query on average'
+            ))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote results to {options["output"]}'))
+
+    def get_cases(self, conn, pairs, seed):
+        """Return the cases for `compare_statements`: snapping a point and
+        routing between a pair of vertices, for `pairs` random pairs.
+
+        Coordinates are read from the vertex geometries, since the synthetic
+        city that `benchmark_routes` loads has no `lon` and `lat` columns."""
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT setseed(%s)', [seed])
+            cursor.execute("""
+                SELECT id, ST_X(the_geom), ST_Y(the_geom)
+                FROM chicago_ways_vertices_pgr
+                ORDER BY random()
+                LIMIT %s
+            """, [pairs * 2])
+            vertices = cursor.fetchall()
+
+        route = Route()
+        cases = []
+        for (source, lng, lat), (target, _, _) in zip(vertices[::2], vertices[1::2]):
+            # Coordinates come in as lat,lng, like the app sends them
+            coord = [str(lat), str(lng)]
+            cases.append((
+                'nearest_vertex',
+                route._build_nearest_vertex_query(coord),
+                route._nearest_vertex_statement(),
+                route._build_nearest_vertex_query(coord)[1],
+            ))
+
+            # Routes are compact, like the app requests them
+            path_sql, _ = route._build_search_queries(source, target, use_bbox=True)
+            cases.append((
+                'route',
+                route._route_document_query_args(
+                    path_sql,
+                    [source, target],
+                    used_bbox=True,
+                    compact=True
+                ),
+                route._route_statement(use_bbox=True, compact=True),
+                [source, target, 1, 0],
+            ))
+        return cases
@@ -0,0 +1,47 @@
+import io
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from mbm.graph import load_graph
+from mbm.models import DataVersion
+
+
+class Command(BaseCommand):
+    """
+    Label every routing vertex with its strongly and weakly connected
+    components, so that the route API can detect unreachable pairs of
+    vertices before running any routing query.
+    """
+    help = 'Precompute connected components of the routing graph.'
+
+    def handle(self, *args, **kwargs):
+        start = time.monotonic()
+        graph = load_graph()
+        strong = graph.strong_components()
+        weak = graph.weak_components()
+        self.stdout.write(
+            f'Found {strong.max() + 1 if len(strong) else 0} strong and '
+            f'{weak.max() + 1 if len(weak) else 0} weak components among '
+            f'{graph.num_vertices} vertices in {time.monotonic() - start:.1f}s'
+        )
+
+        buf = io.StringIO()
+        for row in zip(graph.vertex_ids.tolist(), strong.tolist(), weak.tolist()):
+            buf.write('%d\t%d\t%d\n' % row)
+        buf.seek(0)
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('TRUNCATE mbm_vertexcomponent')
+            cursor.copy_from(
+                buf,
+                'mbm_vertexcomponent',
+                columns=('vertex_id', 'strong_component', 'weak_component')
+            )
+            # App processes keep the components in their vertex indexes, so
+            # have them reload. The mellow data itself hasn't changed, so
+            # routing graphs and cached routes stay valid.
+            DataVersion.bump(DataVersion.VERTICES)
+
+        self.stdout.write('Successfully saved vertex components.')
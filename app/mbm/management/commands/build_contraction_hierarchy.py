@@ -0,0 +1,53 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mbm.contraction import ContractionHierarchy
+from mbm.graph import load_graph
+from mbm.models import DataVersion
+
+
+class Command(BaseCommand):
+    """
+    Build a contraction hierarchy over the mellow-weighted routing graph for
+    the 'ch' routing backend.
+    """
+    help = 'Build the contraction hierarchy used by the "ch" routing backend.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            default=settings.ROUTING_CH_PATH,
+            help='Path to write the hierarchy to (default: %(default)s)'
+        )
+
+    def handle(self, *args, **options):
+        # Record the version before loading the graph, so that any edits made
+        # while we're building will mark the hierarchy as stale
+        version = DataVersion.get(DataVersion.MELLOW)
+
+        start = time.monotonic()
+        graph = load_graph()
+        self.stdout.write(
+            f'Loaded graph with {graph.num_vertices} vertices and '
+            f'{graph.num_arcs} arcs in {time.monotonic() - start:.1f}s'
+        )
+
+        start = time.monotonic()
+        hierarchy = ContractionHierarchy.build(
+            graph,
+            version=version,
+            log=self.stdout.write
+        )
+        self.stdout.write(
+            f'Built hierarchy with {len(hierarchy.up_targets)} upward and '
+            f'{len(hierarchy.down_sources)} downward arcs in '
+            f'{time.monotonic() - start:.1f}s'
+        )
+
+        hierarchy.save(options['output'])
+        self.stdout.write(
+            f'Successfully wrote contraction hierarchy for mellow data '
+            f'version {version} to {options["output"]}'
+        )
@@ -0,0 +1,43 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mbm.graph import load_graph, load_vertex_coordinates
+from mbm.models import DataVersion
+
+
+class Command(BaseCommand):
+    """
+    Write a snapshot of the mellow-weighted routing graph that processes
+    using the 'memory' routing backend can share. Rerun it whenever the
+    mellow data changes; processes pick up the new snapshot on their next
+    route request.
+    """
+    help = 'Build the shared graph snapshot used by the "memory" routing backend.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output-dir',
+            default=settings.ROUTING_SNAPSHOT_DIR,
+            help='Directory to write the snapshot to (default: %(default)s)'
+        )
+
+    def handle(self, *args, **options):
+        # Record the version before loading the graph, so that any edits made
+        # while we're building will mark the snapshot as stale
+        version = DataVersion.get(DataVersion.MELLOW)
+
+        start = time.monotonic()
+        graph = load_graph()
+        graph.lngs, graph.lats = load_vertex_coordinates(graph.vertex_ids)
+        self.stdout.write(
+            f'Loaded graph with {graph.num_vertices} vertices and '
+            f'{graph.num_arcs} arcs in {time.monotonic() - start:.1f}s'
+        )
+
+        path = graph.save_snapshot(options['output_dir'], version)
+        self.stdout.write(
+            f'Successfully wrote graph snapshot for mellow data version '
+            f'{version} to {path}'
+        )
@@ -1,14 +1,27 @@
 # Adapted from https://github.com/rdegges/django-clear-cache
 from django.conf import settings
-from django.core.cache import cache
+from django.core.cache import caches
 from django.core.management.base import BaseCommand, CommandError
 
+from mbm.tiered_cache import GENERATION_KEY, TieredCache
+
 
 class Command(BaseCommand):
-    """A simple management command which clears the site-wide cache."""
+    """
+    A simple management command which clears the site-wide cache.
+
+    With the tiered cache, it reports the number of entries in the shared
+    tier and the generation that local tiers were filled in. Clearing the
+    cache bumps the generation, and app processes drop their local tiers
+    once they see that it changed. Their local tiers aren't reported, since
+    this command only sees its own, which is always empty.
+    """
     help = 'Fully clear your site-wide cache.'
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument('--stats', action='store_true', help='Report on the cache without clearing it')
+
+    def handle(self, *args, **options):
         try:
             assert settings.CACHES
         except AttributeError:
@@ -16,5 +29,16 @@ class Command(BaseCommand):
                 'No cache configured. Check CACHES in settings.py.'
             )
 
+        cache = caches['default']
+        tiered = isinstance(cache, TieredCache)
+        if tiered:
+            self.stdout.write(f'shared: alias={cache.shared_alias} entries={cache.shared_entries()}')
+            self.stdout.write(f'generation: {cache.shared.get(GENERATION_KEY)}')
+
+        if options['stats']:
+            return
+
         cache.clear()
+        if tiered:
+            self.stdout.write(f'Bumped the generation to {cache.local.generation}.')
         self.stdout.write('Successfully cleared the cache.')
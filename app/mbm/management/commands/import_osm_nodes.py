@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from mbm.osm import import_osm_nodes
+
+
+class Command(BaseCommand):
+    """
+    Load the node locations and node lists of routable ways from the OSM
+    extract that osm2pgrouting imported, which `apply_osm_changes` needs to
+    split ways again. Run this after importing new OSM data.
+    """
+    help = 'Load OSM node locations and way node lists for incremental updates.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Path to the OSM XML file that osm2pgrouting imported')
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        num_ways, num_nodes = import_osm_nodes(options['path'])
+        self.stdout.write(
+            f'Successfully loaded {num_ways} ways and {num_nodes} nodes '
+            f'in {time.monotonic() - start:.1f}s.'
+        )
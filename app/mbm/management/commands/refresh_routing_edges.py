@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from mbm.models import RoutingEdge
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the routing edge table from chicago_ways and mbm_mellowroute.
+    Run this after importing new OSM data.
+
+    Deploys run it with --if-empty, so that a fresh routing edge table gets
+    filled without rebuilding it on every deploy.
+    """
+    help = 'Rebuild the mellow-weighted routing edge table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--if-empty',
+            action='store_true',
+            help='Only rebuild the table if it has no edges'
+        )
+
+    def handle(self, *args, **options):
+        if 'chicago_ways' not in connection.introspection.table_names():
+            self.stdout.write('Skipping the routing edges, since chicago_ways has not been imported.')
+            return
+        if options['if_empty'] and RoutingEdge.objects.exists():
+            self.stdout.write('Routing edges are already built.')
+            return
+
+        RoutingEdge.refresh()
+        self.stdout.write(
+            f'Successfully refreshed {RoutingEdge.objects.count()} routing edges.'
+        )
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from mbm.models import SimplifiedRoute
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the simplified mellow route geometries from chicago_ways and
+    mbm_mellowroute. Run this after importing new OSM data.
+
+    Deploys run it with --if-empty, so that a fresh simplified route table
+    gets filled without rebuilding it on every deploy.
+    """
+    help = 'Rebuild the simplified mellow route geometries.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--if-empty',
+            action='store_true',
+            help='Only rebuild the table if it has no lines'
+        )
+
+    def handle(self, *args, **options):
+        if 'chicago_ways' not in connection.introspection.table_names():
+            self.stdout.write('Skipping the simplified routes, since chicago_ways has not been imported.')
+            return
+        if options['if_empty'] and SimplifiedRoute.objects.exists():
+            self.stdout.write('Simplified routes are already built.')
+            return
+
+        SimplifiedRoute.refresh()
+        self.stdout.write(
+            f'Successfully refreshed {SimplifiedRoute.objects.count()} simplified route lines.'
+        )
@@ -0,0 +1,79 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mbm.replay import load_corpus, replay
+
+
+class Command(BaseCommand):
+    """
+    Replay a corpus of route requests to measure throughput and latency
+    under load, for example:
+
+        ./manage.py replay_routes requests.jsonl --concurrency 8
+
+    Requests go to the `Route` view in this process unless --url points at a
+    running server.
+    """
+    help = 'Replay a JSONL corpus of route requests and report on the results.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('corpus', help='Path to a JSONL file of route requests')
+        parser.add_argument(
+            '--url',
+            help='Base URL of a running server to send requests to, like http://localhost:8000'
+        )
+        parser.add_argument('--concurrency', type=int, default=1, help='Number of concurrent workers')
+        parser.add_argument(
+            '--processes',
+            action='store_true',
+            help='Run workers in separate processes instead of threads'
+        )
+        parser.add_argument('--limit', type=int, help='Only replay the first LIMIT requests')
+        parser.add_argument('--repeat', type=int, default=1, help='Number of times to replay the corpus')
+        parser.add_argument('--timeout', type=float, default=30, help='HTTP request timeout, in seconds')
+        parser.add_argument('--output', help='Path to write the report to as JSON')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+
+        try:
+            with open(options['corpus']) as f:
+                requests = load_corpus(f)
+        except ValueError as e:
+            raise CommandError(f'Invalid corpus: {e}')
+        if options['limit'] is not None:
+            requests = requests[:options['limit']]
+        requests = requests * options['repeat']
+        if not requests:
+            raise CommandError('The corpus has no requests')
+
+        self.stdout.write(
+            f'Replaying {len(requests)} requests with {options["concurrency"]} '
+            f'{"processes" if options["processes"] else "threads"} '
+            f'against {options["url"] or "the Route view in process"}'
+        )
+        results = replay(
+            requests,
+            base_url=options['url'],
+            concurrency=options['concurrency'],
+            processes=options['processes'],
+            timeout=options['timeout'],
+        )
+
+        self.stdout.write(
+            f'{results["requests"]} requests in {results["duration_s"]}s '
+            f'({results["throughput_rps"]} requests/s)'
+        )
+        self.stdout.write('latency: ' + ' '.join(f'{key}={value}' for key, value in results['latency'].items()))
+        self.stdout.write('search: ' + ' '.join(f'{key}={value}' for key, value in results['search'].items()))
+        if results['errors']:
+            self.stdout.write(self.style.WARNING(
+                'errors: ' + ' '.join(f'{key}={value}' for key, value in results['errors'].items())
+            ))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote report to {options["output"]}'))
@@ -0,0 +1,195 @@
+"""
+In-process request metrics, exposed in the Prometheus text format.
+
+Each app process keeps its own counters and histograms, so a scraper sees
+one set of series per process, the same way it would with the standard
+Prometheus client in multi-process servers without a shared directory.
+Stage timings for a single request are also reported to the client in a
+`Server-Timing` header by `StageTimer`.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Upper bounds of the route edge count histogram buckets
+EDGE_COUNT_BUCKETS = (0, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return '{%s}' % pairs
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class for a metric with an optional set of label names. Values are
+    tracked separately for every combination of label values.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name} takes labels {self.labels}, got {tuple(labels)}')
+        return tuple(labels[name] for name in self.labels)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+            lines.extend(self._render_samples(values))
+        return lines
+
+    def _render_samples(self, values):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A count that only goes up."""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _render_samples(self, values):
+        for key, value in values:
+            yield f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}'
+
+
+class Histogram(Metric):
+    """Counts of observations in cumulative buckets, plus their sum."""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(self._key(labels), ([], 0))
+        return sum(counts)
+
+    def _render_samples(self, values):
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labels + ('le',), key + (_format_value(bound),))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labels, key)
+            yield f'{self.name}_sum{labels} {_format_value(total)}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Collected(Metric):
+    """
+    A metric whose values are read by calling `collect()` whenever the
+    metrics are rendered, for values that are already tracked elsewhere.
+    `collect` returns a list of `(labels, value)` pairs, and `type` is the
+    Prometheus type to report them as.
+    """
+    def __init__(self, name, documentation, collect, labels=(), type='gauge'):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+        self.type = type
+
+    def render(self):
+        values = {self._key(labels): value for labels, value in self.collect()}
+        with self._lock:
+            self._values = values
+        return super().render()
+
+    def _render_samples(self, values):
+        for key, value in values:
+            yield f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}'
+
+
+# Every metric, in the order that it's rendered
+REGISTRY = []
+
+
+def render():
+    """Render every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class StageTimer:
+    """
+    Times the stages of a single request. Stages that run more than once,
+    like the searches in successively larger bounding boxes, are added up.
+
+    Every stage is also observed in `histogram` under a `stage` label.
+    """
+    def __init__(self, histogram=None):
+        self.histogram = histogram
+        self.stages = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0) + elapsed
+            if self.histogram is not None:
+                self.histogram.observe(elapsed, stage=name)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def header(self):
+        """Return the stage durations as a `Server-Timing` header value, in
+        milliseconds, followed by the total time so far."""
+        entries = [
+            f'{name};dur={duration * 1000:.2f}'
+            for name, duration in self.stages.items()
+        ]
+        entries.append(f'total;dur={self.elapsed() * 1000:.2f}')
+        return ', '.join(entries)
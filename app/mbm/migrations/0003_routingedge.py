@@ -0,0 +1,28 @@
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mbm', '0002_dataversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoutingEdge',
+            fields=[
+                ('gid', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('osm_id', models.BigIntegerField(db_index=True)),
+                ('source', models.BigIntegerField()),
+                ('target', models.BigIntegerField()),
+                ('cost', models.FloatField()),
+                ('reverse_cost', models.FloatField()),
+                ('length_m', models.FloatField()),
+                ('name', models.TextField(null=True)),
+                ('tag_id', models.IntegerField()),
+                ('type', models.CharField(choices=[('route', 'Official bike route'), ('street', 'Mellow street'), ('path', 'Off-street bike path')], db_index=True, max_length=6, null=True)),
+                ('the_geom', django.contrib.gis.db.models.fields.LineStringField(srid=4326)),
+            ],
+        ),
+    ]
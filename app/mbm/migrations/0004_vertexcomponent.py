@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mbm', '0003_routingedge'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VertexComponent',
+            fields=[
+                ('vertex_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('strong_component', models.IntegerField(db_index=True)),
+                ('weak_component', models.IntegerField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mbm', '0004_vertexcomponent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimplifiedRoute',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(choices=[('route', 'Official bike route'), ('street', 'Mellow street'), ('path', 'Off-street bike path')], max_length=6)),
+                ('tolerance', models.FloatField(db_index=True)),
+                ('the_geom', django.contrib.gis.db.models.fields.LineStringField(srid=4326)),
+            ],
+        ),
+    ]
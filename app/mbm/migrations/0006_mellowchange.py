@@ -0,0 +1,24 @@
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mbm', '0005_simplifiedroute'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MellowChange',
+            fields=[
+                ('version', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('osm_ids', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), default=list, size=None)),
+                ('min_lng', models.FloatField(null=True)),
+                ('min_lat', models.FloatField(null=True)),
+                ('max_lng', models.FloatField(null=True)),
+                ('max_lat', models.FloatField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
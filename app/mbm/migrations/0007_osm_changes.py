@@ -0,0 +1,36 @@
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mbm', '0006_mellowchange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mellowchange',
+            name='topology_changed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='OsmNode',
+            fields=[
+                ('osm_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('lng', models.FloatField()),
+                ('lat', models.FloatField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OsmWayNodes',
+            fields=[
+                ('osm_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('nodes', django.contrib.postgres.fields.ArrayField(base_field=models.BigIntegerField(), size=None)),
+            ],
+            options={
+                'indexes': [django.contrib.postgres.indexes.GinIndex(fields=['nodes'], name='mbm_osmwayn_nodes_8fcbb7_gin')],
+            },
+        ),
+    ]
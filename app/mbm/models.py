@@ -1,9 +1,14 @@
 import json
 
-from django.db import models, connection
+from django.db import models, connection, transaction
 from django.contrib.postgres import fields as pg_models
+from django.contrib.postgres.indexes import GinIndex
 from django.contrib.gis.db import models as gis_models
 
+from mbm.costs import cost_sql
+
+METERS_PER_MILE = 1609.344
+
 
 class Edge(models.Model):
     """
@@ -41,6 +46,70 @@ class Edge(models.Model):
         managed = False
         db_table = 'chicago_ways'
 
+    # A GeoJSON feature for each OSM way, merged from the edges in `way`,
+    # for the way picker on the mellow route edit form
+    WAY_FEATURE_SQL = """
+        json_build_object(
+            'type', 'Feature',
+            'geometry', ST_AsGeoJSON(
+                ST_Simplify(ST_LineMerge(ST_Union(way.the_geom)), %s, true),
+                6
+            )::json,
+            'properties', json_build_object(
+                'id', way.osm_id::varchar,
+                'name', MAX(way.name)
+            )
+        )
+    """
+
+    @classmethod
+    def way_tile(cls, z, x, y):
+        """
+        Return a GeoJSON FeatureCollection, serialized as a string, with a
+        feature for every OSM way that intersects the web mercator tile
+        `z/x/y`. Ways are returned whole rather than clipped to the tile, so
+        that a way that spans several tiles is the same feature in each, and
+        simplified to the resolution of the tile's zoom level.
+        """
+        tolerance = SimplifiedRoute.tolerance_for_zoom(z)
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                WITH tile_ways AS (
+                    SELECT DISTINCT osm_id
+                    FROM chicago_ways
+                    WHERE the_geom && ST_Transform(ST_TileEnvelope(%s, %s, %s), 4326)
+                ),
+                features AS (
+                    SELECT {cls.WAY_FEATURE_SQL} AS feature
+                    FROM chicago_ways AS way
+                    JOIN tile_ways USING (osm_id)
+                    GROUP BY way.osm_id
+                )
+                SELECT json_build_object(
+                    'type', 'FeatureCollection',
+                    'features', COALESCE(json_agg(feature), '[]'::json)
+                )::text
+                FROM features
+            """, [z, x, y, tolerance])
+            return cursor.fetchone()[0]
+
+    @classmethod
+    def way_features(cls, osm_ids):
+        """
+        Return a list of GeoJSON features for the OSM ways in `osm_ids`, in
+        the same shape as the features of `way_tile` but not simplified.
+        """
+        if not osm_ids:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT {cls.WAY_FEATURE_SQL}
+                FROM chicago_ways AS way
+                WHERE way.osm_id = ANY(%s::bigint[])
+                GROUP BY way.osm_id
+            """, [0, [int(osm_id) for osm_id in osm_ids]])
+            return [row[0] for row in cursor.fetchall()]
+
 
 class Way(models.Model):
     """
@@ -60,6 +129,32 @@ class Way(models.Model):
         db_table = 'osm_ways'
 
 
+class OsmNode(models.Model):
+    """
+    Model storing the location of every OSM node along a routable way.
+    osm2pgrouting only keeps the nodes where ways are split, so applying an
+    OSM change file needs these to rebuild the edges of a way whose nodes
+    weren't part of the change. Loaded by `import_osm_nodes` and kept up to
+    date by `apply_osm_changes`.
+    """
+    osm_id = models.BigIntegerField(primary_key=True)
+    lng = models.FloatField()
+    lat = models.FloatField()
+
+
+class OsmWayNodes(models.Model):
+    """
+    Model storing the ordered node IDs of every routable OSM way, so that we
+    can tell which ways share nodes with a changed way and need to be split
+    again. Loaded and kept up to date along with `OsmNode`.
+    """
+    osm_id = models.BigIntegerField(primary_key=True)
+    nodes = pg_models.ArrayField(models.BigIntegerField())
+
+    class Meta:
+        indexes = [GinIndex(fields=['nodes'])]
+
+
 class MellowRoute(models.Model):
     """
     Model representing a collection of mellow routes, bounded by a particular
@@ -89,38 +184,487 @@ class MellowRoute(models.Model):
         unique_together = ('slug', 'type')
 
     @classmethod
-    def all(cls):
+    def all(cls, bbox=None, zoom=None):
         """
-        Retrieve all mellow routes and return their unioned geometries as a
-        dictionary grouped by route type.
+        Retrieve all mellow routes and return their geometries as a GeoJSON
+        FeatureCollection with one feature per route type.
+
+        If `bbox` is a `(min_lng, min_lat, max_lng, max_lat)` tuple, only
+        return geometries that intersect it. If `zoom` is a web map zoom
+        level, return geometries simplified for display at that zoom.
         """
         with connection.cursor() as cursor:
-            cursor.execute("""
-                SELECT
-                    routes.type,
-                    ST_AsGeoJSON(ST_Union(chicago_ways.the_geom)) AS geometry
-                FROM chicago_ways
-                JOIN (
-                    SELECT UNNEST(ways) AS osm_id, type
-                    FROM mbm_mellowroute
-                ) as routes
-                USING(osm_id)
-                GROUP BY routes.type
-            """)
-            rows = fetchall(cursor)
+            cursor.execute(*cls.all_query(bbox=bbox, zoom=zoom))
+            return cls.all_from_rows(cursor.fetchall())
+
+    @classmethod
+    def all_query(cls, bbox=None, zoom=None):
+        """Return a tuple `(sql, params)` of the query behind `all`."""
+        tolerance = SimplifiedRoute.tolerance_for_zoom(zoom)
+        if bbox is not None:
+            bbox_sql, params = 'AND the_geom && ST_MakeEnvelope(%s, %s, %s, %s, 4326)', [tolerance, *bbox]
+        else:
+            bbox_sql, params = '', [tolerance]
+
+        return f"""
+            SELECT
+                type,
+                ST_AsGeoJSON(ST_Collect(the_geom)) AS geometry
+            FROM mbm_simplifiedroute
+            WHERE tolerance = %s
+            {bbox_sql}
+            GROUP BY type
+        """, params
 
+    @classmethod
+    def all_from_rows(cls, rows):
+        """Build the result of `all` from the rows of `all_query`."""
         return {
             'type': 'FeatureCollection',
             'features': [
                 {
                     'type': 'Feature',
-                    'geometry': json.loads(row['geometry']),
-                    'properties': {'type': row['type']}
+                    'geometry': json.loads(geometry),
+                    'properties': {'type': route_type}
                 }
-                for row in rows
+                for route_type, geometry in rows
             ]
         }
 
+    @classmethod
+    def neighborhoods(cls):
+        """
+        Summarize every neighborhood in a GeoJSON FeatureCollection with one
+        feature per neighborhood, rather than one per route type. Each
+        feature's geometry is the neighborhood's bounding box, and its
+        properties are its `slug` and `name`, the number of ways of each
+        route type in `way_counts` and in total in `num_ways`, and the total
+        length of its ways in miles in `length_mi`. Features are sorted by
+        name.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                WITH neighborhoods AS (
+                    SELECT
+                        slug,
+                        MIN(name) AS name,
+                        (ARRAY_AGG(bounding_box) FILTER (
+                            WHERE bounding_box IS NOT NULL
+                        ))[1] AS bounding_box,
+                        JSON_OBJECT_AGG(type, CARDINALITY(ways)) AS way_counts,
+                        SUM(CARDINALITY(ways)) AS num_ways
+                    FROM mbm_mellowroute
+                    GROUP BY slug
+                ),
+                lengths AS (
+                    SELECT route.slug, SUM(way.length_m) AS length_m
+                    FROM (
+                        SELECT DISTINCT slug, UNNEST(ways) AS osm_id
+                        FROM mbm_mellowroute
+                    ) AS route
+                    JOIN chicago_ways AS way
+                    USING (osm_id)
+                    GROUP BY route.slug
+                )
+                SELECT json_build_object(
+                    'type', 'FeatureCollection',
+                    'features', COALESCE(
+                        json_agg(
+                            json_build_object(
+                                'type', 'Feature',
+                                'geometry', ST_AsGeoJSON(hood.bounding_box)::json,
+                                'properties', json_build_object(
+                                    'slug', hood.slug,
+                                    'name', hood.name,
+                                    'way_counts', hood.way_counts,
+                                    'num_ways', hood.num_ways,
+                                    'length_mi', ROUND(
+                                        (COALESCE(lengths.length_m, 0) / %s)::numeric,
+                                        1
+                                    )
+                                )
+                            )
+                            ORDER BY hood.name
+                        ),
+                        '[]'::json
+                    )
+                )
+                FROM neighborhoods AS hood
+                LEFT JOIN lengths
+                USING (slug)
+            """, [METERS_PER_MILE])
+            return cursor.fetchone()[0]
+
+    @classmethod
+    def tile(cls, z, x, y):
+        """
+        Render the mellow routes within the web mercator tile `z/x/y` as a
+        Mapbox vector tile, with one feature per route type in a layer named
+        'routes'.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                WITH bounds AS (
+                    SELECT
+                        ST_TileEnvelope(%s, %s, %s) AS geom,
+                        ST_Transform(ST_TileEnvelope(%s, %s, %s), 4326) AS geom_4326
+                ),
+                routes AS (
+                    SELECT
+                        edge.type,
+                        ST_AsMVTGeom(
+                            ST_Transform(ST_LineMerge(ST_Collect(edge.the_geom)), 3857),
+                            bounds.geom
+                        ) AS geom
+                    FROM mbm_routingedge AS edge
+                    CROSS JOIN bounds
+                    -- Filter in EPSG 4326 so that we can use the spatial index
+                    WHERE edge.the_geom && bounds.geom_4326
+                    AND edge.type IS NOT NULL
+                    GROUP BY edge.type, bounds.geom
+                )
+                SELECT ST_AsMVT(routes, 'routes')
+                FROM routes
+                WHERE geom IS NOT NULL
+            """, [z, x, y, z, x, y])
+            tile = cursor.fetchone()[0]
+        return bytes(tile) if tile else b''
+
+
+class RoutingEdge(models.Model):
+    """
+    Model representing an Edge with its final mellow-adjusted routing costs.
+
+    This table is derived from `chicago_ways` and `mbm_mellowroute` so that
+    routing queries can read the edge set with a plain indexed scan, instead
+    of unnesting every MellowRoute and evaluating the cost model for every
+    edge on every request. It's refreshed for the affected ways whenever a
+    MellowRoute changes, and in full by the `refresh_routing_edges` command.
+    """
+    gid = models.BigIntegerField(primary_key=True)
+    osm_id = models.BigIntegerField(db_index=True)
+    source = models.BigIntegerField()
+    target = models.BigIntegerField()
+    cost = models.FloatField()
+    reverse_cost = models.FloatField()
+    length_m = models.FloatField()
+    name = models.TextField(null=True)
+    tag_id = models.IntegerField()
+    type = models.CharField(
+        max_length=6,
+        choices=MellowRoute.Type.choices,
+        null=True,
+        db_index=True
+    )
+    the_geom = gis_models.LineStringField()
+
+    @classmethod
+    def refresh(cls, osm_ids=None):
+        """
+        Recompute the routing edges for the ways in `osm_ids`, or for every
+        way if `osm_ids` is None.
+        """
+        if osm_ids is not None:
+            osm_ids = list(osm_ids)
+            if not osm_ids:
+                return
+            where_sql, params = 'WHERE way.osm_id = ANY(%s::bigint[])', [osm_ids]
+        else:
+            where_sql, params = '', []
+
+        # When a way belongs to more than one type of MellowRoute, it takes on
+        # the type that gives it the cheapest cost
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"""
+                DELETE FROM mbm_routingedge AS way
+                {where_sql}
+            """, params)
+            cursor.execute(f"""
+                INSERT INTO mbm_routingedge (
+                    gid, osm_id, source, target, cost, reverse_cost,
+                    length_m, name, tag_id, type, the_geom
+                )
+                SELECT
+                    gid,
+                    osm_id,
+                    source,
+                    target,
+                    {cost_sql('cost')} AS cost,
+                    {cost_sql('reverse_cost')} AS reverse_cost,
+                    length_m,
+                    name,
+                    tag_id,
+                    type,
+                    the_geom
+                FROM (
+                    SELECT
+                        way.gid,
+                        way.osm_id,
+                        way.source,
+                        way.target,
+                        way.cost,
+                        way.reverse_cost,
+                        way.length_m,
+                        way.name,
+                        way.tag_id,
+                        way.oneway,
+                        mellow.type,
+                        way.the_geom
+                    FROM chicago_ways AS way
+                    LEFT JOIN (
+                        SELECT
+                            osm_id,
+                            (ARRAY_AGG(type ORDER BY CASE type
+                                WHEN 'path' THEN 0
+                                WHEN 'street' THEN 1
+                                ELSE 2
+                            END))[1] AS type
+                        FROM (
+                            SELECT UNNEST(ways) AS osm_id, type
+                            FROM mbm_mellowroute
+                        ) AS routes
+                        GROUP BY osm_id
+                    ) AS mellow
+                    USING(osm_id)
+                    {where_sql}
+                ) AS edge
+            """, params)
+
+
+class SimplifiedRoute(models.Model):
+    """
+    Model storing the merged geometries of each type of mellow route,
+    simplified at each of a fixed set of tolerances so that we don't have to
+    union the mellow ways on every request. The rows for a type are rebuilt
+    whenever a MellowRoute of that type changes.
+    """
+    # Simplification tolerances in degrees. 0 keeps the full geometry.
+    TOLERANCES = (0, 0.00002, 0.0001, 0.0005, 0.002)
+
+    type = models.CharField(max_length=6, choices=MellowRoute.Type.choices)
+    tolerance = models.FloatField(db_index=True)
+    the_geom = gis_models.LineStringField()
+
+    @classmethod
+    def tolerance_for_zoom(cls, zoom):
+        """
+        Return the largest tolerance that is less than the size of a pixel at
+        web map zoom level `zoom`, or 0 if `zoom` is None.
+        """
+        if zoom is None:
+            return 0
+        pixel_size = 360 / (256 * 2 ** zoom)
+        return max(tolerance for tolerance in cls.TOLERANCES if tolerance < pixel_size)
+
+    @classmethod
+    def refresh(cls, types=None):
+        """
+        Recompute the simplified geometries for the mellow route types in
+        `types`, or for every type if `types` is None.
+        """
+        if types is not None:
+            types = sorted(set(types))
+            if not types:
+                return
+        type_sql = '' if types is None else 'WHERE type = ANY(%s::varchar[])'
+        type_params = [] if types is None else [types]
+
+        # Merge the ways of each type into lines that are as long as possible
+        # before simplifying them, then store each line as its own row so
+        # that they can be filtered by bounding box
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM mbm_simplifiedroute {type_sql}', type_params)
+            cursor.execute(f"""
+                INSERT INTO mbm_simplifiedroute (type, tolerance, the_geom)
+                SELECT merged.type, tolerances.tolerance, line.geom
+                FROM (
+                    SELECT
+                        routes.type,
+                        ST_LineMerge(ST_Union(chicago_ways.the_geom)) AS geom
+                    FROM chicago_ways
+                    JOIN (
+                        SELECT UNNEST(ways) AS osm_id, type
+                        FROM mbm_mellowroute
+                        {type_sql}
+                    ) AS routes
+                    USING(osm_id)
+                    GROUP BY routes.type
+                ) AS merged
+                CROSS JOIN UNNEST(%s::float8[]) AS tolerances(tolerance)
+                CROSS JOIN LATERAL ST_Dump(ST_Simplify(merged.geom, tolerances.tolerance)) AS line
+                WHERE GeometryType(line.geom) = 'LINESTRING'
+            """, type_params + [list(cls.TOLERANCES)])
+
+
+class VertexComponent(models.Model):
+    """
+    Model storing the connected components of each routing vertex, so that we
+    can tell that two vertices can't reach each other without running a
+    route query. Components are numbered in descending order of size, so
+    component 0 is the main street network. Built by the `build_components`
+    management command.
+    """
+    vertex_id = models.BigIntegerField(primary_key=True)
+    # Component of the directed graph, respecting one-way edges. Every vertex
+    # can reach every other vertex in the same strong component.
+    strong_component = models.IntegerField(db_index=True)
+    # Component of the graph when edge direction is ignored. No vertex can
+    # reach a vertex in a different weak component.
+    weak_component = models.IntegerField()
+
+    MAIN_COMPONENT = 0
+
+    @classmethod
+    def for_vertices(cls, *vertex_ids):
+        """
+        Return a dict mapping each of `vertex_ids` that has a component to a
+        `(strong_component, weak_component)` tuple.
+        """
+        return {
+            vertex_id: (strong, weak)
+            for vertex_id, strong, weak in cls.objects.filter(
+                vertex_id__in=vertex_ids
+            ).values_list('vertex_id', 'strong_component', 'weak_component')
+        }
+
+
+class DataVersion(models.Model):
+    """
+    Model storing a version counter for a set of data that other artifacts
+    are derived from. Processes record the version that an artifact was built
+    from and compare it to the current version to tell if it's stale.
+    """
+    MELLOW = 'mellow'
+    # The routing vertices and their connected components, which the
+    # in-process vertex index is built from
+    VERTICES = 'vertices'
+
+    name = models.CharField(max_length=50, primary_key=True)
+    version = models.BigIntegerField(default=0)
+
+    @classmethod
+    def get(cls, name):
+        """Return the current version for `name`, or 0 if it has never been bumped."""
+        version = cls.objects.filter(name=name).values_list('version', flat=True).first()
+        return version or 0
+
+    @classmethod
+    def bump(cls, name):
+        """Atomically increment the version for `name` and return it."""
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO mbm_dataversion (name, version)
+                VALUES (%s, 1)
+                ON CONFLICT (name)
+                DO UPDATE SET version = mbm_dataversion.version + 1
+                RETURNING version
+            """, [name])
+            return cursor.fetchone()[0]
+
+
+class MellowChange(models.Model):
+    """
+    Model logging each change to the mellow data, so that processes holding
+    artifacts built from an older version can update just the parts that
+    changed instead of rebuilding them. Each change is also announced with a
+    NOTIFY on the `CHANNEL` channel, with its version as the payload.
+    """
+    CHANNEL = 'mbm_mellow_change'
+
+    version = models.BigIntegerField(primary_key=True)
+    # Ways whose mellow type may have changed
+    osm_ids = pg_models.ArrayField(models.BigIntegerField(), default=list)
+    # Bounding box of the changed ways, or NULL if no ways changed
+    min_lng = models.FloatField(null=True)
+    min_lat = models.FloatField(null=True)
+    max_lng = models.FloatField(null=True)
+    max_lat = models.FloatField(null=True)
+    # Whether the street network itself changed, rather than just the mellow
+    # types of its ways, so that graphs built from it have to be reloaded
+    topology_changed = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def record(cls, osm_ids, bounds=None, topology_changed=False):
+        """
+        Bump the mellow data version, log a change to the ways in `osm_ids`
+        under the new version, and return the version. Since NOTIFY is
+        transactional, listeners only hear about the change once the
+        surrounding transaction commits.
+
+        The change covers the current extent of the ways, plus the `(min_lng,
+        min_lat, max_lng, max_lat)` box `bounds` if given, for ways that
+        have moved or been removed.
+        """
+        version = DataVersion.bump(DataVersion.MELLOW)
+        min_lng, min_lat, max_lng, max_lat = bounds or (None, None, None, None)
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO mbm_mellowchange (
+                    version, osm_ids, min_lng, min_lat, max_lng, max_lat,
+                    topology_changed, created_at
+                )
+                SELECT
+                    %s,
+                    %s::bigint[],
+                    ST_XMin(extent),
+                    ST_YMin(extent),
+                    ST_XMax(extent),
+                    ST_YMax(extent),
+                    %s,
+                    NOW()
+                FROM (
+                    SELECT ST_Extent(geom) AS extent
+                    FROM (
+                        SELECT the_geom AS geom
+                        FROM chicago_ways
+                        WHERE osm_id = ANY(%s::bigint[])
+                        UNION ALL
+                        -- NULL when there are no bounds, which ST_Extent skips
+                        SELECT ST_MakeEnvelope(
+                            %s::float8, %s::float8, %s::float8, %s::float8, 4326
+                        )
+                    ) AS geoms
+                ) AS ways
+            """, [
+                version,
+                list(osm_ids),
+                topology_changed,
+                list(osm_ids),
+                min_lng,
+                min_lat,
+                max_lng,
+                max_lat,
+            ])
+            cursor.execute('SELECT pg_notify(%s, %s)', [cls.CHANNEL, str(version)])
+        return version
+
+    @classmethod
+    def since(cls, version, until):
+        """
+        Return the changes after `version` up to and including `until`, in
+        order, or None if any of them are missing from the log.
+        """
+        changes = list(
+            cls.objects.filter(version__gt=version, version__lte=until).order_by('version')
+        )
+        if len(changes) != until - version:
+            return None
+        return changes
+
+    def intersects(self, bounds):
+        """
+        Return whether this change touched the `(min_lng, min_lat, max_lng,
+        max_lat)` box `bounds`.
+        """
+        if self.min_lng is None:
+            return False
+        min_lng, min_lat, max_lng, max_lat = bounds
+        return (
+            self.min_lng <= max_lng and self.max_lng >= min_lng
+            and self.min_lat <= max_lat and self.max_lat >= min_lat
+        )
+
 
 def fetchall(cursor):
     """
@@ -0,0 +1,530 @@
+"""
+Incremental updates to the street network from OSM change files.
+
+The full import runs osm2pgrouting over an extract of Chicago, which rebuilds
+every routing table from scratch and invalidates everything derived from
+them. `apply_osm_changes` instead applies an OSM change file (.osc) to
+`osm_ways`, `chicago_ways` and `chicago_ways_vertices_pgr`, splitting into
+edges only the ways that changed, or that share nodes with ways that changed.
+
+osm2pgrouting only keeps the nodes where ways are split, so splitting a way
+again needs the locations of all of its nodes. `import_osm_nodes` loads them
+into `mbm_osmnode`, along with the node IDs of every way in `mbm_osmwaynodes`,
+from the same extract that osm2pgrouting imports.
+"""
+import math
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+from django.db import connection, transaction
+from psycopg2.extras import execute_values
+
+from mbm.models import DataVersion, MellowChange, MellowRoute, RoutingEdge, SimplifiedRoute
+
+# Table where osm2pgrouting stores the tag classes from its mapconfig, which
+# decide which ways are routable
+CONFIGURATION_TABLE = 'chicago_configuration'
+
+# osm2pgrouting's codes for the `one_way` column of each value of `oneway`
+ONE_WAY_CODES = {'UNKNOWN': 0, 'YES': 1, 'NO': 2, 'REVERSED': -1}
+
+EARTH_RADIUS_M = 6371008.8
+
+# Number of rows to send in each INSERT when loading nodes
+BATCH_SIZE = 10000
+
+# SQL to let bikes ride both ways on one-way streets that allow it, which the
+# full import in the Makefile runs over every edge
+ONEWAY_BICYCLE_SQL = """
+    UPDATE chicago_ways SET one_way = 2, oneway = 'NO', reverse_cost = cost
+    FROM osm_ways
+    WHERE osm_ways.osm_id = chicago_ways.osm_id
+    AND osm_ways.tags @> 'oneway:bicycle => no'
+    AND chicago_ways.gid = ANY(%s::bigint[])
+"""
+
+NodeElement = namedtuple('NodeElement', ['osm_id', 'action', 'location'])
+WayElement = namedtuple('WayElement', ['osm_id', 'action', 'tags', 'nodes'])
+
+
+def parse_osm(source):
+    """
+    Parse the nodes and ways of an OSM XML file or OSM change file, which
+    can be a path or a file object, and yield a `NodeElement` or
+    `WayElement` for each. `action` is 'create', 'modify' or 'delete' for
+    elements of a change file, and None otherwise. Deleted nodes have no
+    `location`. Relations are skipped.
+    """
+    action = None
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag in ('create', 'modify', 'delete'):
+                action = elem.tag
+            continue
+
+        if elem.tag == 'node':
+            location = None
+            if elem.get('lon') is not None and elem.get('lat') is not None:
+                location = (float(elem.get('lon')), float(elem.get('lat')))
+            yield NodeElement(int(elem.get('id')), action, location)
+            elem.clear()
+        elif elem.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+            nodes = [int(nd.get('ref')) for nd in elem.iter('nd')]
+            yield WayElement(int(elem.get('id')), action, tags, nodes)
+            elem.clear()
+        elif elem.tag == 'relation':
+            elem.clear()
+        elif elem.tag in ('create', 'modify', 'delete'):
+            action = None
+
+
+def load_tag_classes(cursor):
+    """
+    Return a dict mapping each `(tag_key, tag_value)` pair in the
+    osm2pgrouting configuration to a dict with its `tag_id`, `priority` and
+    `maxspeed`.
+    """
+    cursor.execute(f"""
+        SELECT tag_key, tag_value, tag_id, priority, maxspeed
+        FROM {CONFIGURATION_TABLE}
+    """)
+    return {
+        (key, value): {'tag_id': tag_id, 'priority': priority, 'maxspeed': maxspeed}
+        for key, value, tag_id, priority, maxspeed in cursor.fetchall()
+    }
+
+
+def classify_way(tags, tag_classes):
+    """
+    Return the `(tag_key, tag_value)` pair that decides how a way with
+    `tags` is routed, or None if the way isn't routable. When more than one
+    of its tags is in `tag_classes`, the last one wins.
+    """
+    match = None
+    for key, value in tags.items():
+        if (key, value) in tag_classes:
+            match = (key, value)
+    return match
+
+
+def one_way_type(tags):
+    """Return the osm2pgrouting `oneway` value for a way with `tags`."""
+    oneway = tags.get('oneway', '').lower()
+    if oneway in ('yes', 'true', '1'):
+        return 'YES'
+    if oneway in ('-1', 'reverse'):
+        return 'REVERSED'
+    if oneway in ('no', 'false', '0'):
+        return 'NO'
+    if tags.get('junction') == 'roundabout':
+        return 'YES'
+    return 'UNKNOWN'
+
+
+def split_way(nodes, use_counts):
+    """
+    Return a list of `(start, end)` indexes into `nodes` of the edges that a
+    way is split into: at its ends, and at every node that `use_counts` says
+    is used more than once across all ways, like osm2pgrouting does.
+    Segments that don't go anywhere are dropped.
+    """
+    last = len(nodes) - 1
+    splits = [
+        idx for idx, node in enumerate(nodes)
+        if idx == 0 or idx == last or use_counts.get(node, 0) > 1
+    ]
+    return [
+        (start, end)
+        for start, end in zip(splits, splits[1:])
+        if len(set(nodes[start:end + 1])) > 1
+    ]
+
+
+def line_lengths(coords):
+    """
+    Return a tuple `(length, length_m)` with the length of the line through
+    the `(lng, lat)` pairs `coords` in degrees, like ST_Length in EPSG 4326,
+    and in meters along the earth's surface.
+    """
+    length = length_m = 0
+    for (lng1, lat1), (lng2, lat2) in zip(coords, coords[1:]):
+        length += math.hypot(lng2 - lng1, lat2 - lat1)
+        phi1, phi2 = math.radians(lat1), math.radians(lat2)
+        a = (
+            math.sin((phi2 - phi1) / 2) ** 2
+            + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+        )
+        length_m += 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+    return length, length_m
+
+
+def edge_row(way_id, nodes, coords, tags, tag_class):
+    """
+    Return a dict with the `chicago_ways` columns of an edge of way
+    `way_id` along `nodes`, located at `coords`. Edges that can't be
+    traversed in a direction get a negative cost in that direction.
+    """
+    length, length_m = line_lengths(coords)
+    oneway = one_way_type(tags)
+    maxspeed = tag_class['maxspeed'] or 50
+    cost = reverse_cost = length
+    cost_s = reverse_cost_s = length_m / maxspeed * 3.6
+    if oneway == 'YES':
+        reverse_cost, reverse_cost_s = -reverse_cost, -reverse_cost_s
+    elif oneway == 'REVERSED':
+        cost, cost_s = -cost, -cost_s
+
+    return {
+        'osm_id': way_id,
+        'tag_id': tag_class['tag_id'],
+        'length': length,
+        'length_m': length_m,
+        'name': tags.get('name'),
+        'source_osm': nodes[0],
+        'target_osm': nodes[-1],
+        'cost': cost,
+        'reverse_cost': reverse_cost,
+        'cost_s': cost_s,
+        'reverse_cost_s': reverse_cost_s,
+        'one_way': ONE_WAY_CODES[oneway],
+        'oneway': oneway,
+        'x1': coords[0][0],
+        'y1': coords[0][1],
+        'x2': coords[-1][0],
+        'y2': coords[-1][1],
+        'maxspeed_forward': maxspeed,
+        'maxspeed_backward': maxspeed,
+        'priority': tag_class['priority'],
+        'the_geom': 'LINESTRING(%s)' % ', '.join(f'{lng} {lat}' for lng, lat in coords),
+    }
+
+
+def import_osm_nodes(path):
+    """
+    Replace the contents of `mbm_osmnode` and `mbm_osmwaynodes` with the
+    routable ways in the OSM XML file at `path` and the locations of their
+    nodes, and return a tuple `(num_ways, num_nodes)`.
+    """
+    with connection.cursor() as cursor:
+        tag_classes = load_tag_classes(cursor)
+
+    # Read the file twice, since nodes come before the ways that use them
+    way_nodes = {
+        element.osm_id: element.nodes
+        for element in parse_osm(path)
+        if isinstance(element, WayElement) and classify_way(element.tags, tag_classes)
+    }
+    needed = {node for nodes in way_nodes.values() for node in nodes}
+    locations = [
+        (element.osm_id, *element.location)
+        for element in parse_osm(path)
+        if isinstance(element, NodeElement) and element.osm_id in needed and element.location
+    ]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('TRUNCATE mbm_osmnode, mbm_osmwaynodes')
+        execute_values(
+            cursor,
+            'INSERT INTO mbm_osmnode (osm_id, lng, lat) VALUES %s',
+            locations,
+            page_size=BATCH_SIZE
+        )
+        execute_values(
+            cursor,
+            'INSERT INTO mbm_osmwaynodes (osm_id, nodes) VALUES %s',
+            list(way_nodes.items()),
+            page_size=BATCH_SIZE
+        )
+    return len(way_nodes), len(locations)
+
+
+def apply_osm_changes(source):
+    """
+    Apply the OSM change file `source`, which can be a path or a file
+    object, to the street network, and return a report of what changed:
+
+    - `ways`: the IDs of the ways in the change file (`changed`), of every
+      way whose edges were rebuilt (`affected`), and of ways that couldn't
+      be rebuilt because some of their nodes have no known location
+      (`skipped`)
+    - `edges`: the gids of the edges that were `removed` and `added`
+    - `vertices`: the IDs of the vertices that were `added`, `removed` or
+      `moved`
+    - `version`: the mellow data version that the change was logged under
+
+    Everything derived from the affected ways is refreshed in the same
+    transaction, and the change is logged so that caches can update just
+    the affected area. Graphs and the vertex index are reloaded, since the
+    network itself changed.
+    """
+    nodes, ways = {}, {}
+    for element in parse_osm(source):
+        if isinstance(element, NodeElement):
+            nodes[element.osm_id] = None if element.action == 'delete' else element.location
+        else:
+            ways[element.osm_id] = element
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        tag_classes = load_tag_classes(cursor)
+        routable = {
+            osm_id: way for osm_id, way in ways.items()
+            if way.action != 'delete' and classify_way(way.tags, tag_classes)
+        }
+        changed_ids = list(ways)
+
+        cursor.execute("""
+            SELECT nodes FROM mbm_osmwaynodes WHERE osm_id = ANY(%s::bigint[])
+        """, [changed_ids])
+        old_way_nodes = {node for (way_nodes,) in cursor.fetchall() for node in way_nodes}
+        new_way_nodes = {node for way in routable.values() for node in way.nodes}
+
+        moved_nodes = _update_nodes(cursor, nodes, new_way_nodes)
+
+        cursor.execute('DELETE FROM mbm_osmwaynodes WHERE osm_id = ANY(%s::bigint[])', [changed_ids])
+        execute_values(
+            cursor,
+            'INSERT INTO mbm_osmwaynodes (osm_id, nodes) VALUES %s',
+            [(osm_id, way.nodes) for osm_id, way in routable.items()]
+        )
+
+        # Rebuild every way that changed, and every way that shares a node
+        # with them or has a node that moved, since where they're split may
+        # have changed too
+        cursor.execute("""
+            SELECT osm_id FROM mbm_osmwaynodes WHERE nodes && %s::bigint[]
+        """, [list(old_way_nodes | new_way_nodes | moved_nodes)])
+        affected_ids = set(changed_ids) | {row[0] for row in cursor.fetchall()}
+
+        cursor.execute("""
+            SELECT osm_id, nodes FROM mbm_osmwaynodes WHERE osm_id = ANY(%s::bigint[])
+        """, [list(affected_ids)])
+        affected_ways = dict(cursor.fetchall())
+        locations = _load_locations(cursor, affected_ways)
+        _update_osm_ways(cursor, changed_ids, routable, tag_classes, locations)
+        affected_tags = _load_tags(cursor, affected_ways)
+
+        # Remove the old edges of every affected way, remembering where they
+        # were so that caches covering that area are invalidated too
+        cursor.execute("""
+            SELECT ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), ST_YMax(extent)
+            FROM (
+                SELECT ST_Extent(the_geom) AS extent
+                FROM chicago_ways
+                WHERE osm_id = ANY(%s::bigint[])
+            ) AS ways
+        """, [list(affected_ids)])
+        old_bounds = cursor.fetchone()
+        cursor.execute("""
+            DELETE FROM chicago_ways
+            WHERE osm_id = ANY(%s::bigint[])
+            RETURNING gid, source, target
+        """, [list(affected_ids)])
+        removed = cursor.fetchall()
+        removed_gids = [gid for gid, _, _ in removed]
+        old_vertex_ids = {vertex_id for _, source, target in removed for vertex_id in (source, target)}
+
+        added_gids, added_vertex_ids, moved_vertex_ids, skipped = _insert_edges(
+            cursor, affected_ways, affected_tags, locations, tag_classes, moved_nodes
+        )
+        cursor.execute(ONEWAY_BICYCLE_SQL, [added_gids])
+
+        cursor.execute("""
+            DELETE FROM chicago_ways_vertices_pgr AS vert
+            WHERE vert.id = ANY(%s::bigint[])
+            AND NOT EXISTS (SELECT 1 FROM chicago_ways WHERE source = vert.id)
+            AND NOT EXISTS (SELECT 1 FROM chicago_ways WHERE target = vert.id)
+            RETURNING vert.id
+        """, [list(old_vertex_ids)])
+        removed_vertex_ids = [row[0] for row in cursor.fetchall()]
+
+        RoutingEdge.refresh(sorted(affected_ids))
+        SimplifiedRoute.refresh(
+            MellowRoute.objects
+            .filter(ways__overlap=list(affected_ids))
+            .values_list('type', flat=True)
+        )
+        version = MellowChange.record(
+            sorted(affected_ids),
+            bounds=old_bounds if old_bounds[0] is not None else None,
+            topology_changed=True
+        )
+        # Vertices were added, removed or moved, so have app processes
+        # reload their vertex indexes
+        DataVersion.bump(DataVersion.VERTICES)
+
+    return {
+        'ways': {
+            'changed': sorted(changed_ids),
+            'affected': sorted(affected_ids),
+            'skipped': sorted(skipped),
+        },
+        'edges': {
+            'removed': sorted(removed_gids),
+            'added': sorted(added_gids),
+        },
+        'vertices': {
+            'added': sorted(added_vertex_ids),
+            'removed': sorted(removed_vertex_ids),
+            'moved': sorted(moved_vertex_ids),
+        },
+        'version': version,
+    }
+
+
+def _update_nodes(cursor, nodes, new_way_nodes):
+    """
+    Store the locations of the nodes in the change file that we already
+    know about or that routable ways now use, drop deleted nodes, and
+    return the IDs of known nodes that moved.
+    """
+    cursor.execute("""
+        SELECT osm_id FROM mbm_osmnode WHERE osm_id = ANY(%s::bigint[])
+    """, [list(nodes)])
+    known = {row[0] for row in cursor.fetchall()}
+    moved = {osm_id for osm_id in known if nodes[osm_id] is not None}
+
+    locations = [
+        (osm_id, *nodes[osm_id])
+        for osm_id in moved | (new_way_nodes & set(nodes))
+        if nodes[osm_id] is not None
+    ]
+    execute_values(cursor, """
+        INSERT INTO mbm_osmnode (osm_id, lng, lat) VALUES %s
+        ON CONFLICT (osm_id) DO UPDATE SET lng = EXCLUDED.lng, lat = EXCLUDED.lat
+    """, locations)
+    cursor.execute("""
+        DELETE FROM mbm_osmnode WHERE osm_id = ANY(%s::bigint[])
+    """, [[osm_id for osm_id in known if nodes[osm_id] is None]])
+    return moved
+
+
+def _load_locations(cursor, way_nodes):
+    """Return a dict mapping every node of `way_nodes` to its location."""
+    cursor.execute("""
+        SELECT osm_id, lng, lat FROM mbm_osmnode WHERE osm_id = ANY(%s::bigint[])
+    """, [list({node for nodes in way_nodes.values() for node in nodes})])
+    return {osm_id: (lng, lat) for osm_id, lng, lat in cursor.fetchall()}
+
+
+def _update_osm_ways(cursor, changed_ids, routable, tag_classes, locations):
+    """Replace the `osm_ways` rows of the ways in the change file."""
+    cursor.execute('DELETE FROM osm_ways WHERE osm_id = ANY(%s::bigint[])', [changed_ids])
+    for osm_id, way in routable.items():
+        coords = [locations[node] for node in way.nodes if node in locations]
+        tag_name, tag_value = classify_way(way.tags, tag_classes)
+        cursor.execute("""
+            INSERT INTO osm_ways (osm_id, tags, tag_name, tag_value, name, the_geom)
+            VALUES (
+                %s,
+                hstore(%s::text[], %s::text[]),
+                %s,
+                %s,
+                %s,
+                ST_GeomFromText(%s, 4326)
+            )
+        """, [
+            osm_id,
+            list(way.tags.keys()),
+            list(way.tags.values()),
+            tag_name,
+            tag_value,
+            way.tags.get('name'),
+            'LINESTRING(%s)' % ', '.join(f'{lng} {lat}' for lng, lat in coords)
+            if len(coords) > 1 else None,
+        ])
+
+
+def _load_tags(cursor, way_nodes):
+    """Return a dict mapping each way in `way_nodes` to its tags."""
+    cursor.execute("""
+        SELECT osm_id, akeys(tags), avals(tags)
+        FROM osm_ways
+        WHERE osm_id = ANY(%s::bigint[])
+    """, [list(way_nodes)])
+    return {osm_id: dict(zip(keys, values)) for osm_id, keys, values in cursor.fetchall()}
+
+
+def _insert_edges(cursor, way_nodes, way_tags, locations, tag_classes, moved_nodes):
+    """
+    Split each way in `way_nodes` into edges and insert them along with any
+    new vertices, moving the vertices of nodes in `moved_nodes`. Return a
+    tuple `(added_gids, added_vertex_ids, moved_vertex_ids, skipped_ways)`.
+    """
+    cursor.execute("""
+        SELECT node, COUNT(*)
+        FROM (
+            SELECT UNNEST(nodes) AS node
+            FROM mbm_osmwaynodes
+            WHERE nodes && %s::bigint[]
+        ) AS uses
+        WHERE node = ANY(%s::bigint[])
+        GROUP BY node
+    """, [list(locations), list(locations)])
+    use_counts = dict(cursor.fetchall())
+
+    cursor.execute("""
+        UPDATE chicago_ways_vertices_pgr AS vert
+        SET lon = node.lng, lat = node.lat, the_geom = ST_SetSRID(ST_MakePoint(node.lng, node.lat), 4326)
+        FROM mbm_osmnode AS node
+        WHERE vert.osm_id = node.osm_id
+        AND node.osm_id = ANY(%s::bigint[])
+        RETURNING vert.id
+    """, [list(moved_nodes)])
+    moved_vertex_ids = [row[0] for row in cursor.fetchall()]
+
+    cursor.execute("""
+        SELECT osm_id, id FROM chicago_ways_vertices_pgr WHERE osm_id = ANY(%s::bigint[])
+    """, [list(locations)])
+    vertex_ids = dict(cursor.fetchall())
+
+    added_gids, added_vertex_ids, skipped = [], [], []
+    for way_id, nodes in way_nodes.items():
+        tags = way_tags.get(way_id)
+        tag_key = classify_way(tags, tag_classes) if tags is not None else None
+        if tag_key is None or any(node not in locations for node in nodes):
+            skipped.append(way_id)
+            continue
+
+        for start, end in split_way(nodes, use_counts):
+            edge_nodes = nodes[start:end + 1]
+            for node in (edge_nodes[0], edge_nodes[-1]):
+                if node not in vertex_ids:
+                    lng, lat = locations[node]
+                    cursor.execute("""
+                        INSERT INTO chicago_ways_vertices_pgr (osm_id, lon, lat, the_geom)
+                        VALUES (%s, %s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326))
+                        RETURNING id
+                    """, [node, lng, lat, lng, lat])
+                    vertex_ids[node] = cursor.fetchone()[0]
+                    added_vertex_ids.append(vertex_ids[node])
+
+            row = edge_row(
+                way_id,
+                edge_nodes,
+                [locations[node] for node in edge_nodes],
+                tags,
+                tag_classes[tag_key]
+            )
+            row['source'] = vertex_ids[edge_nodes[0]]
+            row['target'] = vertex_ids[edge_nodes[-1]]
+            cursor.execute("""
+                INSERT INTO chicago_ways (
+                    osm_id, tag_id, length, length_m, name, source, target,
+                    source_osm, target_osm, cost, reverse_cost, cost_s,
+                    reverse_cost_s, one_way, oneway, x1, y1, x2, y2,
+                    maxspeed_forward, maxspeed_backward, priority, the_geom
+                )
+                VALUES (
+                    %(osm_id)s, %(tag_id)s, %(length)s, %(length_m)s, %(name)s,
+                    %(source)s, %(target)s, %(source_osm)s, %(target_osm)s,
+                    %(cost)s, %(reverse_cost)s, %(cost_s)s, %(reverse_cost_s)s,
+                    %(one_way)s, %(oneway)s, %(x1)s, %(y1)s, %(x2)s, %(y2)s,
+                    %(maxspeed_forward)s, %(maxspeed_backward)s, %(priority)s,
+                    ST_GeomFromText(%(the_geom)s, 4326)
+                )
+                RETURNING gid
+            """, row)
+            added_gids.append(cursor.fetchone()[0])
+
+    return added_gids, added_vertex_ids, moved_vertex_ids, skipped
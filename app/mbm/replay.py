@@ -0,0 +1,178 @@
+"""
+Replay a corpus of route requests, either in-process or against a running
+server, to reproduce production load locally.
+
+A corpus is a JSONL file with one route request per line, like:
+
+    {"source": "41.91,-87.65", "target": [41.88, -87.62], "compact": true}
+
+Coordinates can be `lat,lng` strings, like the app sends, or `[lat, lng]`
+pairs, and any other keys are passed along as request arguments. Run it with
+the `replay_routes` management command.
+"""
+import collections
+import json
+import multiprocessing
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.db import connections
+from django.test import RequestFactory
+
+from mbm.benchmark import search_outcome, summarize
+
+ROUTE_PATH = '/api/route/'
+
+
+def load_corpus(lines):
+    """
+    Parse route requests from an iterable of JSONL lines, and return a list
+    of dicts of request arguments. Blank lines are skipped.
+    """
+    requests = []
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            params = {key: _format_param(value) for key, value in entry.items()}
+            params['source'], params['target']
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise ValueError(
+                f'Line {number} must be a JSON object with source and target coordinates'
+            )
+        requests.append(params)
+    return requests
+
+
+def _format_param(value):
+    if isinstance(value, list):
+        return ','.join(str(part) for part in value)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def in_process_router():
+    """Return a function that sends route requests straight to the `Route`
+    view, and returns the status code and body of the response."""
+    from mbm.views import Route
+
+    factory = RequestFactory()
+    view = Route.as_view()
+
+    def route(params):
+        response = view(factory.get(ROUTE_PATH, params))
+        if hasattr(response, 'render'):
+            response.render()
+        return response.status_code, response.content
+
+    return route
+
+
+def http_router(base_url, timeout=30):
+    """Return a function that sends route requests to the server at
+    `base_url`, and returns the status code and body of the response."""
+    url = base_url.rstrip('/') + ROUTE_PATH
+
+    def route(params):
+        try:
+            with urllib.request.urlopen(f'{url}?{urllib.parse.urlencode(params)}', timeout=timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    return route
+
+
+def get_router(base_url=None, timeout=30):
+    if base_url:
+        return http_router(base_url, timeout=timeout)
+    return in_process_router()
+
+
+def send(route, params):
+    """
+    Send a single route request and return a tuple `(latency, error,
+    outcome)`, where `error` describes why the request failed, if it did,
+    and `outcome` is how its route was found, from `search_outcome()`.
+    """
+    start = time.perf_counter()
+    try:
+        status, body = route(params)
+    except Exception as e:
+        return time.perf_counter() - start, type(e).__name__, None
+    latency = time.perf_counter() - start
+
+    if status != 200:
+        return latency, f'http_{status}', None
+    try:
+        properties = json.loads(body)['route']['properties']
+    except (ValueError, KeyError, TypeError):
+        return latency, 'invalid_response', None
+    return latency, None, search_outcome(properties)
+
+
+def replay_chunk(base_url, timeout, requests):
+    """Send `requests` one after another, from a single worker thread or
+    process, and return a list of the results of `send`."""
+    route = get_router(base_url, timeout=timeout)
+    try:
+        return [send(route, params) for params in requests]
+    finally:
+        # Worker threads and processes each open their own connections
+        if not base_url:
+            connections.close_all()
+
+
+def replay(requests, base_url=None, concurrency=1, processes=False, timeout=30):
+    """
+    Replay `requests` with `concurrency` workers, which are threads, or
+    processes if `processes` is True, and return a report of the results.
+
+    Requests are dealt out to the workers round-robin. With `base_url`, the
+    requests are sent over HTTP, and otherwise to the `Route` view in this
+    process, sharing its caches with the other workers.
+    """
+    chunks = [requests[idx::concurrency] for idx in range(concurrency)]
+    chunks = [chunk for chunk in chunks if chunk]
+
+    if processes:
+        if not base_url:
+            # Forked workers must not share the parent's connections
+            connections.close_all()
+        executor = ProcessPoolExecutor(len(chunks), mp_context=multiprocessing.get_context('fork'))
+    else:
+        executor = ThreadPoolExecutor(len(chunks))
+
+    start = time.perf_counter()
+    with executor:
+        results = [
+            result
+            for chunk_results in executor.map(
+                replay_chunk,
+                [base_url] * len(chunks),
+                [timeout] * len(chunks),
+                chunks,
+            )
+            for result in chunk_results
+        ]
+    return report(results, time.perf_counter() - start)
+
+
+def report(results, duration):
+    """Summarize a list of the results of `send`, from requests that took
+    `duration` seconds in total to replay."""
+    errors = collections.Counter(error for _, error, _ in results if error)
+    outcomes = collections.Counter(outcome for _, _, outcome in results if outcome)
+    return {
+        'requests': len(results),
+        'errors': dict(sorted(errors.items())),
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(results) / duration, 2) if duration else None,
+        'latency': summarize([latency for latency, error, _ in results if not error]),
+        'search': dict(sorted(outcomes.items())),
+    }
@@ -101,14 +101,86 @@ DATABASES['default'] = dj_database_url.parse(
 # Caching
 # https://docs.djangoproject.com/en/3.0/topics/cache/
 
+# The default cache keeps up to LOCAL_CACHE_MAX_ENTRIES values, taking up at
+# most LOCAL_CACHE_MAX_MB when pickled, in memory in each process for up to
+# LOCAL_CACHE_TIMEOUT seconds, in front of the shared site_cache table. Set
+# LOCAL_CACHE_MAX_ENTRIES to 0 to always read from the shared cache. Nothing
+# is cached in debug mode unless LOCAL_CACHE_MAX_ENTRIES is set.
 cache_backend = 'dummy.DummyCache' if DEBUG is True else 'db.DatabaseCache'
 CACHES = {
     'default': {
+        'BACKEND': 'mbm.tiered_cache.TieredCache',
+        'LOCATION': 'shared',
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('LOCAL_CACHE_MAX_ENTRIES', 0 if DEBUG is True else 256)),
+            'MAX_BYTES': int(os.getenv('LOCAL_CACHE_MAX_MB', 64)) * 1024 * 1024,
+            'LOCAL_TIMEOUT': int(os.getenv('LOCAL_CACHE_TIMEOUT', 60)),
+        },
+    },
+    'shared': {
         'BACKEND': f'django.core.cache.backends.{cache_backend}',
         'LOCATION': 'site_cache',
-    }
+    },
 }
 
+# Routing
+# Set the ROUTING_BACKEND environment variable to 'memory' to search routes
+# with an in-process copy of the routing graph instead of pgr_dijkstra. Each
+# process loads the graph on its first route request. Set it to 'ch' to query
+# the contraction hierarchy built by the build_contraction_hierarchy command,
+# falling back to pgr_dijkstra while the hierarchy is missing or stale.
+ROUTING_BACKEND = os.getenv('ROUTING_BACKEND', 'pgrouting')
+ROUTING_CH_PATH = os.getenv(
+    'ROUTING_CH_PATH',
+    os.path.join(BASE_DIR, 'data', 'contraction_hierarchy.npz')
+)
+
+# When a graph snapshot built by the build_graph_snapshot command is current,
+# the 'memory' backend maps it from ROUTING_SNAPSHOT_DIR rather than loading
+# the graph from the database, so that processes share one copy of the graph.
+ROUTING_SNAPSHOT_DIR = os.getenv(
+    'ROUTING_SNAPSHOT_DIR',
+    os.path.join(BASE_DIR, 'data', 'graph_snapshot')
+)
+
+# Set SNAPPING_BACKEND to 'memory' to snap coordinates to the nearest vertex
+# with an in-process spatial index instead of a KNN query. Each process loads
+# the index on its first lookup.
+SNAPPING_BACKEND = os.getenv('SNAPPING_BACKEND', 'database')
+
+# Maximum number of /api/route/ results that each process keeps in memory.
+# Set ROUTE_CACHE_SIZE to 0 to disable the route cache.
+ROUTE_CACHE_SIZE = int(os.getenv('ROUTE_CACHE_SIZE', 1024))
+
+# Maximum number of /api/isochrone/ results that each process keeps in memory.
+# Set ISOCHRONE_CACHE_SIZE to 0 to disable the isochrone cache.
+ISOCHRONE_CACHE_SIZE = int(os.getenv('ISOCHRONE_CACHE_SIZE', 64))
+
+# Set COALESCE_ROUTES_ACROSS_WORKERS to 'True' to have concurrent requests for
+# the same route in different processes wait on a Postgres advisory lock for
+# the first one to find it, and share its result through the shared cache.
+# Requests within a process are always coalesced.
+COALESCE_ROUTES_ACROSS_WORKERS = os.getenv('COALESCE_ROUTES_ACROSS_WORKERS', 'False') == 'True'
+
+# Set MELLOW_CHANGE_LISTENER to 'True' to have each app process listen for
+# changes to the mellow data and apply them to its caches as soon as they're
+# committed, instead of on the next request that needs them.
+MELLOW_CHANGE_LISTENER = os.getenv('MELLOW_CHANGE_LISTENER', 'False') == 'True'
+
+# Set PREPARED_ROUTING_QUERIES to 'True' to run the snapping and route queries
+# of /api/route/ as server-side prepared statements, over a pool of up to
+# ROUTING_DB_POOL_SIZE connections per process that keeps them prepared.
+PREPARED_ROUTING_QUERIES = os.getenv('PREPARED_ROUTING_QUERIES', 'False') == 'True'
+ROUTING_DB_POOL_SIZE = int(os.getenv('ROUTING_DB_POOL_SIZE', 4))
+
+# Maximum number of database connections that each event loop opens for the
+# async route API under ASGI. Requests beyond that wait for a free connection.
+ASYNC_DB_POOL_SIZE = int(os.getenv('ASYNC_DB_POOL_SIZE', 10))
+
+# /metrics/ is only served to staff users, and to scrapers that send
+# METRICS_TOKEN as a bearer token in the Authorization header, if it's set.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
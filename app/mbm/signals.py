@@ -0,0 +1,96 @@
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from mbm.models import MellowChange, MellowRoute, RoutingEdge, SimplifiedRoute
+
+# Ways and route types changed in the current `batched_refresh()` block of
+# each thread, which are refreshed together at the end of the block
+_pending = threading.local()
+
+
+@contextmanager
+def batched_refresh():
+    """
+    Run a block in a transaction, and refresh the data derived from the
+    MellowRoutes that it saves or deletes once, at the end of the block and
+    inside the same transaction. Saving a neighborhood's three routes in one
+    block then refreshes them and bumps the mellow data version once, rather
+    than once per route. Nested blocks are refreshed with the outermost one,
+    and if the block raises, the transaction rolls back without refreshing.
+    """
+    with transaction.atomic():
+        if getattr(_pending, 'changes', None) is not None:
+            yield
+            return
+
+        _pending.changes = (set(), set())
+        try:
+            yield
+            ways, types = _pending.changes
+        finally:
+            _pending.changes = None
+        if ways or types:
+            refresh(ways, types)
+
+
+def schedule_refresh(ways, types):
+    """
+    Refresh the data derived from `ways` and mellow route `types` at the end
+    of the current `batched_refresh()` block, or straight away outside of one.
+    """
+    changes = getattr(_pending, 'changes', None)
+    if changes is None:
+        refresh(ways, types)
+    else:
+        changes[0].update(ways)
+        changes[1].update(types)
+
+
+def refresh(ways, types):
+    """
+    Refresh the routing edges and simplified routes derived from `ways` and
+    mellow route `types`, and log the change, in the current transaction.
+    """
+    with transaction.atomic():
+        RoutingEdge.refresh(sorted(ways))
+        SimplifiedRoute.refresh(types)
+        MellowChange.record(sorted(ways))
+
+
+@receiver(pre_save, sender=MellowRoute)
+def remember_previous_ways(sender, instance, raw=False, **kwargs):
+    """
+    Record the ways and type that a MellowRoute had before it was saved, so
+    that we can refresh the routing edges for ways that were removed from it
+    and the simplified routes of the type it was moved out of.
+    """
+    previous = None
+    if instance.pk is not None and not raw:
+        previous = (
+            MellowRoute.objects
+            .filter(pk=instance.pk)
+            .values_list('ways', 'type')
+            .first()
+        )
+    instance._previous_ways, instance._previous_type = previous or ([], None)
+
+
+@receiver(post_save, sender=MellowRoute)
+def mellow_route_saved(sender, instance, raw=False, **kwargs):
+    # Fixtures are loaded before the street network is imported, so leave
+    # derived tables to the import commands
+    if raw:
+        return
+    previous_ways = getattr(instance, '_previous_ways', [])
+    previous_type = getattr(instance, '_previous_type', None)
+    types = {instance.type} | ({previous_type} if previous_type else set())
+    schedule_refresh(set(previous_ways) | set(instance.ways), types)
+
+
+@receiver(post_delete, sender=MellowRoute)
+def mellow_route_deleted(sender, instance, **kwargs):
+    schedule_refresh(instance.ways, {instance.type})
@@ -0,0 +1,232 @@
+"""
+In-process nearest-vertex snapping.
+
+Snapping a coordinate to the street network with a KNN query means a database
+round trip and an expensive join for what is essentially a tree lookup. The
+`VertexIndex` loads the coordinates of every routable, non-sidewalk vertex
+once per process into a uniform grid and answers lookups in memory.
+"""
+import threading
+
+import numpy as np
+from django.db import connection
+
+from mbm.costs import SIDEWALK_TAG_IDS
+from mbm.models import DataVersion
+
+# Size of each grid cell in degrees, about 500m in Chicago
+DEFAULT_CELL_SIZE = 0.005
+
+# Component label for vertices whose component is unknown
+NO_COMPONENT = -1
+
+
+class VertexIndex:
+    """
+    A uniform grid over vertex coordinates.
+
+    Distances are measured in degrees on the lng/lat plane, which is the same
+    metric that PostGIS uses for the `<->` operator on EPSG 4326 geometries,
+    so lookups return the same vertex as the KNN query.
+    """
+    def __init__(self, vertex_ids, lngs, lats, components=None, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        lngs = np.asarray(lngs, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        if components is None:
+            components = np.full(len(lngs), NO_COMPONENT)
+
+        self.min_lng = lngs.min() if len(lngs) else 0.0
+        self.min_lat = lats.min() if len(lats) else 0.0
+        cols = self._col(lngs)
+        rows = self._row(lats)
+        self.num_cols = int(cols.max()) + 1 if len(cols) else 0
+        self.num_rows = int(rows.max()) + 1 if len(rows) else 0
+
+        # Sort vertices by cell, so that each cell is a contiguous range
+        keys = cols * max(self.num_rows, 1) + rows
+        order = np.argsort(keys, kind='stable')
+        self.vertex_ids = np.asarray(vertex_ids, dtype=np.int64)[order]
+        self.lngs = lngs[order]
+        self.lats = lats[order]
+        self.components = np.asarray(components, dtype=np.int64)[order]
+        self.cell_keys, self.cell_starts = np.unique(keys[order], return_index=True)
+        self.cell_ends = np.append(self.cell_starts[1:], len(order))
+
+    def __len__(self):
+        return len(self.vertex_ids)
+
+    def _col(self, lngs):
+        return np.floor((lngs - self.min_lng) / self.cell_size).astype(np.int64)
+
+    def _row(self, lats):
+        return np.floor((lats - self.min_lat) / self.cell_size).astype(np.int64)
+
+    def _cells(self, lngs, lats):
+        """Return the columns and rows of the cells to start searching from
+        for points at `lngs` and `lats`. Points outside the grid start from
+        the nearest cell on its edge, since no vertex can be closer to them
+        than to their projection onto the grid."""
+        cols = np.clip(self._col(lngs), 0, max(self.num_cols - 1, 0))
+        rows = np.clip(self._row(lats), 0, max(self.num_rows - 1, 0))
+        return cols, rows
+
+    @staticmethod
+    def _ring_offsets(radius):
+        """Return the column and row offsets of the cells that are exactly
+        `radius` cells away from a cell."""
+        if radius == 0:
+            return np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64)
+        offsets = np.arange(-radius, radius + 1)
+        edge = np.full(len(offsets), radius)
+        cols = np.concatenate([offsets, offsets, -edge[1:-1], edge[1:-1]])
+        rows = np.concatenate([-edge, edge, offsets[1:-1], offsets[1:-1]])
+        return cols, rows
+
+    def _ring_candidates(self, points, cols, rows, radius):
+        """
+        Return a tuple `(points, positions)` of parallel arrays pairing each
+        of `points` with the positions of the vertices in the cells that are
+        exactly `radius` cells away from its cell at `cols` and `rows`.
+        """
+        col_offsets, row_offsets = self._ring_offsets(radius)
+        points = np.repeat(points, len(col_offsets))
+        ring_cols = cols[points] + np.tile(col_offsets, len(points) // len(col_offsets))
+        ring_rows = rows[points] + np.tile(row_offsets, len(points) // len(row_offsets))
+        valid = (
+            (ring_cols >= 0) & (ring_cols < self.num_cols)
+            & (ring_rows >= 0) & (ring_rows < self.num_rows)
+        )
+        points = points[valid]
+        keys = ring_cols[valid] * self.num_rows + ring_rows[valid]
+
+        cells = np.searchsorted(self.cell_keys, keys)
+        occupied = cells < len(self.cell_keys)
+        occupied[occupied] = self.cell_keys[cells[occupied]] == keys[occupied]
+        points, cells = points[occupied], cells[occupied]
+
+        # Expand each cell into the contiguous range of its vertices
+        counts = self.cell_ends[cells] - self.cell_starts[cells]
+        firsts = np.repeat(np.cumsum(counts) - counts, counts)
+        positions = np.repeat(self.cell_starts[cells], counts) + np.arange(counts.sum()) - firsts
+        return np.repeat(points, counts), positions
+
+    def nearest(self, lng, lat, strong_component=None):
+        """
+        Return the ID of the vertex nearest to `(lng, lat)`, optionally
+        restricted to vertices in the strong component `strong_component`.
+        Returns None if the index has no matching vertices.
+        """
+        return self.nearest_many([lng], [lat], strong_component=strong_component)[0]
+
+    def nearest_many(self, lngs, lats, strong_component=None):
+        """
+        Return a list with the ID of the nearest vertex to each of the points
+        described by the parallel sequences `lngs` and `lats`, or None for
+        points with no matching vertex.
+
+        All points are searched together, one ring of cells at a time, and
+        drop out of the search once no vertex beyond the current ring can be
+        closer than the nearest one found so far.
+        """
+        lngs = np.asarray(lngs, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        if not len(self):
+            return [None] * len(lngs)
+        cols, rows = self._cells(lngs, lats)
+        best_positions = np.full(len(lngs), -1, dtype=np.int64)
+        best_dists = np.full(len(lngs), np.inf)
+
+        # Every cell is within this many cells of any starting cell, since
+        # they're all inside the grid
+        max_radius = max(self.num_cols, self.num_rows) - 1
+        active = np.arange(len(lngs))
+        radius = 0
+        while len(active) and radius <= max_radius:
+            points, candidates = self._ring_candidates(active, cols, rows, radius)
+            if strong_component is not None:
+                matching = self.components[candidates] == strong_component
+                points, candidates = points[matching], candidates[matching]
+            dists = np.hypot(self.lngs[candidates] - lngs[points], self.lats[candidates] - lats[points])
+
+            # Keep the closest candidate for each point
+            order = np.lexsort((dists, points))
+            points, candidates, dists = points[order], candidates[order], dists[order]
+            closest = np.ones(len(points), dtype=bool)
+            closest[1:] = points[1:] != points[:-1]
+            points, candidates, dists = points[closest], candidates[closest], dists[closest]
+            better = dists < best_dists[points]
+            best_dists[points[better]] = dists[better]
+            best_positions[points[better]] = candidates[better]
+
+            # Every vertex beyond this ring is at least `radius` cells away
+            active = active[best_dists[active] > radius * self.cell_size]
+            radius += 1
+
+        return [
+            int(self.vertex_ids[position]) if position >= 0 else None
+            for position in best_positions
+        ]
+
+
+def load_vertex_index():
+    """
+    Load the coordinates and components of every vertex that is the endpoint
+    of a non-sidewalk edge.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT
+                vert.id,
+                ST_X(vert.the_geom) AS lng,
+                ST_Y(vert.the_geom) AS lat,
+                COALESCE(comp.strong_component, {NO_COMPONENT}) AS strong_component
+            FROM chicago_ways_vertices_pgr AS vert
+            JOIN (
+                SELECT source AS id FROM chicago_ways
+                WHERE tag_id NOT IN {SIDEWALK_TAG_IDS}
+                UNION
+                SELECT target AS id FROM chicago_ways
+                WHERE tag_id NOT IN {SIDEWALK_TAG_IDS}
+            ) AS routable
+            USING(id)
+            LEFT JOIN mbm_vertexcomponent AS comp
+            ON comp.vertex_id = vert.id
+        """)
+        rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 4)
+    return VertexIndex(
+        vertex_ids=rows[:, 0].astype(np.int64),
+        lngs=rows[:, 1],
+        lats=rows[:, 2],
+        components=rows[:, 3].astype(np.int64),
+    )
+
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def get_vertex_index():
+    """
+    Return the vertex index for this process, loading it on first use and
+    reloading it whenever the routing vertices or their components change.
+    """
+    global _index, _index_version
+    version = DataVersion.get(DataVersion.VERTICES)
+    if _index is None or _index_version != version:
+        with _index_lock:
+            if _index is None or _index_version != version:
+                _index = load_vertex_index()
+                _index_version = version
+    return _index
+
+
+def clear_vertex_index():
+    """
+    Drop the vertex index for this process, so that it's reloaded on next
+    use.
+    """
+    global _index, _index_version
+    with _index_lock:
+        _index, _index_version = None, None
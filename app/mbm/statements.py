@@ -0,0 +1,181 @@
+"""
+Server-side prepared statements for the routing queries, and a pool of
+connections to run them on.
+
+Every route request runs the same few large queries with different
+parameters. Run ad hoc, Postgres parses and plans each of them from scratch
+on every request. Prepared, they're parsed once per connection, and planned
+once Postgres settles on a generic plan. Prepared statements only live as
+long as the connection that prepared them, so they run on a pool of
+connections that each process keeps open and shares between its threads,
+rather than on Django's per-thread connection, which is closed whenever it
+outlives CONN_MAX_AGE.
+"""
+import itertools
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+from django.conf import settings
+from django.db import connections
+
+from mbm import metrics
+
+PREPARES = metrics.Counter(
+    'mbm_prepared_statements_total',
+    'Statements prepared on routing database connections.'
+)
+
+_PLACEHOLDER = re.compile(r'%s')
+
+
+def number_placeholders(sql, start=1):
+    """Replace the `%s` placeholders in `sql` with numbered placeholders for
+    a prepared statement, starting from `$start`."""
+    numbers = itertools.count(start)
+    return _PLACEHOLDER.sub(lambda match: f'${next(numbers)}', sql)
+
+
+class Statement:
+    """A named statement with `$n` placeholders of the Postgres `types`."""
+    def __init__(self, name, sql, types):
+        self.name = name
+        self.sql = sql
+        self.types = tuple(types)
+
+    @property
+    def prepare_sql(self):
+        return f'PREPARE {self.name} ({", ".join(self.types)}) AS {self.sql}'
+
+    @property
+    def execute_sql(self):
+        return f'EXECUTE {self.name} ({", ".join(["%s"] * len(self.types))})'
+
+
+# Statements by name, built once per process
+_statements = {}
+_statements_lock = threading.Lock()
+
+
+def statement(name, types, build):
+    """Return the statement `name` with parameters of `types`, calling
+    `build()` for its SQL the first time that it's used."""
+    stmt = _statements.get(name)
+    if stmt is None:
+        stmt = Statement(name, build(), types)
+        with _statements_lock:
+            stmt = _statements.setdefault(name, stmt)
+    return stmt
+
+
+class PreparedConnection(extensions.connection):
+    """A connection in autocommit mode that remembers which statements it
+    has prepared."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.autocommit = True
+        self.prepared = set()
+
+    def prepare(self, statement):
+        if statement.name not in self.prepared:
+            with self.cursor() as cursor:
+                cursor.execute(statement.prepare_sql)
+            self.prepared.add(statement.name)
+            PREPARES.inc()
+
+    def execute(self, statement, params=()):
+        """Run `statement`, preparing it first if this connection hasn't,
+        and return a cursor over its results."""
+        self.prepare(statement)
+        cursor = self.cursor()
+        cursor.execute(statement.execute_sql, list(params))
+        return cursor
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of `PreparedConnection`s. Connections are opened as
+    they're needed, up to `maxsize`, and threads wait for a free one beyond
+    that. Connections that were closed, like after the database restarted,
+    are dropped from the pool.
+    """
+    def __init__(self, maxsize, **params):
+        self.maxsize = maxsize
+        self.params = params
+        self.in_use = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxsize)
+
+    @property
+    def size(self):
+        return self.in_use + len(self._idle)
+
+    @contextmanager
+    def connection(self):
+        with self._slots:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+                self.in_use += 1
+            try:
+                if conn is None or conn.closed:
+                    conn = psycopg2.connect(connection_factory=PreparedConnection, **self.params)
+                yield conn
+            finally:
+                with self._lock:
+                    self.in_use -= 1
+                    if conn is not None and not conn.closed:
+                        self._idle.append(conn)
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return this process's pool of connections to the default database.
+    Forked processes get a pool of their own."""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ConnectionPool(
+                settings.ROUTING_DB_POOL_SIZE,
+                **connections['default'].get_connection_params()
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def fetchone(statement, params=()):
+    """Run `statement` on a pooled connection and return its first row."""
+    with get_pool().connection() as conn:
+        with conn.execute(statement, params) as cursor:
+            return cursor.fetchone()
+
+
+def fetchall(statement, params=()):
+    """Run `statement` on a pooled connection and return all of its rows."""
+    with get_pool().connection() as conn:
+        with conn.execute(statement, params) as cursor:
+            return cursor.fetchall()
+
+
+metrics.Collected(
+    'mbm_routing_db_connections',
+    'Open connections in the routing statement pool, by whether they are in use.',
+    lambda: [
+        ({'state': 'in_use'}, _pool.in_use if _pool else 0),
+        ({'state': 'idle'}, _pool.size - _pool.in_use if _pool else 0),
+    ],
+    labels=('state',)
+)
@@ -0,0 +1,328 @@
+"""
+A two-tier cache backend: a size-bounded in-memory LRU in each process, in
+front of a shared cache like the `site_cache` table.
+
+Hits in the local tier skip the round trip to the shared cache and the
+unpickling of large values like route lists and tiles, which would
+otherwise compete with routing queries for the database. Local entries
+expire after at most `LOCAL_TIMEOUT` seconds, so values that other processes
+replace or delete in the shared cache are picked up after that. Clearing the
+cache bumps a generation number in the shared cache, which every process
+checks at most every `GENERATION_CHECK_INTERVAL` seconds, dropping its local
+tier when it changes.
+
+Configure it with the alias of the shared cache as its location:
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'mbm.tiered_cache.TieredCache',
+            'LOCATION': 'shared',
+            'OPTIONS': {'MAX_ENTRIES': 256, 'MAX_BYTES': 64 * 1024 * 1024},
+        },
+        'shared': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'site_cache',
+        },
+    }
+"""
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.db import DatabaseCache
+from django.db import connections, router
+
+from mbm import metrics
+
+# Key in the shared cache of the generation that local tiers were filled in
+GENERATION_KEY = 'tiered_cache:generation'
+
+
+class LocalTier:
+    """
+    A thread-safe LRU of pickled values with expiry times, bounded by both
+    the number of entries and their total size in bytes, that counts its
+    hits, misses, evictions and expirations.
+    """
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.generation = None
+        self.checked_at = None
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Return a tuple `(found, pickled)` of whether `key` has a live
+        entry, and its pickled value."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.time():
+                self._pop(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, key, pickled, expires_at):
+        """Store `pickled` under `key` until `expires_at`, or forever if it's
+        None, unless it's already expired or too big to fit."""
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+            return
+        if self.max_entries <= 0 or len(pickled) > self.max_bytes:
+            self.delete(key)
+            return
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (expires_at, pickled)
+            self.bytes += len(pickled)
+            while len(self._data) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            return self._pop(key)
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return False
+        self.bytes -= len(entry[1])
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'max_entries': self.max_entries,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+# Local tiers by cache alias, shared between the threads of a process, since
+# Django creates a backend instance per thread
+_local_tiers = {}
+_local_tiers_lock = threading.Lock()
+
+# Lookups in the shared tier after a local miss, by cache alias and result
+SHARED_LOOKUPS = metrics.Counter(
+    'mbm_shared_cache_lookups_total',
+    'Lookups in the shared tier of the site cache after a local miss, by result.',
+    labels=('cache', 'result')
+)
+
+
+class TieredCache(BaseCache):
+    """
+    A cache backend that reads through a `LocalTier` in this process to the
+    cache whose alias is its location. Writes go to both tiers. Options:
+
+    - MAX_ENTRIES: number of entries in the local tier, or 0 to disable it
+    - MAX_BYTES: total size of the pickled values in the local tier
+    - LOCAL_TIMEOUT: seconds to keep values in the local tier, or None to
+      keep them for as long as in the shared cache
+    - GENERATION_CHECK_INTERVAL: seconds between checks for whether another
+      process cleared the cache
+    """
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.shared_alias = location
+        self.local_timeout = options.get('LOCAL_TIMEOUT', 60)
+        self.check_interval = options.get('GENERATION_CHECK_INTERVAL', 5)
+        with _local_tiers_lock:
+            self.local = _local_tiers.get(location)
+            if self.local is None:
+                self.local = _local_tiers[location] = LocalTier(
+                    options.get('MAX_ENTRIES', 256),
+                    options.get('MAX_BYTES', 64 * 1024 * 1024)
+                )
+
+    @property
+    def shared(self):
+        return caches[self.shared_alias]
+
+    def _local_key(self, key, version):
+        return self.shared.make_key(key, version=version)
+
+    def _local_expiry(self, timeout):
+        """Return the time when a value that's cached in the shared tier for
+        `timeout` should expire from the local tier."""
+        expires_at = self.shared.get_backend_timeout(timeout)
+        if self.local_timeout is not None:
+            local_expires_at = time.time() + self.local_timeout
+            expires_at = local_expires_at if expires_at is None else min(expires_at, local_expires_at)
+        return expires_at
+
+    def _check_generation(self):
+        """Drop the local tier if the cache was cleared since it was filled,
+        checking at most every `check_interval` seconds."""
+        now = time.monotonic()
+        local = self.local
+        if local.checked_at is not None and now - local.checked_at < self.check_interval:
+            return
+        local.checked_at = now
+        generation = self.shared.get(GENERATION_KEY)
+        if generation != local.generation:
+            local.clear()
+            local.generation = generation
+
+    def get(self, key, default=None, version=None):
+        self._check_generation()
+        local_key = self._local_key(key, version)
+        found, pickled = self.local.get(local_key)
+        if found:
+            return pickle.loads(pickled)
+
+        sentinel = object()
+        value = self.shared.get(key, sentinel, version=version)
+        if value is sentinel:
+            SHARED_LOOKUPS.inc(cache=self.shared_alias, result='miss')
+            return default
+        SHARED_LOOKUPS.inc(cache=self.shared_alias, result='hit')
+        # The shared tier doesn't say how long the value has left, so only
+        # keep it locally for as long as a fresh one would be
+        self.local.set(
+            local_key,
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+            self._local_expiry(DEFAULT_TIMEOUT)
+        )
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._check_generation()
+        self.shared.set(key, value, timeout, version=version)
+        self.local.set(
+            self._local_key(key, version),
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+            self._local_expiry(timeout)
+        )
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._check_generation()
+        added = self.shared.add(key, value, timeout, version=version)
+        if added:
+            self.local.set(
+                self._local_key(key, version),
+                pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                self._local_expiry(timeout)
+            )
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        self.local.delete(self._local_key(key, version))
+        return self.shared.touch(key, timeout, version=version)
+
+    def delete(self, key, version=None):
+        self.local.delete(self._local_key(key, version))
+        return self.shared.delete(key, version=version)
+
+    def has_key(self, key, version=None):
+        return self.get(key, self, version=version) is not self
+
+    def incr(self, key, delta=1, version=None):
+        self.local.delete(self._local_key(key, version))
+        return self.shared.incr(key, delta, version=version)
+
+    def clear(self):
+        """Clear the shared tier and this process's local tier, and have
+        every other process drop its local tier."""
+        self.shared.clear()
+        self.local.clear()
+        self.local.generation = uuid.uuid4().hex
+        self.shared.set(GENERATION_KEY, self.local.generation, None)
+
+    def close(self, **kwargs):
+        self.shared.close(**kwargs)
+
+    def stats(self):
+        """Return statistics for the local tier in this process, and the
+        number of entries in the shared tier if it's a database cache."""
+        return {
+            'local': self.local.stats(),
+            'shared': {
+                'alias': self.shared_alias,
+                'entries': self.shared_entries(),
+                'hits': SHARED_LOOKUPS.value(cache=self.shared_alias, result='hit'),
+                'misses': SHARED_LOOKUPS.value(cache=self.shared_alias, result='miss'),
+            },
+        }
+
+    def shared_entries(self):
+        """Return the number of entries in the shared tier, or None if it
+        can't be counted."""
+        shared = self.shared
+        if not isinstance(shared, DatabaseCache):
+            return None
+        db = router.db_for_read(shared.cache_model_class)
+        connection = connections[db]
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM %s' % connection.ops.quote_name(shared._table))
+            return cursor.fetchone()[0]
+
+
+def _local_tier_samples(attribute):
+    return [({'cache': alias}, getattr(tier, attribute)) for alias, tier in sorted(_local_tiers.items())]
+
+
+metrics.Collected(
+    'mbm_local_cache_lookups_total',
+    'Lookups in the local tier of the site cache, by result.',
+    lambda: [
+        sample
+        for alias, tier in sorted(_local_tiers.items())
+        for sample in (
+            ({'cache': alias, 'result': 'hit'}, tier.hits),
+            ({'cache': alias, 'result': 'miss'}, tier.misses),
+        )
+    ],
+    labels=('cache', 'result'),
+    type='counter'
+)
+metrics.Collected(
+    'mbm_local_cache_evictions_total',
+    'Entries evicted from the local tier of the site cache to make room.',
+    lambda: _local_tier_samples('evictions'),
+    labels=('cache',),
+    type='counter'
+)
+metrics.Collected(
+    'mbm_local_cache_entries',
+    'Number of entries in the local tier of the site cache.',
+    lambda: [({'cache': alias}, len(tier)) for alias, tier in sorted(_local_tiers.items())],
+    labels=('cache',)
+)
+metrics.Collected(
+    'mbm_local_cache_bytes',
+    'Total size of the pickled values in the local tier of the site cache.',
+    lambda: _local_tier_samples('bytes'),
+    labels=('cache',)
+)
@@ -15,7 +15,6 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
-from django.views.decorators.cache import cache_page
 
 from mbm import views
 
@@ -23,7 +22,13 @@ urlpatterns = [
     path('', views.Home.as_view(), name='home'),
     path('about/', views.About.as_view(), name='about'),
     path('api/route/', views.Route.as_view(), name='route'),
-    path('api/routes/', cache_page(60 * 60 * 24)(views.RouteList.as_view()), name='route-list'),
+    path('api/route/matrix/', views.RouteMatrix.as_view(), name='route-matrix'),
+    path('api/routes/', views.RouteList.as_view(), name='route-list'),
+    path('api/isochrone/', views.Isochrone.as_view(), name='isochrone'),
+    path('api/async/route/', views.async_route, name='async-route'),
+    path('api/async/routes/', views.async_route_list, name='async-route-list'),
+    path('api/routes/tiles/<int:z>/<int:x>/<int:y>.pbf', views.route_tile, name='route-tile'),
+    path('api/ways/tiles/<int:z>/<int:x>/<int:y>.json', views.way_tile, name='way-tile'),
     path('neighborhoods/', views.MellowRouteList.as_view(), name='mellow-route-list'),
     path('neighborhoods/create/', views.MellowRouteCreate.as_view(), name='mellow-route-create'),
     path('neighborhoods/edit/<slug:slug>/', views.MellowRouteNeighborhoodEdit.as_view(), name='mellow-route-neighborhood-edit'),
@@ -32,6 +37,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('pong/', views.pong),
     path('healthcheck/', views.healthcheck, name='healthcheck'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
 
 handler404 = 'mbm.views.page_not_found'
@@ -1,40 +1,44 @@
+import asyncio
+import functools
+import hmac
 import json
+import math
 
-from django.db import connection
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
 from django.urls import reverse_lazy
 from django.shortcuts import render
-from django.http import HttpResponseRedirect, HttpResponse
-from django.views.generic import TemplateView, CreateView, UpdateView, ListView, DeleteView
+from django.http import (
+    Http404, HttpResponseForbidden, HttpResponseRedirect, HttpResponse, JsonResponse,
+    StreamingHttpResponse
+)
+from django.utils.cache import patch_cache_control
+from django.views.generic import TemplateView, CreateView, UpdateView, DeleteView
 from django.contrib import messages
+from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.renderers import JSONRenderer
 from rest_framework.exceptions import ParseError
 
-from mbm import forms
-from mbm.models import MellowRoute, fetchall
-
-
-# osm2pgrouting tag IDs for indexing specific types of streets. For docs, see:
-# https://github.com/pgRouting/osm2pgrouting/blob/8491929fc4037d308f271e84d59bb96da3c28aa2/mapconfig_for_bicycles.xml
-
-RESIDENTIAL_STREET_TAG_IDS = (
-    507,  # living_street
-    509,  # residential
+from mbm import forms, metrics, statements
+from mbm.aiodb import get_pool
+from mbm.caching import (
+    ROUTE_REQUESTS_COALESCED, advisory_lock, async_route_flights, get_versioned,
+    get_versioned_async, isochrone_cache, route_cache, route_flights, shared_cache
 )
-
-CYCLEWAY_TAG_IDS = (
-    101,  # cycleway:track
-    201,  # cycleway:right:track
-    301,  # cycleway:left:track
-    501,  # highway:cycleway
+from mbm.contraction import get_contraction_hierarchy
+from mbm.costs import SIDEWALK_TAG_IDS
+from mbm.graph import METERS_PER_DEGREE, get_graph
+from mbm.models import (
+    METERS_PER_MILE, DataVersion, Edge, MellowChange, MellowRoute, VertexComponent
 )
+from mbm.signals import batched_refresh
+from mbm.snapping import get_vertex_index
 
-SIDEWALK_TAG_IDS = (
-    503,  # highway:pedestrian
-    504,  # highway:footway
-)
 
 # Illinois East coordinate system.
 # Useful for geometry math since its units are in feet, as opposed to
@@ -42,6 +46,55 @@ SIDEWALK_TAG_IDS = (
 # See: https://epsg.io/3435
 IL_EAST_CRS = 3435
 
+# Upper limit for the buffer that we add around the source and target to
+# build the bounding box that restricts the route search, in feet
+BBOX_MAX_BUFFER_FT = 2 * 5280
+
+# When no route can be found within the bounding box, grow its buffer by this
+# factor and search again, up to BBOX_MAX_EXPANSIONS times, before we fall
+# back to searching the full graph
+BBOX_EXPANSION_FACTOR = 2
+BBOX_MAX_EXPANSIONS = 2
+
+# Naive guess of biking speed that we use to estimate travel times
+BIKE_SPEED_MPH = 10
+
+# Number of decimal places to keep in compact route coordinates, about 1m
+COMPACT_PRECISION = 5
+
+ROUTE_STAGE_SECONDS = metrics.Histogram(
+    'mbm_route_stage_seconds',
+    'Time spent in each stage of a route request.',
+    labels=('stage',)
+)
+ROUTE_REQUEST_SECONDS = metrics.Histogram(
+    'mbm_route_request_seconds',
+    'Total time spent handling successful route requests.'
+)
+# Outcomes are `bbox_hit`, `bbox_expanded` and `fallback` for searches with
+# pgr_dijkstra, by how many bounding boxes they tried, and `graph` for
+# searches with the in-process graph or contraction hierarchy
+ROUTE_SEARCHES = metrics.Counter(
+    'mbm_route_searches_total',
+    'Route searches that missed the route cache, by how the route was found.',
+    labels=('outcome',)
+)
+ROUTE_EDGES = metrics.Histogram(
+    'mbm_route_edges',
+    'Number of edges in each route found.',
+    buckets=metrics.EDGE_COUNT_BUCKETS
+)
+ISOCHRONE_STAGE_SECONDS = metrics.Histogram(
+    'mbm_isochrone_stage_seconds',
+    'Time spent in each stage of an isochrone request.',
+    labels=('stage',)
+)
+
+# How much of the way from a convex hull to the tightest hull around their
+# edges isochrone hulls go, as the `target_percent` of ST_ConcaveHull
+ISOCHRONE_HULL_TARGET_PERCENT = 0.8
+
+
 
 class Home(TemplateView):
     title = 'Home'
@@ -56,30 +109,252 @@ class About(TemplateView):
 class RouteList(APIView):
     renderer_classes = [JSONRenderer]
 
+    max_zoom = 22
+
     def get(self, request):
-        return Response(MellowRoute.all())
+        bbox = self.get_bbox_from_request(request)
+        zoom = self.get_zoom_from_request(request)
+        routes = get_versioned(
+            f'route-list:{bbox}:{zoom}',
+            lambda: MellowRoute.all(bbox=bbox, zoom=zoom),
+            bounds=bbox,
+            timeout=ROUTE_LIST_CACHE_TIMEOUT
+        )
+        response = Response(routes)
+        patch_cache_control(response, public=True, max_age=BROWSER_CACHE_MAX_AGE)
+        return response
+
+    def get_bbox_from_request(self, request):
+        bbox = request.GET.get('bbox')
+        if bbox is None:
+            return None
+        try:
+            min_lng, min_lat, max_lng, max_lat = (float(val) for val in bbox.split(','))
+        except ValueError:
+            raise ParseError(
+                'bbox must be of the form min_lng,min_lat,max_lng,max_lat'
+            )
+        if min_lng > max_lng or min_lat > max_lat:
+            raise ParseError('bbox minimums must not be greater than its maximums')
+        return (min_lng, min_lat, max_lng, max_lat)
+
+    def get_zoom_from_request(self, request):
+        zoom = request.GET.get('zoom')
+        if zoom is None:
+            return None
+        try:
+            zoom = int(zoom)
+        except ValueError:
+            raise ParseError('zoom must be an integer')
+        if not 0 <= zoom <= self.max_zoom:
+            raise ParseError(f'zoom must be between 0 and {self.max_zoom}')
+        return zoom
+
+
+# Maximum zoom level for mellow route vector tiles
+MAX_TILE_ZOOM = 22
+
+# How long to cache vector tiles and route lists, in seconds. Cached entries
+# are checked against the mellow data version, so edits invalidate them
+# immediately regardless.
+TILE_CACHE_TIMEOUT = 60 * 60 * 24
+ROUTE_LIST_CACHE_TIMEOUT = 60 * 60 * 24
+
+# How long to keep routes in the shared cache for workers that waited on
+# another worker's search for them, in seconds
+COALESCED_ROUTE_CACHE_TIMEOUT = 60
+
+# How long browsers may cache vector tiles and route lists, in seconds
+BROWSER_CACHE_MAX_AGE = 60 * 60
+
+
+def tile_bounds(z, x, y):
+    """Return the `(min_lng, min_lat, max_lng, max_lat)` bounds of the web
+    mercator tile `z/x/y`, padded by the buffer that ST_AsMVTGeom includes
+    around each tile."""
+    n = 2 ** z
+    # ST_AsMVTGeom includes a 256 unit buffer on each side of a 4096 unit tile
+    buffer = 256 / 4096
+
+    def lng(tile_x):
+        return tile_x / n * 360 - 180
+
+    def lat(tile_y):
+        tile_y = min(max(tile_y, 0), n)
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n))))
+
+    return (lng(x - buffer), lat(y + 1 + buffer), lng(x + 1 + buffer), lat(y - buffer))
+
+
+def route_tile(request, z, x, y):
+    """Serve the mellow routes within a web mercator tile as a Mapbox vector
+    tile, so that clients only need to fetch the routes that are in view.
+
+    Cached tiles survive edits to the mellow data that don't touch them."""
+    if z > MAX_TILE_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise Http404('Tile %s/%s/%s does not exist' % (z, x, y))
+
+    tile = get_versioned(
+        f'route-tile:{z}:{x}:{y}',
+        lambda: MellowRoute.tile(z, x, y),
+        bounds=tile_bounds(z, x, y),
+        timeout=TILE_CACHE_TIMEOUT
+    )
+
+    response = HttpResponse(tile, content_type='application/vnd.mapbox-vector-tile')
+    patch_cache_control(response, public=True, max_age=BROWSER_CACHE_MAX_AGE)
+    return response
+
+
+# How long to cache way tiles for the way picker, in seconds. Ways only
+# change when OSM data is reimported, after which the cache should be cleared.
+WAY_TILE_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+
+@login_required
+def way_tile(request, z, x, y):
+    """Serve the OSM ways within a web mercator tile as GeoJSON, so that the
+    way picker on the mellow route edit form can load the ways in view as
+    the map moves instead of embedding every way in the page."""
+    if z != forms.WAY_TILE_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise Http404('Way tile %s/%s/%s does not exist' % (z, x, y))
+
+    cache_key = f'way-tile:{z}:{x}:{y}'
+    tile = cache.get(cache_key)
+    if tile is None:
+        tile = Edge.way_tile(z, x, y)
+        cache.set(cache_key, tile, WAY_TILE_CACHE_TIMEOUT)
+
+    response = HttpResponse(tile, content_type='application/json')
+    patch_cache_control(response, private=True, max_age=BROWSER_CACHE_MAX_AGE)
+    return response
 
 
 class Route(APIView):
+    """
+    A route between two points. Each stage of the request is timed, and the
+    timings are reported in the `Server-Timing` header of the response as
+    well as in the `/metrics/` histograms.
+    """
     renderer_classes = [JSONRenderer]
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.timer = metrics.StageTimer(ROUTE_STAGE_SECONDS)
+
     def get(self, request):
         source_coord = self.get_coord_from_request(request, 'source')
-        source_vertex_id = self.get_nearest_vertex_id(source_coord)
+        with self.timer.stage('snap_source'):
+            source_vertex_id = self.get_nearest_vertex_id(source_coord)
 
         target_coord = self.get_coord_from_request(request, 'target')
-        target_vertex_id = self.get_nearest_vertex_id(target_coord)
+        with self.timer.stage('snap_target'):
+            target_vertex_id = self.get_nearest_vertex_id(target_coord)
 
-        show_bbox = request.GET.get("show_bbox", False) == "true"
+        with self.timer.stage('reachability'):
+            source_vertex_id, target_vertex_id = self.ensure_reachable(
+                source_coord,
+                source_vertex_id,
+                target_coord,
+                target_vertex_id
+            )
+
+        route = self.get_cached_route(
+            source_vertex_id,
+            target_vertex_id,
+            **self.get_route_options(request)
+        )
+        return self.render_route(
+            source_coord,
+            target_coord,
+            source_vertex_id,
+            target_vertex_id,
+            route
+        )
 
-        response_dict = {
-            'source': source_coord,
-            'target': target_coord,
-            'source_vertex_id': source_vertex_id,
-            'target_vertex_id': target_vertex_id,
-            'route': self.get_route(source_vertex_id, target_vertex_id, show_bbox=show_bbox)
+    def get_route_options(self, request):
+        """Return the keyword arguments for `get_route` from the request."""
+        show_bbox = request.GET.get("show_bbox", False) == "true"
+        compact = request.GET.get("compact", False) == "true"
+        geometry_format = request.GET.get("geometry", "geojson")
+        if geometry_format not in ('geojson', 'polyline'):
+            raise ParseError("Request argument 'geometry' must be one of: geojson, polyline")
+        return {
+            'show_bbox': show_bbox,
+            'compact': compact or geometry_format == 'polyline',
+            'polyline': geometry_format == 'polyline',
         }
-        return Response(response_dict)
+
+    def render_route(self, source_coord, target_coord, source_vertex_id, target_vertex_id, route):
+        """Return the response for `route`, with the request's stage timings."""
+        # The route is already serialized by Postgres, so splice it into the
+        # response as-is rather than parsing it just to serialize it again
+        with self.timer.stage('render'):
+            response_json = json.dumps({
+                'source': source_coord,
+                'target': target_coord,
+                'source_vertex_id': source_vertex_id,
+                'target_vertex_id': target_vertex_id,
+            }, separators=(',', ':'))
+            response = HttpResponse(
+                response_json[:-1] + ',"route":' + route + '}',
+                content_type='application/json'
+            )
+
+        ROUTE_REQUEST_SECONDS.observe(self.timer.elapsed())
+        response['Server-Timing'] = self.timer.header()
+        return response
+
+    def get_cached_route(
+        self,
+        source_vertex_id,
+        target_vertex_id,
+        show_bbox=False,
+        compact=False,
+        polyline=False
+    ):
+        """Return the result of `get_route` from the route cache, computing
+        and caching it on a miss.
+
+        Entries are keyed on the current version of the mellow data, so any
+        change to a MellowRoute invalidates every cached route, except for
+        those that the change listener carries over to the new version.
+
+        Concurrent requests for the same route in this process wait for the
+        first one to find it rather than searching for it themselves, and
+        with `COALESCE_ROUTES_ACROSS_WORKERS`, so do requests in other
+        worker processes.
+        """
+        with self.timer.stage('cache'):
+            version = DataVersion.get(DataVersion.MELLOW)
+            cache_key = (source_vertex_id, target_vertex_id, show_bbox, compact, polyline, version)
+            route = route_cache.get(cache_key)
+        if route is None:
+            route, shared = route_flights.do(cache_key, lambda: self._get_uncached_route(cache_key))
+            if shared:
+                ROUTE_REQUESTS_COALESCED.inc(scope='process')
+        return route
+
+    def _get_uncached_route(self, cache_key):
+        """Find the route for a `route_cache` key that missed the cache, and
+        cache it."""
+        source_vertex_id, target_vertex_id, show_bbox, compact, polyline, _ = cache_key
+        options = {'show_bbox': show_bbox, 'compact': compact, 'polyline': polyline}
+        if settings.COALESCE_ROUTES_ACROSS_WORKERS:
+            # Hold a lock on the route while searching for it, and leave the
+            # result in the shared cache for any worker that waited on it
+            shared_key = 'coalesced-route:' + ':'.join(str(part) for part in cache_key)
+            with advisory_lock(shared_key) as waited:
+                route = shared_cache().get(shared_key) if waited else None
+                if route is not None:
+                    ROUTE_REQUESTS_COALESCED.inc(scope='workers')
+                else:
+                    route = self.get_route(source_vertex_id, target_vertex_id, **options)
+                    shared_cache().set(shared_key, route, COALESCED_ROUTE_CACHE_TIMEOUT)
+        else:
+            route = self.get_route(source_vertex_id, target_vertex_id, **options)
+        route_cache.set(cache_key, route)
+        return route
 
     def get_coord_from_request(self, request, key):
         try:
@@ -87,47 +362,202 @@ class Route(APIView):
         except KeyError:
             raise ParseError('Request is missing required key: %s' % key)
 
+        return self.parse_coord(coord, key)
+
+    def parse_coord(self, coord, key):
+        """Split a coordinate string of the form lng,lat into its parts,
+        raising a ParseError on behalf of the request argument `key` if it's
+        malformed."""
         coord_parts = coord.split(',')
 
         try:
             assert len(coord_parts) == 2
             float(coord_parts[0]), float(coord_parts[1])
-        except (AssertionError, TypeError):
+        except (AssertionError, TypeError, ValueError):
             raise ParseError(
                 "Request argument '%s' must be a coordinate of the form lng,lat" % key
             )
 
         return coord_parts
 
-    def get_nearest_vertex_id(self, coord):
-        with connection.cursor() as cursor:
-            cursor.execute(f"""
-                SELECT vert.id
-                FROM chicago_ways_vertices_pgr AS vert
-                INNER JOIN chicago_ways AS cw
-                    ON vert.id = cw.source
-                    OR vert.id = cw.target
-                WHERE cw.tag_id NOT IN {SIDEWALK_TAG_IDS}
-                ORDER BY vert.the_geom <-> ST_SetSRID(
-                    ST_MakePoint(%s, %s),
-                    4326
-                )
-                LIMIT 1
-            """, [coord[1], coord[0]])  # ST_MakePoint() expects lng,lat
-            rows = fetchall(cursor)
-        if rows:
-            return rows[0]['id']
+    def get_nearest_vertex_id(self, coord, strong_component=None):
+        """Return the ID of the nearest routable vertex to `coord`, optionally
+        restricted to vertices in the strong component `strong_component`.
+
+        The app sends `source` and `target` as lat,lng, so `coord` is a
+        `[lat, lng]` pair here, unlike the `[lng, lat]` pairs that
+        `get_nearest_vertex_ids` takes for the route matrix.
+        """
+        if settings.SNAPPING_BACKEND == 'memory':
+            vertex_id = get_vertex_index().nearest(
+                float(coord[1]),
+                float(coord[0]),
+                strong_component=strong_component
+            )
+            if vertex_id is None:
+                raise ParseError('No vertex found near point %s' % ','.join(coord))
+            return vertex_id
+
+        sql, params = self._build_nearest_vertex_query(coord, strong_component)
+        if settings.PREPARED_ROUTING_QUERIES:
+            row = statements.fetchone(
+                self._nearest_vertex_statement(strong_component is not None),
+                params
+            )
         else:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                row = cursor.fetchone()
+        if row is None:
             raise ParseError('No vertex found near point %s' % ','.join(coord))
+        return row[0]
+
+    def _build_nearest_vertex_query(self, coord, strong_component=None):
+        """Return a tuple `(sql, params)` of the KNN query that snaps `coord`
+        for `get_nearest_vertex_id`."""
+        component_sql, params = '', [coord[1], coord[0]]  # ST_MakePoint() expects lng,lat
+        if strong_component is not None:
+            component_sql = """
+                AND vert.id IN (
+                    SELECT vertex_id
+                    FROM mbm_vertexcomponent
+                    WHERE strong_component = %s
+                )
+            """
+            params = [strong_component] + params
+
+        return f"""
+            SELECT vert.id
+            FROM chicago_ways_vertices_pgr AS vert
+            INNER JOIN chicago_ways AS cw
+                ON vert.id = cw.source
+                OR vert.id = cw.target
+            WHERE cw.tag_id NOT IN {SIDEWALK_TAG_IDS}
+            {component_sql}
+            ORDER BY vert.the_geom <-> ST_SetSRID(
+                ST_MakePoint(%s, %s),
+                4326
+            )
+            LIMIT 1
+        """, params
+
+    def _nearest_vertex_statement(self, in_component=False):
+        """Return the prepared statement for `_build_nearest_vertex_query`,
+        which takes the strong component first if `in_component`."""
+        if in_component:
+            return statements.statement(
+                'mbm_nearest_vertex_in_component',
+                ('integer', 'float8', 'float8'),
+                lambda: statements.number_placeholders(
+                    self._build_nearest_vertex_query(['0', '0'], strong_component=0)[0]
+                )
+            )
+        return statements.statement(
+            'mbm_nearest_vertex',
+            ('float8', 'float8'),
+            lambda: statements.number_placeholders(self._build_nearest_vertex_query(['0', '0'])[0])
+        )
+
+    def get_nearest_vertex_ids(self, coords):
+        """Return the IDs of the nearest routable vertices to a list of
+        coordinates, in the same order as `coords`. When snapping with the
+        database, all coordinates are snapped in a single query."""
+        if settings.SNAPPING_BACKEND == 'memory':
+            vertex_ids = get_vertex_index().nearest_many(
+                [float(coord[0]) for coord in coords],
+                [float(coord[1]) for coord in coords]
+            )
+            if None in vertex_ids:
+                raise ParseError('No vertices found near the requested points')
+            return vertex_ids
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT point.idx, nearest.id
+                FROM UNNEST(%s::float8[], %s::float8[])
+                    WITH ORDINALITY AS point(lng, lat, idx)
+                CROSS JOIN LATERAL (
+                    SELECT vert.id
+                    FROM chicago_ways_vertices_pgr AS vert
+                    INNER JOIN chicago_ways AS cw
+                        ON vert.id = cw.source
+                        OR vert.id = cw.target
+                    WHERE cw.tag_id NOT IN {SIDEWALK_TAG_IDS}
+                    ORDER BY vert.the_geom <-> ST_SetSRID(
+                        ST_MakePoint(point.lng, point.lat),
+                        4326
+                    )
+                    LIMIT 1
+                ) AS nearest
+                ORDER BY point.idx
+            """, [
+                [float(coord[0]) for coord in coords],
+                [float(coord[1]) for coord in coords],
+            ])
+            vertex_ids = [row[1] for row in cursor.fetchall()]
+        if len(vertex_ids) != len(coords):
+            raise ParseError('No vertices found near the requested points')
+        return vertex_ids
+
+    def ensure_reachable(
+        self,
+        source_coord,
+        source_vertex_id,
+        target_coord,
+        target_vertex_id
+    ):
+        """Use the precomputed vertex components to make sure that a route
+        can exist between the snapped source and target vertices, and return
+        a tuple `(source_vertex_id, target_vertex_id)`.
+
+        If the vertices lie in different weak components, no route search can
+        succeed, so we re-snap whichever of them lies outside of the main
+        street network to the nearest vertex within it. Vertices in the same
+        weak component are left alone, since they may still be able to reach
+        each other. If the components haven't been built, this is a no-op.
+        """
+        if source_vertex_id == target_vertex_id:
+            return source_vertex_id, target_vertex_id
+
+        components = VertexComponent.for_vertices(source_vertex_id, target_vertex_id)
+        resnap_source, resnap_target = self._resnaps_needed(
+            components,
+            source_vertex_id,
+            target_vertex_id
+        )
+
+        main = VertexComponent.MAIN_COMPONENT
+        if resnap_source:
+            source_vertex_id = self.get_nearest_vertex_id(source_coord, strong_component=main)
+        if resnap_target:
+            target_vertex_id = self.get_nearest_vertex_id(target_coord, strong_component=main)
+        return source_vertex_id, target_vertex_id
+
+    def _resnaps_needed(self, components, source_vertex_id, target_vertex_id):
+        """Return a tuple of whether the source and target vertices have to
+        be re-snapped to the main component for `ensure_reachable`, given
+        their `components` from `VertexComponent.for_vertices`."""
+        if len(components) < 2:
+            return False, False
+
+        (source_strong, source_weak) = components[source_vertex_id]
+        (target_strong, target_weak) = components[target_vertex_id]
+        if source_weak == target_weak:
+            return False, False
+
+        main = VertexComponent.MAIN_COMPONENT
+        return source_strong != main, target_strong != main
 
     def get_route(
         self,
         source_vertex_id,
         target_vertex_id,
-        show_bbox=False
+        show_bbox=False,
+        compact=False,
+        polyline=False
     ):
         """Get a GeoJSON feature collection representing a route between points
-        `source_vertex_id` and `target_vertex_id`.
+        `source_vertex_id` and `target_vertex_id`, serialized as a JSON string.
 
         Optional param behavior:
 
@@ -135,6 +565,16 @@ class Route(APIView):
            use to restrict the search space in the feature collection in the
            response, along with a used_bbox` property indicating whether the
            bbox restriction was active for the returned route
+        - `compact` (bool): Merge runs of consecutive edges that share a name
+           and type into single features, and round their coordinates
+        - `polyline` (bool): Return the geometry of each compact feature as
+           an encoded polyline in its `polyline` property instead
+
+        The `bbox_expansions` and `bbox_buffer_ft` properties always report
+        how many times the bounding box had to be grown to find the route and
+        the buffer that was finally used, so that we can tune the buffer from
+        real traffic. Both are null for routes found in process, which don't
+        search within a bounding box.
         """
         # Make sure vertices are integers, since we need to template them
         # directly into the SQL string below to satisfy the pgRouting interface,
@@ -142,227 +582,676 @@ class Route(APIView):
         assert isinstance(source_vertex_id, int)
         assert isinstance(target_vertex_id, int)
 
-        rows = self._execute_route_query(
+        options = {'show_bbox': show_bbox, 'compact': compact, 'polyline': polyline}
+
+        if settings.ROUTING_BACKEND in ('memory', 'ch'):
+            with self.timer.stage('graph_search'):
+                edge_ids = self._search_graph(source_vertex_id, target_vertex_id)
+            # An empty path means the vertices aren't connected in the
+            # in-process graph, which may just be out of date, so let
+            # pgRouting have the final say
+            if edge_ids:
+                return self._get_edge_route(edge_ids, **options)
+
+        # Search within progressively larger bounding boxes, which is much
+        # cheaper than jumping straight to the full graph when the initial
+        # bounding box is too tight to contain a route
+        for expansion in range(BBOX_MAX_EXPANSIONS + 1):
+            with self.timer.stage('bbox_query'):
+                route, num_edges = self._execute_route_query(
+                    source_vertex_id,
+                    target_vertex_id,
+                    use_bbox=True,
+                    buffer_scale=BBOX_EXPANSION_FACTOR ** expansion,
+                    bbox_expansions=expansion,
+                    **options
+                )
+            if num_edges:
+                ROUTE_SEARCHES.inc(outcome='bbox_expanded' if expansion else 'bbox_hit')
+                ROUTE_EDGES.observe(num_edges)
+                return route
+
+        with self.timer.stage('fallback_query'):
+            route, num_edges = self._execute_route_query(
+                source_vertex_id,
+                target_vertex_id,
+                use_bbox=False,
+                bbox_expansions=BBOX_MAX_EXPANSIONS + 1,
+                **options
+            )
+        ROUTE_SEARCHES.inc(outcome='fallback')
+        ROUTE_EDGES.observe(num_edges)
+        return route
+
+    def _search_graph(self, source_vertex_id, target_vertex_id):
+        """Search for a route in process with the `memory` or `ch` routing
+        backend, and return the gids of its edges, or None if it has to be
+        searched for with pgRouting instead. An empty list means that no path
+        was found in process."""
+        if settings.ROUTING_BACKEND == 'memory':
+            # The in-process graph searches the full graph quickly enough
+            # that we don't need to restrict it to a bounding box
+            return get_graph().shortest_path(source_vertex_id, target_vertex_id)
+
+        hierarchy = get_contraction_hierarchy()
+        if hierarchy is None:
+            return None
+        return hierarchy.shortest_path(source_vertex_id, target_vertex_id)
+
+    def _get_edge_route(self, edge_ids, **options):
+        """Build the route document for a path found in process."""
+        with self.timer.stage('route_query'):
+            route, num_edges = self._execute_edge_query(edge_ids, **options)
+        ROUTE_SEARCHES.inc(outcome='graph')
+        ROUTE_EDGES.observe(num_edges)
+        return route
+
+    def _execute_route_query(
+        self,
+        source_vertex_id,
+        target_vertex_id,
+        use_bbox=True,
+        buffer_scale=1,
+        bbox_expansions=0,
+        show_bbox=False,
+        compact=False,
+        polyline=False
+    ):
+        """Route between two vertices with pgRouting and return a tuple
+        `(route, num_edges)`, where `route` is the serialized feature
+        collection built by `_execute_route_document_query`.
+        """
+        if settings.PREPARED_ROUTING_QUERIES:
+            params = [source_vertex_id, target_vertex_id]
+            if use_bbox:
+                params.append(buffer_scale)
+            params.append(bbox_expansions)
+            if show_bbox:
+                params.append(use_bbox)
+            return self._route_from_row(statements.fetchone(
+                self._route_statement(use_bbox, show_bbox, compact, polyline),
+                params
+            ))
+
+        path_sql, bbox_sql = self._build_search_queries(
             source_vertex_id,
             target_vertex_id,
-            use_bbox=True
+            use_bbox=use_bbox,
+            buffer_scale=buffer_scale,
+            show_bbox=show_bbox
+        )
+        return self._execute_route_document_query(
+            path_sql,
+            [source_vertex_id, target_vertex_id],
+            bbox_sql=bbox_sql,
+            bbox_expansions=bbox_expansions,
+            used_bbox=use_bbox,
+            show_bbox=show_bbox,
+            compact=compact,
+            polyline=polyline
         )
-        used_bbox = True
 
-        if not rows:
-            rows = self._execute_route_query(
+    def _build_search_queries(
+        self,
+        source_vertex_id,
+        target_vertex_id,
+        use_bbox=True,
+        buffer_scale=1,
+        show_bbox=False
+    ):
+        """Return a tuple `(path_sql, bbox_sql)` of the queries that
+        `_execute_route_query` passes to `_execute_route_document_query`."""
+        path_sql = self._build_route_query(
+            source_vertex_id,
+            target_vertex_id,
+            use_bbox,
+            buffer_scale
+        )
+        bbox_sql = None
+        if use_bbox and show_bbox:
+            bbox_sql = self._build_bbox_query(
                 source_vertex_id,
                 target_vertex_id,
-                use_bbox=False
+                buffer_scale
             )
-            used_bbox = False
-
-        # Calculate total distance in miles and time in minutes based on
-        # the total length of the route in meters
-        dist_in_meters = sum(row['length_m'] for row in rows)
-        distance, time = self.format_distance(dist_in_meters)
-        major_streets = self.get_major_streets(rows, dist_in_meters)
+        return path_sql, bbox_sql
+
+    # Path query for routes that have already been found as a list of edges
+    EDGE_PATH_SQL = """
+        SELECT path.seq, path.edge_id, NULL::float8 AS bbox_buffer_ft
+        FROM UNNEST(%s::bigint[]) WITH ORDINALITY AS path(edge_id, seq)
+    """
+
+    def _execute_edge_query(self, edge_ids, show_bbox=False, compact=False, polyline=False):
+        """Build the feature collection for a route that has already been
+        found as a list of edge gids, and return a tuple `(route,
+        num_edges)` in the same shape as `_execute_route_query`. The route
+        wasn't searched for within a bounding box, so its `bbox_expansions`
+        is null."""
+        if settings.PREPARED_ROUTING_QUERIES:
+            params = [list(edge_ids), None]
+            if show_bbox:
+                params.append(False)
+            return self._route_from_row(statements.fetchone(
+                self._edge_route_statement(show_bbox, compact, polyline),
+                params
+            ))
+
+        return self._execute_route_document_query(
+            self.EDGE_PATH_SQL,
+            [list(edge_ids)],
+            bbox_expansions=None,
+            used_bbox=False,
+            show_bbox=show_bbox,
+            compact=compact,
+            polyline=polyline
+        )
 
-        properties = {
+    def _execute_route_document_query(
+        self,
+        path_sql,
+        params,
+        bbox_sql=None,
+        bbox_expansions=0,
+        used_bbox=False,
+        show_bbox=False,
+        compact=False,
+        polyline=False
+    ):
+        """Execute the document query built by `_build_route_document_query`
+        and return a tuple `(route, num_edges)`."""
+        with connection.cursor() as cursor:
+            cursor.execute(*self._route_document_query_args(
+                path_sql,
+                params,
+                bbox_sql=bbox_sql,
+                bbox_expansions=bbox_expansions,
+                used_bbox=used_bbox,
+                show_bbox=show_bbox,
+                compact=compact,
+                polyline=polyline
+            ))
+            row = cursor.fetchone()
+        return self._route_from_row(row)
+
+    def _route_from_row(self, row):
+        """Return a tuple `(route, num_edges)` from a row of the query built
+        by `_build_route_document_query`, where `route` is the serialized
+        feature collection. The features are spliced in as they came from
+        the database, and the summary properties are filled in here."""
+        features, properties, length_m, streets, num_edges = row
+        distance, time = self.format_distance(length_m)
+        summary = {
             'distance': distance,
             'time': time,
-            'major_streets': major_streets,
-        }
-        if show_bbox:
-            properties['used_bbox'] = used_bbox
-
-        route_geojson = {
-            'type': 'FeatureCollection',
-            'properties': properties,
-            'features': [
-                {
-                    'type': 'Feature',
-                    'geometry': json.loads(row['geometry']),
-                    'properties': {
-                        'name': row['name'],
-                        'type': row['type']
-                    }
-                }
-                for row in rows
-            ]
+            'major_streets': self.get_major_streets(streets, length_m),
+            **properties,
         }
+        route = (
+            '{"type": "FeatureCollection", "properties": '
+            + json.dumps(summary)
+            + ', "features": '
+            + features
+            + '}'
+        )
+        return route, num_edges
 
-        if show_bbox and used_bbox:
-            bbox_feature = self._execute_bbox_query(
-                source_vertex_id,
-                target_vertex_id
+    def _route_statement(self, use_bbox, show_bbox=False, compact=False, polyline=False):
+        """
+        Return the prepared statement for `_execute_route_query`. It takes
+        the source and target vertex, the buffer scale if `use_bbox`, the
+        number of bbox expansions and, if `show_bbox`, whether the bbox was
+        used.
+        """
+        path_types = ('bigint', 'bigint', 'float8') if use_bbox else ('bigint', 'bigint')
+        types = path_types + ('integer',) + (('boolean',) if show_bbox else ())
+        name = '_'.join(['mbm_route', 'bbox' if use_bbox else 'full'] + [
+            option for option, enabled in (
+                ('show_bbox', show_bbox),
+                ('compact', compact),
+                ('polyline', polyline),
+            ) if enabled
+        ])
+
+        def build():
+            path_sql = self._build_prepared_route_query(use_bbox)
+            bbox_sql = self._bbox_query_sql('$1', '$2', '$3') if use_bbox and show_bbox else None
+            return statements.number_placeholders(
+                self._build_route_document_query(
+                    path_sql,
+                    bbox_sql=bbox_sql,
+                    show_bbox=show_bbox,
+                    compact=compact,
+                    polyline=polyline
+                ),
+                start=len(path_types) + 1
             )
-            route_geojson["features"].append(bbox_feature)
 
-        return route_geojson
+        return statements.statement(name, types, build)
+
+    def _edge_route_statement(self, show_bbox=False, compact=False, polyline=False):
+        """Return the prepared statement for `_execute_edge_query`, which
+        takes the edge gids, the number of bbox expansions and, if
+        `show_bbox`, whether the bbox was used."""
+        name = '_'.join(['mbm_edge_route'] + [
+            option for option, enabled in (
+                ('show_bbox', show_bbox),
+                ('compact', compact),
+                ('polyline', polyline),
+            ) if enabled
+        ])
+        return statements.statement(
+            name,
+            ('bigint[]', 'integer') + (('boolean',) if show_bbox else ()),
+            lambda: statements.number_placeholders(self._build_route_document_query(
+                self.EDGE_PATH_SQL,
+                show_bbox=show_bbox,
+                compact=compact,
+                polyline=polyline
+            ))
+        )
 
-    def _execute_route_query(
+    def _route_document_query_args(
         self,
-        source_vertex_id,
-        target_vertex_id,
-        use_bbox=True
+        path_sql,
+        params,
+        bbox_sql=None,
+        bbox_expansions=0,
+        used_bbox=False,
+        show_bbox=False,
+        compact=False,
+        polyline=False
     ):
-        """Execute the routing query and return a list of rows representing
-        steps of the route.
+        """Return a tuple `(query, params)` of the document query for
+        `_execute_route_document_query`."""
+        params = list(params) + [bbox_expansions]
+        if show_bbox:
+            params.append(used_bbox)
+        query = self._build_route_document_query(
+            path_sql,
+            bbox_sql=bbox_sql,
+            show_bbox=show_bbox,
+            compact=compact,
+            polyline=polyline
+        )
+        return query, params
 
-        Returns an empty list if no route was found.
+    def _build_route_document_query(
+        self,
+        path_sql,
+        bbox_sql=None,
+        show_bbox=False,
+        compact=False,
+        polyline=False
+    ):
+        """Build a SQL query that serializes the features of the route
+        described by `path_sql` to GeoJSON, for `_route_from_row` to wrap in
+        a feature collection.
+
+        `path_sql` must select the `seq`, `edge_id` and `bbox_buffer_ft` of
+        each step of the route. The query takes the parameters of `path_sql`,
+        followed by the number of bbox expansions and, if `show_bbox` is
+        True, whether the bbox was used. If `bbox_sql` is provided, its
+        geometry is appended to the features.
+
+        The query returns a single row with the features as JSON text, the
+        bbox properties, the length of the route in meters, the length of
+        each named street along it, and the number of edges. The features
+        are never parsed in Python.
         """
-        query = self._build_route_query(
-            source_vertex_id,
-            target_vertex_id,
-            use_bbox
-        )
-        with connection.cursor() as cursor:
-            cursor.execute(query, [source_vertex_id, target_vertex_id])
-            return fetchall(cursor)
+        if compact:
+            # Consecutive steps with the same name and type share a `run`,
+            # since their position in the route and their position among
+            # steps with that name and type increase together
+            if polyline:
+                geometry_sql = 'NULL'
+                polyline_sql = f", 'polyline', ST_AsEncodedPolyline(line.geom, {COMPACT_PRECISION})"
+            else:
+                geometry_sql = f'ST_AsGeoJSON(line.geom, {COMPACT_PRECISION})::json'
+                polyline_sql = ''
+            features_sql = f"""
+                runs AS (
+                    SELECT
+                        *,
+                        seq - ROW_NUMBER() OVER (PARTITION BY name, type ORDER BY seq) AS run
+                    FROM steps
+                ),
+                lines AS (
+                    SELECT
+                        MIN(seq) AS seq,
+                        name,
+                        type,
+                        ST_LineMerge(ST_Collect(the_geom ORDER BY seq)) AS geom
+                    FROM runs
+                    GROUP BY name, type, run
+                ),
+                route_features AS (
+                    SELECT
+                        lines.seq,
+                        line.path[1] AS part,
+                        json_build_object(
+                            'type', 'Feature',
+                            'geometry', {geometry_sql},
+                            'properties', json_build_object(
+                                'name', lines.name,
+                                'type', lines.type
+                                {polyline_sql}
+                            )
+                        ) AS feature
+                    FROM lines
+                    CROSS JOIN LATERAL ST_Dump(
+                        ST_SnapToGrid(lines.geom, {10 ** -COMPACT_PRECISION})
+                    ) AS line
+                    WHERE GeometryType(line.geom) = 'LINESTRING'
+                )
+            """
+        else:
+            features_sql = """
+                route_features AS (
+                    SELECT
+                        seq,
+                        1 AS part,
+                        json_build_object(
+                            'type', 'Feature',
+                            'geometry', ST_AsGeoJSON(the_geom)::json,
+                            'properties', json_build_object(
+                                'name', name,
+                                'type', type
+                            )
+                        ) AS feature
+                    FROM steps
+                )
+            """
+
+        bbox_feature_sql = ''
+        if bbox_sql:
+            # Features with a NULL seq sort after the steps of the route
+            bbox_feature_sql = f"""
+                UNION ALL
+                SELECT
+                    NULL AS seq,
+                    1 AS part,
+                    json_build_object(
+                        'type', 'Feature',
+                        'geometry', ST_AsGeoJSON(bbox.geom)::json,
+                        'properties', json_build_object(
+                            'name', 'Bounding box',
+                            'type', 'bbox'
+                        )
+                    ) AS feature
+                FROM ({bbox_sql}) AS bbox
+            """
+
+        extra_properties_sql = ''
+        if show_bbox:
+            extra_properties_sql += ", 'used_bbox', %s::boolean"
+        if compact:
+            extra_properties_sql += f", 'precision', {COMPACT_PRECISION}"
+
+        return f"""
+            WITH path AS (
+                {path_sql}
+            ),
+            steps AS (
+                SELECT
+                    path.seq,
+                    path.bbox_buffer_ft,
+                    edge.name,
+                    edge.type,
+                    edge.length_m,
+                    edge.the_geom
+                FROM path
+                JOIN mbm_routingedge AS edge
+                ON path.edge_id = edge.gid
+            ),
+            totals AS (
+                SELECT
+                    COUNT(*) AS num_edges,
+                    COALESCE(SUM(length_m), 0) AS length_m,
+                    MAX(bbox_buffer_ft) AS bbox_buffer_ft
+                FROM steps
+            ),
+            streets AS (
+                SELECT COALESCE(
+                    json_agg(json_build_object('name', name, 'length_m', length_m)),
+                    '[]'::json
+                ) AS lengths
+                FROM (
+                    SELECT name, SUM(length_m) AS length_m
+                    FROM steps
+                    WHERE name <> ''
+                    GROUP BY name
+                ) AS named
+            ),
+            {features_sql},
+            features AS (
+                SELECT seq, part, feature FROM route_features
+                {bbox_feature_sql}
+            )
+            SELECT
+                COALESCE(
+                    (SELECT json_agg(feature ORDER BY seq, part) FROM features),
+                    '[]'::json
+                )::text AS features,
+                json_build_object(
+                    'bbox_expansions', %s::integer,
+                    'bbox_buffer_ft', totals.bbox_buffer_ft
+                    {extra_properties_sql}
+                ) AS properties,
+                totals.length_m,
+                streets.lengths,
+                totals.num_edges
+            FROM totals
+            CROSS JOIN streets
+        """
+
+    def format_distance(self, dist_in_meters):
+        """
+        Given a distance in meters, return a tuple (distance, time)
+        where `distance` is a string representing a distance in miles and
+        `time` is a string representing an estimated travelime in minutes.
+        """
+        dist_in_mi = dist_in_meters / METERS_PER_MILE
+        formatted_dist = round(dist_in_mi, 1)
+        # Don't worry about single-mile case since we always report at least
+        # one decimal (i.e. "1.0 miles")
+        dist_unit_str = 'miles'
+        distance = f'{formatted_dist} {dist_unit_str}'
+
+        mi_per_min = BIKE_SPEED_MPH / 60
+        time_in_min = dist_in_mi / mi_per_min
+        formatted_time = '<1' if time_in_min < 1 else str(round(time_in_min))
+        time_unit_str = 'minute' if formatted_time in ['<1', '1'] else 'minutes'
+        time = f'{formatted_time} {time_unit_str}'
+
+        return distance, time
+
+    def get_major_streets(self, rows, total_length):
+        min_percentage = 0.2 # minimum percentage of the total length of the route that a street must cover to be considered major
+        max_results = 3
+
+        if not total_length:
+            return []
+
+        per_street_lengths = {}
+        for row in rows:
+            name = row.get('name')
+            length = row.get('length_m') or 0
+            if not name:
+                continue
+            per_street_lengths[name] = per_street_lengths.get(name, 0) + length
+
+        threshold = total_length * min_percentage
+        qualifying = [
+            (name, length)
+            for name, length in per_street_lengths.items()
+            if length > threshold
+        ]
+        qualifying.sort(key=lambda item: (-item[1], item[0]))
+
+        return [name for name, _ in qualifying[:max_results]]
 
     def _build_route_query(
         self,
         source_vertex_id,
         target_vertex_id,
-        use_bbox=True
+        use_bbox=True,
+        buffer_scale=1
     ):
         """Build the SQL query for routing between two vertices.
 
-        When `use_bbox` is True (default), the edge set is restricted to ways
+        When `use_bbox` is True (default), the edge set is restricted to edges
         that intersect a buffered bounding box around the source and target, plus
-        any tagged mellow 'path' ways (which are always included regardless of
+        any tagged mellow 'path' edges (which are always included regardless of
         bounding box, to enable meandering along off-street paths that may
-        veer outside the bounding box). When `use_bbox` is False, the routing
-        algorithm will consider all ways.
+        veer outside the bounding box). `buffer_scale` multiplies the buffer
+        around the bounding box. When `use_bbox` is False, the routing
+        algorithm will consider all edges.
+
+        Each row of the result is a step of the route, with its `seq`, the
+        `edge_id` of the edge that it follows, and the `bbox_buffer_ft` that
+        was used to build the bounding box, or NULL if `use_bbox` is False.
+        The final step of a pgRouting path has an `edge_id` of -1.
         """
         assert isinstance(source_vertex_id, int)
         assert isinstance(target_vertex_id, int)
 
         if use_bbox:
+            bbox_sql = self._build_bbox_query(
+                source_vertex_id,
+                target_vertex_id,
+                buffer_scale
+            )
+            buffer_sql = f"(SELECT bbox.buffer_ft FROM ({bbox_sql}) AS bbox)"
             # One nuance to this query: When the bounding box is active, we
             # want to always include off-street "paths" regardless of whether
             # they are within the bounding box. To do this, we query two sets
-            # of ways and union them: one that includes all ways that intersect
-            # with the bounding box, and another that includes all off-street
-            # path ways. It's important that we query these two sets of ways
-            # separately and union them, since we want to make sure that PostGIS
-            # can use the spatial index on `chicago_ways` for the bounding box
-            # intersection, rather than performing a full table scan on
-            # `chicago_ways` (which has 1m+ rows)
+            # of edges and union them: one that includes all edges that
+            # intersect with the bounding box, and another that includes all
+            # off-street path edges. It's important that we query these two
+            # sets of edges separately and union them, since we want to make
+            # sure that PostGIS can use the spatial index on `mbm_routingedge`
+            # for the bounding box intersection, rather than performing a full
+            # table scan on `mbm_routingedge` (which has 1m+ rows)
             edges_sql = f"""
-                bbox AS (
-                    {self._build_bbox_query(source_vertex_id, target_vertex_id)}
-                ),
-                edge AS (
-                    SELECT
-                        way.gid AS id,
-                        way.source,
-                        way.target,
-                        way.cost,
-                        way.reverse_cost,
-                        way.oneway,
-                        way.tag_id,
-                        mellow.type
-                    FROM chicago_ways AS way
-                    JOIN bbox ON way.the_geom && bbox.geom
-                    LEFT JOIN mellow USING(osm_id)
-                    UNION
-                    SELECT
-                        way.gid AS id,
-                        way.source,
-                        way.target,
-                        way.cost,
-                        way.reverse_cost,
-                        way.oneway,
-                        way.tag_id,
-                        mellow.type
-                    FROM mellow
-                    JOIN chicago_ways AS way USING(osm_id)
-                    WHERE mellow.type = ''path''
+                WITH bbox AS (
+                    {bbox_sql}
                 )
+                SELECT edge.gid AS id, edge.source, edge.target, edge.cost, edge.reverse_cost
+                FROM mbm_routingedge AS edge
+                JOIN bbox ON edge.the_geom && bbox.geom
+                UNION
+                SELECT edge.gid AS id, edge.source, edge.target, edge.cost, edge.reverse_cost
+                FROM mbm_routingedge AS edge
+                WHERE edge.type = ''path''
             """
         else:
+            buffer_sql = 'NULL'
             edges_sql = """
-                edge AS (
-                    SELECT
-                        way.gid AS id,
-                        way.source,
-                        way.target,
-                        way.cost,
-                        way.reverse_cost,
-                        way.oneway,
-                        way.tag_id,
-                        mellow.type
-                    FROM chicago_ways AS way
-                    LEFT JOIN mellow USING(osm_id)
-                )
+                SELECT gid AS id, source, target, cost, reverse_cost
+                FROM mbm_routingedge
             """
 
+        # Costs in `mbm_routingedge` already have the mellow multipliers
+        # applied, so we can pass them to pgRouting as-is
         return f"""
             SELECT
-                way.name,
-                way.length_m,
-                ST_AsGeoJSON(way.the_geom) AS geometry,
-                mellow.type
+                path.seq,
+                path.edge AS edge_id,
+                {buffer_sql} AS bbox_buffer_ft
             FROM pgr_dijkstra(
-                'WITH mellow AS (
-                    SELECT DISTINCT(UNNEST(ways)) AS osm_id, type
-                    FROM mbm_mellowroute
-                ),
-                {edges_sql}
-                SELECT
-                    id,
-                    source,
-                    target,
-                    CASE
-                        WHEN type = ''path'' THEN cost * 0.1
-                        WHEN type = ''street'' THEN cost * 0.25
-                        WHEN tag_id in {CYCLEWAY_TAG_IDS} OR tag_id in {RESIDENTIAL_STREET_TAG_IDS} THEN cost * 0.5
-                        WHEN oneway = ''YES'' THEN cost * 0.75
-                        ELSE cost
-                    END AS cost,
-                    CASE
-                        WHEN type = ''path'' THEN reverse_cost * 0.1
-                        WHEN type = ''street'' THEN reverse_cost * 0.25
-                        WHEN tag_id in {CYCLEWAY_TAG_IDS} OR tag_id IN {RESIDENTIAL_STREET_TAG_IDS} THEN reverse_cost * 0.5
-                        WHEN oneway = ''YES'' THEN reverse_cost * 0.75
-                        ELSE reverse_cost
-                    END AS reverse_cost
-                FROM edge
-                ',
+                '{edges_sql}',
                 %s,
                 %s
             ) AS path
-            JOIN chicago_ways AS way
-            ON path.edge = way.gid
-            LEFT JOIN (
-                SELECT DISTINCT(UNNEST(ways)) AS osm_id, type
-                FROM mbm_mellowroute
-            ) as mellow
-            USING(osm_id)
         """
 
-    def _build_bbox_query(self, source_vertex_id, target_vertex_id):
+    def _build_prepared_route_query(self, use_bbox=True):
+        """Build the SQL query of `_build_route_query` for a prepared
+        statement, where `$1` and `$2` are the source and target vertex and,
+        if `use_bbox`, `$3` is the buffer scale.
+
+        pgRouting plans the edge query that it's passed on every call, so it
+        can't take parameters of its own. Instead, the bounding box is
+        computed in the statement and formatted into the edge query as
+        numbers, which keeps the query that pgRouting plans small.
+        """
+        if not use_bbox:
+            return """
+                SELECT
+                    path.seq,
+                    path.edge AS edge_id,
+                    NULL::float8 AS bbox_buffer_ft
+                FROM pgr_dijkstra(
+                    'SELECT gid AS id, source, target, cost, reverse_cost FROM mbm_routingedge',
+                    $1::bigint,
+                    $2::bigint
+                ) AS path
+            """
+
+        # See _build_route_query for why paths are queried separately
+        return f"""
+            WITH bbox AS (
+                {self._bbox_query_sql('$1', '$2', '$3')}
+            )
+            SELECT
+                path.seq,
+                path.edge AS edge_id,
+                bbox.buffer_ft AS bbox_buffer_ft
+            FROM bbox
+            CROSS JOIN LATERAL pgr_dijkstra(
+                format(
+                    $edges$
+                        SELECT edge.gid AS id, edge.source, edge.target, edge.cost, edge.reverse_cost
+                        FROM mbm_routingedge AS edge
+                        WHERE edge.the_geom && ST_MakeEnvelope(%1$s, %2$s, %3$s, %4$s, 4326)
+                        UNION
+                        SELECT edge.gid AS id, edge.source, edge.target, edge.cost, edge.reverse_cost
+                        FROM mbm_routingedge AS edge
+                        WHERE edge.type = 'path'
+                    $edges$,
+                    ST_XMin(bbox.geom),
+                    ST_YMin(bbox.geom),
+                    ST_XMax(bbox.geom),
+                    ST_YMax(bbox.geom)
+                ),
+                $1::bigint,
+                $2::bigint
+            ) AS path
+        """
+
+    def _build_bbox_query(self, source_vertex_id, target_vertex_id, buffer_scale=1):
         """Get a SQL query that returns a buffered bounding box geometry
-        around two points `source_vertex_id` and `target_vertex_id`.
+        around two points `source_vertex_id` and `target_vertex_id`, along
+        with the size of its buffer in feet.
 
         The size of the buffer is determined by whichever of these two values
-        is smaller:
+        is smaller, multiplied by `buffer_scale`:
 
             - 1/2 the distance between source and target
-            - 2 miles
+            - BBOX_MAX_BUFFER_FT (2 miles)
         """
         assert isinstance(source_vertex_id, int)
         assert isinstance(target_vertex_id, int)
+        assert isinstance(buffer_scale, (int, float))
 
+        return self._bbox_query_sql(source_vertex_id, target_vertex_id, buffer_scale)
+
+    def _bbox_query_sql(self, source_sql, target_sql, scale_sql):
+        """Build the query of `_build_bbox_query` from SQL expressions for
+        the source and target vertex and the buffer scale."""
         return f"""
             -- Cast source and target vertices to IL East CRS for more
             -- precise measurements
             WITH source_vertex AS (
                 SELECT id, ST_Transform(the_geom, {IL_EAST_CRS}) AS the_geom
                 FROM chicago_ways_vertices_pgr
-                WHERE id = {source_vertex_id}
+                WHERE id = {source_sql}
             ),
             target_vertex AS (
                 SELECT id, ST_Transform(the_geom, {IL_EAST_CRS}) AS the_geom
                 FROM chicago_ways_vertices_pgr
-                WHERE id = {target_vertex_id}
+                WHERE id = {target_sql}
             ),
             combined_vertex AS (
                 SELECT * FROM source_vertex
@@ -387,122 +1276,770 @@ class Route(APIView):
                         ST_Envelope(
                             ST_Collect(vertex.the_geom)
                         ),
-                        LEAST(dist.ft / 2, 2 * 5280)
+                        LEAST(dist.ft / 2, {BBOX_MAX_BUFFER_FT}) * {scale_sql}
                     ),
                     4326
-                ) AS geom
+                ) AS geom,
+                LEAST(dist.ft / 2, {BBOX_MAX_BUFFER_FT}) * {scale_sql} AS buffer_ft
             FROM combined_vertex AS vertex
             CROSS JOIN vertex_dist AS dist
             GROUP BY dist.ft
         """
 
-    def _execute_bbox_query(self, source_vertex_id, target_vertex_id):
-        """Get a GeoJSON feature representing the buffered bounding geometry
-        around two points `source_vertex_id` and `target_vertex_id`."""
-        assert isinstance(source_vertex_id, int)
-        assert isinstance(target_vertex_id, int)
-
-        route_bbox_sql = self._build_bbox_query(
-            source_vertex_id,
-            target_vertex_id
+    def get_search_bounds(self, vertex_pairs):
+        """Return a list with the `(min_lng, min_lat, max_lng, max_lat)` box
+        that a route is searched for in once its bounding box has been
+        expanded as far as it goes, for each `(source_vertex_id,
+        target_vertex_id)` pair in `vertex_pairs`, or None if either vertex no
+        longer exists.
+
+        Like the bounding box search itself, this assumes that changes
+        outside of the box don't change the route."""
+        bbox_sql = self._bbox_query_sql(
+            'pair.source',
+            'pair.target',
+            BBOX_EXPANSION_FACTOR ** BBOX_MAX_EXPANSIONS
         )
-        query_sql = f"""
-            SELECT ST_AsGeoJSON(bbox.geom) AS geometry
-            FROM (
-                {route_bbox_sql}
-            ) AS bbox
-        """
         with connection.cursor() as cursor:
-            cursor.execute(query_sql)
-            rows = fetchall(cursor)
+            cursor.execute(f"""
+                SELECT
+                    pair.idx,
+                    ST_XMin(bbox.geom),
+                    ST_YMin(bbox.geom),
+                    ST_XMax(bbox.geom),
+                    ST_YMax(bbox.geom)
+                FROM UNNEST(%s::bigint[], %s::bigint[])
+                    WITH ORDINALITY AS pair(source, target, idx)
+                CROSS JOIN LATERAL ({bbox_sql}) AS bbox
+            """, [
+                [source for source, _ in vertex_pairs],
+                [target for _, target in vertex_pairs]
+            ])
+            rows = cursor.fetchall()
+
+        bounds = [None] * len(vertex_pairs)
+        for idx, *box in rows:
+            bounds[idx - 1] = tuple(box)
+        return bounds
+
+
+class RouteMatrix(Route):
+    """
+    Distances and travel times between every pair of a list of origins and a
+    list of destinations, using the same cost model as `Route` but without
+    returning any geometry.
+
+    Accepts either a GET request with `origins` and `destinations` arguments
+    of the form `lng,lat;lng,lat;...`, or a POST request with a JSON body like
+    `{"origins": [[lng, lat], ...], "destinations": [[lng, lat], ...]}`. The
+    response is streamed back one origin row at a time, with distances in
+    meters and times in minutes, or null where no route exists.
+    """
+    # Maximum number of origins or destinations per request
+    max_locations = 1000
+    # Number of origins to route in each many-to-many pgRouting query
+    origin_batch_size = 25
 
-        if not rows or not rows[0]["geometry"]:
+    def get(self, request):
+        origins = self.get_coord_list(request.GET.get('origins'), 'origins')
+        destinations = self.get_coord_list(request.GET.get('destinations'), 'destinations')
+        return self.get_matrix_response(origins, destinations)
+
+    def post(self, request):
+        origins = self.get_coord_list(request.data.get('origins'), 'origins')
+        destinations = self.get_coord_list(request.data.get('destinations'), 'destinations')
+        return self.get_matrix_response(origins, destinations)
+
+    def get_coord_list(self, value, key):
+        """Parse a list of coordinates from either a string of the form
+        `lng,lat;lng,lat` or a list of `[lng, lat]` pairs."""
+        if not value:
+            raise ParseError('Request is missing required key: %s' % key)
+        if isinstance(value, str):
+            value = value.split(';')
+        if not isinstance(value, list):
+            raise ParseError("Request argument '%s' must be a list of coordinates" % key)
+        if len(value) > self.max_locations:
             raise ParseError(
-                "Could not find bounding box around vertices "
-                f"{source_vertex_id} and {target_vertex_id}"
+                "Request argument '%s' can have at most %d coordinates" % (key, self.max_locations)
             )
+        return [
+            self.parse_coord(
+                ','.join(str(part) for part in coord) if isinstance(coord, list) else str(coord),
+                key
+            )
+            for coord in value
+        ]
 
-        bbox_geojson_str = rows[0]["geometry"]
+    def get_matrix_response(self, origins, destinations):
+        # Snap before we start streaming, so that bad input can still produce
+        # an error response
+        origin_vertex_ids = self.get_nearest_vertex_ids(origins)
+        destination_vertex_ids = self.get_nearest_vertex_ids(destinations)
 
-        return {
-            "type": "Feature",
-            "geometry": json.loads(bbox_geojson_str),
-            "properties": {
-                "name": "Bounding box",
-                "type": "bbox"
-            }
-        }
+        def stream():
+            yield '{"origin_vertex_ids": %s, "destination_vertex_ids": %s, "rows": [' % (
+                json.dumps(origin_vertex_ids),
+                json.dumps(destination_vertex_ids),
+            )
+            rows = self.get_matrix_rows(origin_vertex_ids, destination_vertex_ids)
+            for idx, lengths in enumerate(rows):
+                distances = [lengths.get(vertex_id) for vertex_id in destination_vertex_ids]
+                row = {
+                    'distances_m': [
+                        None if dist is None else round(dist, 1)
+                        for dist in distances
+                    ],
+                    'times_min': [
+                        None if dist is None else round(self.get_minutes(dist), 1)
+                        for dist in distances
+                    ],
+                }
+                yield (', ' if idx else '') + json.dumps(row)
+            yield ']}'
+
+        return StreamingHttpResponse(stream(), content_type='application/json')
+
+    def get_minutes(self, dist_in_meters):
+        return dist_in_meters / METERS_PER_MILE / BIKE_SPEED_MPH * 60
+
+    def get_matrix_rows(self, origin_vertex_ids, destination_vertex_ids):
+        """Yield a dict for each origin mapping destination vertex IDs to the
+        length in meters of the route between them."""
+        destinations = set(destination_vertex_ids)
+        if settings.ROUTING_BACKEND in ('memory', 'ch'):
+            graph = get_graph()
+            for origin in origin_vertex_ids:
+                yield graph.path_lengths(origin, destinations)
+            return
+
+        for start in range(0, len(origin_vertex_ids), self.origin_batch_size):
+            batch = origin_vertex_ids[start:start + self.origin_batch_size]
+            lengths = self._execute_matrix_query(batch, destinations)
+            for origin in batch:
+                row = lengths.get(origin, {})
+                if origin in destinations:
+                    row[origin] = 0.0
+                yield row
+
+    def _execute_matrix_query(self, origin_vertex_ids, destination_vertex_ids):
+        """Run a many-to-many pgRouting query and return a dict mapping each
+        origin vertex ID to a dict of destination vertex IDs and route
+        lengths."""
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT
+                    path.start_vid,
+                    path.end_vid,
+                    SUM(edge.length_m) AS length_m
+                FROM pgr_dijkstra(
+                    'SELECT gid AS id, source, target, cost, reverse_cost
+                    FROM mbm_routingedge',
+                    %s::bigint[],
+                    %s::bigint[]
+                ) AS path
+                JOIN mbm_routingedge AS edge
+                ON path.edge = edge.gid
+                GROUP BY path.start_vid, path.end_vid
+            """, [sorted(set(origin_vertex_ids)), sorted(destination_vertex_ids)])
+            rows = cursor.fetchall()
+
+        lengths = {}
+        for origin, destination, length in rows:
+            lengths.setdefault(origin, {})[destination] = length
+        return lengths
+
+
+class Isochrone(Route):
+    """
+    The streets that can be ridden from a point within a number of minutes,
+    along the same mellow routes that `Route` would take.
+
+    Takes a `source` of the form `lat,lng`, like `Route`, and `minutes`, a
+    comma-separated list of time limits. The response has a GeoJSON feature
+    for each limit, found in a single search out to the largest one. With
+    `geometry=edges`, the default, each feature collects the edges that
+    were first reached within its limit, so that the features don't
+    overlap. With `geometry=hull`, each is a concave hull around every edge
+    that can be reached within its limit.
+    """
+    default_minutes = (5, 10, 15)
+    max_minutes = 60
+    max_limits = 6
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.timer = metrics.StageTimer(ISOCHRONE_STAGE_SECONDS)
 
-    def format_distance(self, dist_in_meters):
+    def get(self, request):
+        source_coord = self.get_coord_from_request(request, 'source')
+        minutes = self.get_minutes_from_request(request)
+        geometry = request.GET.get('geometry', 'edges')
+        if geometry not in ('edges', 'hull'):
+            raise ParseError("Request argument 'geometry' must be one of: edges, hull")
+
+        with self.timer.stage('snap_source'):
+            source_vertex_id = self.get_nearest_vertex_id(source_coord)
+        with self.timer.stage('reachability'):
+            source_vertex_id = self.ensure_in_main_component(source_coord, source_vertex_id)
+
+        isochrone = self.get_cached_isochrone(source_vertex_id, minutes, hull=geometry == 'hull')
+
+        with self.timer.stage('render'):
+            response_json = json.dumps({
+                'source': source_coord,
+                'source_vertex_id': source_vertex_id,
+            }, separators=(',', ':'))
+            response = HttpResponse(
+                response_json[:-1] + ',"isochrone":' + isochrone + '}',
+                content_type='application/json'
+            )
+        response['Server-Timing'] = self.timer.header()
+        return response
+
+    def get_minutes_from_request(self, request):
+        """Parse the sorted, distinct time limits from the `minutes`
+        argument."""
+        value = request.GET.get('minutes')
+        if value is None:
+            return list(self.default_minutes)
+        try:
+            minutes = sorted({float(limit) for limit in value.split(',')})
+        except ValueError:
+            raise ParseError("Request argument 'minutes' must be a comma-separated list of numbers")
+        if len(minutes) > self.max_limits:
+            raise ParseError(f"Request argument 'minutes' can have at most {self.max_limits} limits")
+        if not all(0 < limit <= self.max_minutes for limit in minutes):
+            raise ParseError(f"Request argument 'minutes' must be between 0 and {self.max_minutes}")
+        return [int(limit) if limit.is_integer() else limit for limit in minutes]
+
+    def ensure_in_main_component(self, coord, vertex_id):
+        """Re-snap `vertex_id` to the main street network if it's on an
+        island of its own, from which hardly anything can be reached. If the
+        components haven't been built, this is a no-op."""
+        components = VertexComponent.for_vertices(vertex_id)
+        if vertex_id in components and components[vertex_id][0] != VertexComponent.MAIN_COMPONENT:
+            return self.get_nearest_vertex_id(coord, strong_component=VertexComponent.MAIN_COMPONENT)
+        return vertex_id
+
+    def get_meters(self, minutes):
+        return minutes / 60 * BIKE_SPEED_MPH * METERS_PER_MILE
+
+    def get_reach_bounds(self, sources):
+        """Return a list with the `(min_lng, min_lat, max_lng, max_lat)` box
+        around each `(source_vertex_id, minutes)` pair in `sources` that
+        contains every edge an isochrone out to `minutes` can reach, or None
+        if the vertex no longer exists. Routes are never shorter than the
+        straight line, so the box extends `get_meters(minutes)` from the
+        vertex in every direction."""
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT
+                    source.idx,
+                    ST_XMin(box.geom),
+                    ST_YMin(box.geom),
+                    ST_XMax(box.geom),
+                    ST_YMax(box.geom)
+                FROM UNNEST(%s::bigint[], %s::float8[])
+                    WITH ORDINALITY AS source(vertex_id, meters, idx)
+                JOIN chicago_ways_vertices_pgr AS vert
+                ON vert.id = source.vertex_id
+                CROSS JOIN LATERAL (
+                    -- Expand in IL East CRS, which is measured in feet
+                    SELECT ST_Transform(
+                        ST_Expand(
+                            ST_Transform(vert.the_geom, {IL_EAST_CRS}),
+                            source.meters / {METERS_PER_MILE} * 5280
+                        ),
+                        4326
+                    ) AS geom
+                ) AS box
+            """, [
+                [vertex_id for vertex_id, _ in sources],
+                [self.get_meters(minutes) for _, minutes in sources]
+            ])
+            rows = cursor.fetchall()
+
+        bounds = [None] * len(sources)
+        for idx, *box in rows:
+            bounds[idx - 1] = tuple(box)
+        return bounds
+
+    def get_cached_isochrone(self, source_vertex_id, minutes, hull=False):
+        """Return the result of `get_isochrone` from the isochrone cache,
+        computing and caching it on a miss. Like routes, entries are keyed on
+        the current version of the mellow data."""
+        with self.timer.stage('cache'):
+            version = DataVersion.get(DataVersion.MELLOW)
+            cache_key = (source_vertex_id, tuple(minutes), hull, version)
+            isochrone = isochrone_cache.get(cache_key)
+        if isochrone is None:
+            isochrone = self.get_isochrone(source_vertex_id, minutes, hull=hull)
+            isochrone_cache.set(cache_key, isochrone)
+        return isochrone
+
+    def get_isochrone(self, source_vertex_id, minutes, hull=False):
+        """Search for the edges that can be reached from `source_vertex_id`
+        within the largest of `minutes`, and return the GeoJSON feature
+        collection for every limit, serialized as a JSON string.
+
+        With the `pgrouting` backend, the search runs in Postgres as part of
+        the query that builds the feature collection."""
+        max_length = self.get_meters(max(minutes))
+        limit_params = [minutes, [self.get_meters(limit) for limit in minutes]]
+        in_process = settings.ROUTING_BACKEND in ('memory', 'ch')
+        if in_process:
+            with self.timer.stage('search'):
+                reached = get_graph().reachable_edges(source_vertex_id, max_length)
+            params = [list(reached.keys()), list(reached.values())] + limit_params
+        else:
+            params = [source_vertex_id, max_length] + limit_params
+
+        with self.timer.stage('isochrone_query'):
+            with connection.cursor() as cursor:
+                cursor.execute(self._build_isochrone_query(hull, search=not in_process), params)
+                return cursor.fetchone()[0]
+
+    def _build_isochrone_search_sql(self):
         """
-        Given a distance in meters, return a tuple (distance, time)
-        where `distance` is a string representing a distance in miles and
-        `time` is a string representing an estimated travelime in minutes.
+        Build the CTEs that search for the edges that can be reached from a
+        vertex in Postgres, ending with `reached`, which has the gid of every
+        edge that can be ridden in full and the length of the ride to its
+        far end. They take the source vertex and the longest ride in meters.
+
+        `pgr_drivingDistance` finds the tree of cheapest paths from the
+        source, over just the edges within reach of it. Since it's bounded by
+        cost rather than length, it's given the cost of the longest ride if
+        it were all at full cost: edge costs are their length in degrees,
+        scaled down by the mellow multipliers, and a meter is at most
+        `1 / (METERS_PER_DEGREE * cos(lat))` degrees. The length of the ride
+        to each vertex is then summed down the tree, pruning branches that
+        run past the longest ride, like `RoutingGraph.reachable_edges` does.
+        """
+        return f"""
+            search AS (
+                SELECT
+                    vert.id AS vertex_id,
+                    params.max_length,
+                    ST_Expand(
+                        vert.the_geom,
+                        params.max_length / ({METERS_PER_DEGREE} * cos(radians(ST_Y(vert.the_geom)))),
+                        params.max_length / {METERS_PER_DEGREE}
+                    ) AS geom,
+                    params.max_length / ({METERS_PER_DEGREE} * cos(radians(
+                        ABS(ST_Y(vert.the_geom)) + params.max_length / {METERS_PER_DEGREE}
+                    ))) AS max_cost
+                FROM (SELECT %s::bigint AS vertex_id, %s::float8 AS max_length) AS params
+                JOIN chicago_ways_vertices_pgr AS vert
+                ON vert.id = params.vertex_id
+            ),
+            tree AS (
+                SELECT
+                    dd.node,
+                    CASE WHEN edge.source = dd.node THEN edge.target ELSE edge.source END AS parent,
+                    edge.length_m
+                FROM search
+                CROSS JOIN LATERAL pgr_drivingDistance(
+                    format(
+                        $edges$
+                            SELECT gid AS id, source, target, cost, reverse_cost
+                            FROM mbm_routingedge
+                            WHERE the_geom && ST_MakeEnvelope(%%1$s, %%2$s, %%3$s, %%4$s, 4326)
+                        $edges$,
+                        ST_XMin(search.geom),
+                        ST_YMin(search.geom),
+                        ST_XMax(search.geom),
+                        ST_YMax(search.geom)
+                    ),
+                    search.vertex_id,
+                    search.max_cost
+                ) AS dd
+                JOIN mbm_routingedge AS edge
+                ON edge.gid = dd.edge
+            ),
+            rides AS (
+                SELECT vertex_id AS node, 0::float8 AS length_m
+                FROM search
+                UNION ALL
+                SELECT tree.node, rides.length_m + tree.length_m
+                FROM rides
+                JOIN tree
+                ON tree.parent = rides.node
+                CROSS JOIN search
+                WHERE rides.length_m + tree.length_m <= search.max_length
+            ),
+            reached AS (
+                SELECT arcs.edge_id, MIN(arcs.length_m) AS length_m
+                FROM (
+                    SELECT edge.gid AS edge_id, rides.length_m + edge.length_m AS length_m
+                    FROM rides
+                    JOIN mbm_routingedge AS edge
+                    ON edge.source = rides.node AND edge.cost >= 0
+                    UNION ALL
+                    SELECT edge.gid AS edge_id, rides.length_m + edge.length_m AS length_m
+                    FROM rides
+                    JOIN mbm_routingedge AS edge
+                    ON edge.target = rides.node AND edge.reverse_cost >= 0
+                ) AS arcs
+                CROSS JOIN search
+                WHERE arcs.length_m <= search.max_length
+                GROUP BY arcs.edge_id
+            )
         """
-        meters_per_mi = 1609.344
-        dist_in_mi = dist_in_meters / meters_per_mi
-        formatted_dist = round(dist_in_mi, 1)
-        # Don't worry about single-mile case since we always report at least
-        # one decimal (i.e. "1.0 miles")
-        dist_unit_str = 'miles'
-        distance = f'{formatted_dist} {dist_unit_str}'
 
-        # Assume 8mph as a naive guess of speed
-        mi_per_min = 10 / 60
-        time_in_min = dist_in_mi / mi_per_min
-        formatted_time = '<1' if time_in_min < 1 else str(round(time_in_min))
-        time_unit_str = 'minute' if formatted_time in ['<1', '1'] else 'minutes'
-        time = f'{formatted_time} {time_unit_str}'
+    def _build_isochrone_query(self, hull=False, search=False):
+        """
+        Build a SQL query that serializes the edges reached by a search to a
+        GeoJSON feature collection, with one feature per time limit.
+
+        The query takes arrays of the gids of the reached edges and the
+        length of the ride to the far end of each, or if `search`, the
+        parameters of `_build_isochrone_search_sql` to search for them
+        itself. These are followed by arrays of the time limits and the
+        length that can be ridden within each.
+        """
+        if search:
+            reached_sql = 'RECURSIVE ' + self._build_isochrone_search_sql()
+        else:
+            reached_sql = """
+                reached AS (
+                    SELECT *
+                    FROM UNNEST(%s::bigint[], %s::float8[]) AS reached(edge_id, length_m)
+                )
+            """
 
-        return distance, time
+        if hull:
+            geometry_sql = f'ST_ConcaveHull(ST_Collect(edge.the_geom), {ISOCHRONE_HULL_TARGET_PERCENT})'
+            band_sql = ''
+        else:
+            geometry_sql = 'ST_Collect(edge.the_geom)'
+            band_sql = 'AND reached.length_m > limits.previous_length_m'
 
-    def get_major_streets(self, rows, total_length):
-        min_percentage = 0.2 # minimum percentage of the total length of the route that a street must cover to be considered major
-        max_results = 3
+        return f"""
+            WITH {reached_sql},
+            limits AS (
+                SELECT
+                    minutes,
+                    length_m,
+                    LAG(length_m, 1, -1::float8) OVER (ORDER BY length_m) AS previous_length_m
+                FROM UNNEST(%s::float8[], %s::float8[]) AS limits(minutes, length_m)
+            ),
+            features AS (
+                SELECT
+                    limits.minutes,
+                    json_build_object(
+                        'type', 'Feature',
+                        'geometry', ST_AsGeoJSON({geometry_sql}, {COMPACT_PRECISION})::json,
+                        'properties', json_build_object(
+                            'minutes', limits.minutes,
+                            'edges', COUNT(edge.gid)
+                        )
+                    ) AS feature
+                FROM limits
+                LEFT JOIN reached
+                ON reached.length_m <= limits.length_m
+                {band_sql}
+                LEFT JOIN mbm_routingedge AS edge
+                ON edge.gid = reached.edge_id
+                GROUP BY limits.minutes, limits.length_m
+            )
+            SELECT json_build_object(
+                'type', 'FeatureCollection',
+                'features', json_agg(feature ORDER BY minutes)
+            )::text
+            FROM features
+        """
 
-        if not total_length:
-            return []
 
-        per_street_lengths = {}
-        for row in rows:
-            name = row.get('name')
-            length = row.get('length_m') or 0
-            if not name:
-                continue
-            per_street_lengths[name] = per_street_lengths.get(name, 0) + length
+class AsyncRoute(Route):
+    """
+    The same route as `Route`, for the async route API. The source and
+    target are snapped at the same time, and queries go through the async
+    connection pool of the event loop rather than Django's connection, so
+    that a single process can wait on many route queries at once. Searches
+    with the in-process graph or contraction hierarchy, and the vertex index,
+    run in a thread, since they load their data through Django.
+    """
+    async def get(self, request):
+        source_coord = self.get_coord_from_request(request, 'source')
+        target_coord = self.get_coord_from_request(request, 'target')
+        options = self.get_route_options(request)
 
-        threshold = total_length * min_percentage
-        qualifying = [
-            (name, length)
-            for name, length in per_street_lengths.items()
-            if length > threshold
-        ]
-        qualifying.sort(key=lambda item: (-item[1], item[0]))
+        with self.timer.stage('snap'):
+            source_vertex_id, target_vertex_id = await asyncio.gather(
+                self.get_nearest_vertex_id_async(source_coord),
+                self.get_nearest_vertex_id_async(target_coord)
+            )
 
-        return [name for name, _ in qualifying[:max_results]]
+        with self.timer.stage('reachability'):
+            source_vertex_id, target_vertex_id = await self.ensure_reachable_async(
+                source_coord,
+                source_vertex_id,
+                target_coord,
+                target_vertex_id
+            )
+
+        route = await self.get_cached_route_async(source_vertex_id, target_vertex_id, **options)
+        return self.render_route(
+            source_coord,
+            target_coord,
+            source_vertex_id,
+            target_vertex_id,
+            route
+        )
+
+    async def get_nearest_vertex_id_async(self, coord, strong_component=None):
+        """Async version of `get_nearest_vertex_id`."""
+        if settings.SNAPPING_BACKEND == 'memory':
+            # The vertex index is loaded under a lock and only read after
+            # that, so concurrent requests can snap in separate threads
+            return await sync_to_async(self.get_nearest_vertex_id, thread_sensitive=False)(
+                coord,
+                strong_component=strong_component
+            )
+
+        row = await get_pool().fetchone(*self._build_nearest_vertex_query(coord, strong_component))
+        if row is None:
+            raise ParseError('No vertex found near point %s' % ','.join(coord))
+        return row[0]
+
+    async def ensure_reachable_async(
+        self,
+        source_coord,
+        source_vertex_id,
+        target_coord,
+        target_vertex_id
+    ):
+        """Async version of `ensure_reachable`, which re-snaps the source and
+        target at the same time if they both need it."""
+        if source_vertex_id == target_vertex_id:
+            return source_vertex_id, target_vertex_id
+
+        rows = await get_pool().fetchall("""
+            SELECT vertex_id, strong_component, weak_component
+            FROM mbm_vertexcomponent
+            WHERE vertex_id = ANY(%s::bigint[])
+        """, [[source_vertex_id, target_vertex_id]])
+        resnap_source, resnap_target = self._resnaps_needed(
+            {vertex_id: (strong, weak) for vertex_id, strong, weak in rows},
+            source_vertex_id,
+            target_vertex_id
+        )
 
+        async def resnap(coord, vertex_id, needed):
+            if not needed:
+                return vertex_id
+            return await self.get_nearest_vertex_id_async(
+                coord,
+                strong_component=VertexComponent.MAIN_COMPONENT
+            )
 
-class MellowRouteList(LoginRequiredMixin, ListView):
+        source_vertex_id, target_vertex_id = await asyncio.gather(
+            resnap(source_coord, source_vertex_id, resnap_source),
+            resnap(target_coord, target_vertex_id, resnap_target)
+        )
+        return source_vertex_id, target_vertex_id
+
+    async def get_cached_route_async(
+        self,
+        source_vertex_id,
+        target_vertex_id,
+        show_bbox=False,
+        compact=False,
+        polyline=False
+    ):
+        """Async version of `get_cached_route`."""
+        with self.timer.stage('cache'):
+            row = await get_pool().fetchone(
+                'SELECT version FROM mbm_dataversion WHERE name = %s',
+                [DataVersion.MELLOW]
+            )
+            version = row[0] if row else 0
+            cache_key = (source_vertex_id, target_vertex_id, show_bbox, compact, polyline, version)
+            route = route_cache.get(cache_key)
+        if route is None:
+            route, shared = await async_route_flights.do(
+                cache_key,
+                lambda: self._get_uncached_route_async(cache_key)
+            )
+            if shared:
+                ROUTE_REQUESTS_COALESCED.inc(scope='process')
+        return route
+
+    async def _get_uncached_route_async(self, cache_key):
+        """Async version of `_get_uncached_route`, which only coalesces
+        requests within this process."""
+        source_vertex_id, target_vertex_id, show_bbox, compact, polyline, _ = cache_key
+        route = await self.get_route_async(
+            source_vertex_id,
+            target_vertex_id,
+            show_bbox=show_bbox,
+            compact=compact,
+            polyline=polyline
+        )
+        route_cache.set(cache_key, route)
+        return route
+
+    async def get_route_async(
+        self,
+        source_vertex_id,
+        target_vertex_id,
+        show_bbox=False,
+        compact=False,
+        polyline=False
+    ):
+        """Async version of `get_route`."""
+        assert isinstance(source_vertex_id, int)
+        assert isinstance(target_vertex_id, int)
+
+        options = {'show_bbox': show_bbox, 'compact': compact, 'polyline': polyline}
+
+        if settings.ROUTING_BACKEND in ('memory', 'ch'):
+            with self.timer.stage('graph_search'):
+                # Like the vertex index, the graphs are safe to search from
+                # several threads at once
+                edge_ids = await sync_to_async(self._search_graph, thread_sensitive=False)(
+                    source_vertex_id,
+                    target_vertex_id
+                )
+            if edge_ids:
+                with self.timer.stage('route_query'):
+                    route, num_edges = await self._execute_route_document_query_async(
+                        self.EDGE_PATH_SQL,
+                        [list(edge_ids)],
+                        bbox_expansions=None,
+                        **options
+                    )
+                ROUTE_SEARCHES.inc(outcome='graph')
+                ROUTE_EDGES.observe(num_edges)
+                return route
+
+        for expansion in range(BBOX_MAX_EXPANSIONS + 1):
+            with self.timer.stage('bbox_query'):
+                route, num_edges = await self._execute_route_query_async(
+                    source_vertex_id,
+                    target_vertex_id,
+                    use_bbox=True,
+                    buffer_scale=BBOX_EXPANSION_FACTOR ** expansion,
+                    bbox_expansions=expansion,
+                    **options
+                )
+            if num_edges:
+                ROUTE_SEARCHES.inc(outcome='bbox_expanded' if expansion else 'bbox_hit')
+                ROUTE_EDGES.observe(num_edges)
+                return route
+
+        with self.timer.stage('fallback_query'):
+            route, num_edges = await self._execute_route_query_async(
+                source_vertex_id,
+                target_vertex_id,
+                use_bbox=False,
+                bbox_expansions=BBOX_MAX_EXPANSIONS + 1,
+                **options
+            )
+        ROUTE_SEARCHES.inc(outcome='fallback')
+        ROUTE_EDGES.observe(num_edges)
+        return route
+
+    async def _execute_route_query_async(
+        self,
+        source_vertex_id,
+        target_vertex_id,
+        use_bbox=True,
+        buffer_scale=1,
+        bbox_expansions=0,
+        show_bbox=False,
+        compact=False,
+        polyline=False
+    ):
+        """Async version of `_execute_route_query`."""
+        path_sql, bbox_sql = self._build_search_queries(
+            source_vertex_id,
+            target_vertex_id,
+            use_bbox=use_bbox,
+            buffer_scale=buffer_scale,
+            show_bbox=show_bbox
+        )
+        return await self._execute_route_document_query_async(
+            path_sql,
+            [source_vertex_id, target_vertex_id],
+            bbox_sql=bbox_sql,
+            bbox_expansions=bbox_expansions,
+            used_bbox=use_bbox,
+            show_bbox=show_bbox,
+            compact=compact,
+            polyline=polyline
+        )
+
+    async def _execute_route_document_query_async(self, path_sql, params, **kwargs):
+        """Async version of `_execute_route_document_query`."""
+        row = await get_pool().fetchone(
+            *self._route_document_query_args(path_sql, params, **kwargs)
+        )
+        return self._route_from_row(row)
+
+
+def async_api_view(view):
+    """
+    Wrap an async view of the route API to turn request errors into JSON
+    responses like the ones that DRF sends for the sync views.
+    """
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            return await view(request, *args, **kwargs)
+        except ParseError as e:
+            return JsonResponse({'detail': e.detail}, status=e.status_code)
+    return wrapper
+
+
+@async_api_view
+async def async_route(request):
+    """`/api/route/` as an async view, for ASGI servers."""
+    return await AsyncRoute().get(request)
+
+
+@async_api_view
+async def async_route_list(request):
+    """`/api/routes/` as an async view, for ASGI servers."""
+    view = RouteList()
+    bbox = view.get_bbox_from_request(request)
+    zoom = view.get_zoom_from_request(request)
+
+    async def compute():
+        rows = await get_pool().fetchall(*MellowRoute.all_query(bbox=bbox, zoom=zoom))
+        return MellowRoute.all_from_rows(rows)
+
+    routes = await get_versioned_async(
+        f'route-list:{bbox}:{zoom}',
+        compute,
+        bounds=bbox,
+        timeout=ROUTE_LIST_CACHE_TIMEOUT
+    )
+    response = JsonResponse(routes)
+    patch_cache_control(response, public=True, max_age=BROWSER_CACHE_MAX_AGE)
+    return response
+
+
+# How long to cache the neighborhood overview, in seconds. It's checked
+# against the mellow data version, so any edit to a neighborhood rebuilds it.
+NEIGHBORHOOD_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+class MellowRouteList(LoginRequiredMixin, TemplateView):
     title = 'Neighborhoods'
     model = MellowRoute
-    queryset = MellowRoute.objects.values('name', 'slug').distinct('name', 'slug')
     template_name = 'mbm/mellow_route_list.html'
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
-        context['neighborhoods'] = json.dumps({
-            'type': 'FeatureCollection',
-            'features': [
-                {
-                    'type': 'Feature',
-                    'geometry': json.loads(way.bounding_box.json),
-                    'properties': {
-                        'name': way.name
-                    }
-                }
-                for way in self.model.objects.all()
-            ]
-        })
+        overview = get_versioned(
+            'neighborhoods',
+            MellowRoute.neighborhoods,
+            timeout=NEIGHBORHOOD_CACHE_TIMEOUT
+        )
+        context['neighborhoods'] = [feature['properties'] for feature in overview['features']]
+        context['neighborhoods_json'] = json.dumps(overview)
         return context
 
 
@@ -514,8 +2051,12 @@ class MellowRouteCreate(LoginRequiredMixin, CreateView):
     success_url = reverse_lazy('mellow-route-list')
 
     def form_valid(self, form):
+        # Save the routes and refresh the data derived from them once, in one
+        # transaction
+        with batched_refresh():
+            response = super().form_valid(form)
         messages.success(self.request, 'Neighborhood created.')
-        return super().form_valid(form)
+        return response
 
 
 class MellowRouteEdit(LoginRequiredMixin, UpdateView):
@@ -532,8 +2073,12 @@ class MellowRouteEdit(LoginRequiredMixin, UpdateView):
         )
 
     def form_valid(self, form):
+        # Save the route and refresh the data derived from it in one
+        # transaction
+        with batched_refresh():
+            response = super().form_valid(form)
         messages.success(self.request, 'Neighborhood updated.')
-        return super().form_valid(form)
+        return response
 
 
 class MellowRouteNeighborhoodEdit(LoginRequiredMixin, UpdateView):
@@ -548,12 +2093,16 @@ class MellowRouteNeighborhoodEdit(LoginRequiredMixin, UpdateView):
         return self.model.objects.filter(slug=self.kwargs['slug']).first()
 
     def form_valid(self, form):
-        # Save the data for all MellowRoute types
-        self.model.objects.filter(slug=self.kwargs['slug']).update(
-            name=form.instance.name,
-            slug=form.instance.slug,
-            bounding_box=form.instance.bounding_box
-        )
+        # Save the data for all MellowRoute types. QuerySet.update() doesn't
+        # send save signals, so record the change ourselves. No ways change,
+        # so nothing derived from them needs updating.
+        with transaction.atomic():
+            self.model.objects.filter(slug=self.kwargs['slug']).update(
+                name=form.instance.name,
+                slug=form.instance.slug,
+                bounding_box=form.instance.bounding_box
+            )
+            MellowChange.record([])
         return HttpResponseRedirect(self.success_url)
 
 
@@ -569,8 +2118,10 @@ class MellowRouteDelete(LoginRequiredMixin, DeleteView):
         return self.model.objects.filter(slug=self.kwargs['slug']).first()
 
     def delete(self, request, *args, **kwargs):
-        # Delete all MellowRoutes with this slug, no matter the type
-        self.model.objects.filter(slug=self.kwargs['slug']).delete()
+        # Delete all MellowRoutes with this slug, no matter the type, and
+        # refresh the data derived from them once, in one transaction
+        with batched_refresh():
+            self.model.objects.filter(slug=self.kwargs['slug']).delete()
         messages.success(self.request, 'Neighborhood deleted.')
         return HttpResponseRedirect(self.success_url)
 
@@ -594,6 +2145,23 @@ def pong(request):
     return HttpResponse(DEPLOYMENT_ID)
 
 
+def metrics_view(request):
+    """Serve this process's request metrics in the Prometheus text format, to
+    staff users and to scrapers that send the `METRICS_TOKEN` bearer token."""
+    if not (request.user.is_staff or _has_metrics_token(request)):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _has_metrics_token(request):
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    return bool(
+        settings.METRICS_TOKEN
+        and scheme.lower() == 'bearer'
+        and hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode())
+    )
+
+
 def healthcheck(request):
     """Simple endpoint to test database connectivity."""
     with connection.cursor() as cursor:
@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mbm.settings')
 
 application = get_wsgi_application()
+
+from django.conf import settings  # noqa: E402
+
+if settings.MELLOW_CHANGE_LISTENER:
+    from mbm.listener import start_listener  # noqa: E402
+    start_listener()
@@ -46,6 +46,8 @@ psql -U postgres -d mbm -f $PROJECT_DIR/db/create-extensions.sql
 # every deployment
 export DJANGO_SECRET_KEY=temporarykey DATABASE_URL=postgres:///mbm DJANGO_DEBUG=False
 sudo -H -E -u mbm $VENV_DIR/bin/python $PROJECT_DIR/app/manage.py migrate
+sudo -H -E -u mbm $VENV_DIR/bin/python $PROJECT_DIR/app/manage.py refresh_routing_edges --if-empty
+sudo -H -E -u mbm $VENV_DIR/bin/python $PROJECT_DIR/app/manage.py refresh_simplified_routes --if-empty
 sudo -H -E -u mbm $VENV_DIR/bin/python $PROJECT_DIR/app/manage.py createcachetable
 sudo -H -E -u mbm $VENV_DIR/bin/python $PROJECT_DIR/app/manage.py clear_cache 
 sudo -H -E -u mbm $VENV_DIR/bin/python $PROJECT_DIR/app/manage.py collectstatic --no-input
@@ -0,0 +1,61 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from mbm import aiodb
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_pool_bounds_and_reuses_connections():
+    opened = []
+
+    async def connect(**params):
+        conn = FakeConnection()
+        opened.append(conn)
+        return conn
+
+    async def borrow(pool, peak):
+        async with pool.connection():
+            peak.append(pool.in_use)
+            await asyncio.sleep(0.01)
+
+    async def main():
+        pool = aiodb.Pool(2)
+        peak = []
+        await asyncio.gather(*(borrow(pool, peak) for _ in range(6)))
+        return pool, peak
+
+    with patch.object(aiodb.Connection, 'connect', side_effect=connect):
+        pool, peak = asyncio.run(main())
+
+    assert max(peak) == 2
+    assert len(opened) == 2
+    assert (pool.size, pool.in_use) == (2, 0)
+
+
+def test_pool_closes_connections_that_raised():
+    conn = FakeConnection()
+
+    async def connect(**params):
+        return conn
+
+    async def main():
+        pool = aiodb.Pool(1)
+        with pytest.raises(ValueError):
+            async with pool.connection():
+                raise ValueError
+        return pool
+
+    with patch.object(aiodb.Connection, 'connect', side_effect=connect):
+        pool = asyncio.run(main())
+
+    assert conn.closed
+    assert pool.size == 0
@@ -0,0 +1,83 @@
+import math
+
+from mbm.benchmark import SyntheticCity, TRIP_CLASSES, compare, run_trips, search_outcome, summarize
+from mbm.graph import RoutingGraph
+
+
+def test_synthetic_city_is_strongly_connected():
+    city = SyntheticCity(rows=12, cols=12, arterial_spacing=4, bridge_spacing=5, river_col=6)
+    edges = city.edges()
+    graph = RoutingGraph.from_edges([
+        (edge['gid'], edge['source'], edge['target'], edge['cost'], edge['reverse_cost'], edge['length_m'])
+        for edge in edges
+    ])
+    assert graph.num_vertices == 12 * 12
+    assert set(graph.strong_components().tolist()) == {0}
+
+    # The river can only be crossed at the bridges
+    crossings = {
+        row for row in range(12) for edge in edges
+        if {edge['source'], edge['target']} == {city.vertex_id(row, 6), city.vertex_id(row, 7)}
+    }
+    assert crossings == {0, 5, 10}
+
+
+def test_synthetic_city_mellow_ways():
+    city = SyntheticCity(rows=12, cols=12)
+    ways = city.mellow_ways(city.edges())
+    assert set(ways) == {'street', 'path'}
+    assert all(osm_id < 0 for osm_ids in ways.values() for osm_id in osm_ids)
+
+
+def test_trips_fall_within_their_class():
+    city = SyntheticCity(rows=30, cols=30)
+    trips = city.trips(5, seed=1)
+    # A 30x30 grid is about 6km across, which is too small for cross-city trips
+    assert [trip_class for trip_class, _, _ in trips] == ['short'] * 5 + ['medium'] * 5
+    for trip_class, source, target in trips:
+        (y1, x1), (y2, x2) = (map(float, coord.split(',')) for coord in (source, target))
+        dist = math.hypot((x2 - x1) * 83000, (y2 - y1) * 111000)
+        min_m, max_m = TRIP_CLASSES[trip_class]
+        # Allow for the jitter around each vertex
+        assert min_m - 200 <= dist < max_m + 200
+    assert city.trips(5, seed=1) == trips
+
+
+def test_summarize_reports_percentiles_in_milliseconds():
+    summary = summarize([i / 1000 for i in range(1, 101)])
+    assert summary['count'] == 100
+    assert summary['p50_ms'] == 50.5
+    assert summary['max_ms'] == 100.0
+    assert summarize([]) == {'count': 0}
+
+
+def test_run_trips_groups_by_class_and_search_outcome():
+    trips = [('short', 'a', 'b'), ('medium', 'c', 'd')]
+    expansions = {'a': 0, 'c': 3}
+    cleared = []
+    groups = run_trips(
+        lambda source, target: {'bbox_expansions': expansions[source]},
+        trips,
+        repeat=2,
+        clear_cache=lambda: cleared.append(True),
+    )
+    assert len(cleared) == 4
+    assert groups['all']['count'] == 4
+    assert groups['trip:short']['count'] == 2
+    assert groups['search:bbox_hit']['count'] == 2
+    assert groups['search:fallback']['count'] == 2
+
+
+def test_search_outcome_tells_graph_routes_from_bbox_hits():
+    assert search_outcome({'bbox_expansions': None}) == 'graph'
+    assert search_outcome({'bbox_expansions': 0}) == 'bbox_hit'
+    assert search_outcome({}) == 'unknown'
+
+
+def test_compare_reports_relative_change():
+    baseline = {'groups': {'all': {'p50_ms': 10.0, 'p95_ms': 20.0}}}
+    results = {'groups': {'all': {'p50_ms': 5.0, 'p95_ms': 30.0}, 'trip:short': {'p50_ms': 1.0}}}
+    assert compare(results, baseline) == [
+        ('all', 'p50_ms', 10.0, 5.0, -0.5),
+        ('all', 'p95_ms', 20.0, 30.0, 0.5),
+    ]
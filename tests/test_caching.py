@@ -0,0 +1,212 @@
+import asyncio
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from mbm import caching
+from mbm.caching import LRUCache, carry_over, get_versioned
+from mbm.models import MellowChange
+
+
+def test_lru_cache_evicts_least_recently_used_entry():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats() == {
+        'size': 2,
+        'maxsize': 2,
+        'hits': 3,
+        'misses': 1,
+        'evictions': 1,
+    }
+
+
+def test_lru_cache_with_zero_size_stores_nothing():
+    cache = LRUCache(0)
+    cache.set('a', 1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+class DictCache(dict):
+    def get(self, key, default=None):
+        return super().get(key, default)
+
+    def set(self, key, value, timeout=None):
+        self[key] = value
+
+
+@pytest.fixture
+def site_cache():
+    with patch.object(caching, 'cache', DictCache()) as cache:
+        yield cache
+
+
+def change(version, bounds=None):
+    min_lng, min_lat, max_lng, max_lat = bounds or (None, None, None, None)
+    return MellowChange(
+        version=version,
+        min_lng=min_lng, min_lat=min_lat, max_lng=max_lng, max_lat=max_lat
+    )
+
+
+def test_get_versioned_keeps_values_that_changes_did_not_touch(site_cache):
+    bounds = (0, 0, 1, 1)
+    with patch.object(caching.DataVersion, 'get', return_value=1):
+        assert get_versioned('key', lambda: 'old', bounds=bounds) == 'old'
+
+    changes = [change(2, (5, 5, 6, 6))]
+    with patch.object(caching.DataVersion, 'get', return_value=2), \
+         patch.object(MellowChange, 'since', return_value=changes):
+        assert get_versioned('key', lambda: 'new', bounds=bounds) == 'old'
+    assert site_cache['key'] == (2, 'old')
+
+
+def test_get_versioned_rebuilds_values_that_changes_touched(site_cache):
+    bounds = (0, 0, 1, 1)
+    site_cache['key'] = (1, 'old')
+    changes = [change(2), change(3, (0.5, 0.5, 2, 2))]
+    with patch.object(caching.DataVersion, 'get', return_value=3), \
+         patch.object(MellowChange, 'since', return_value=changes):
+        assert get_versioned('key', lambda: 'new', bounds=bounds) == 'new'
+
+
+def test_get_versioned_rebuilds_when_change_log_is_incomplete(site_cache):
+    site_cache['key'] = (1, 'old')
+    with patch.object(caching.DataVersion, 'get', return_value=3), \
+         patch.object(MellowChange, 'since', return_value=None):
+        assert get_versioned('key', lambda: 'new', bounds=(0, 0, 1, 1)) == 'new'
+
+
+def test_get_versioned_without_bounds_rebuilds_on_any_change(site_cache):
+    site_cache['key'] = (1, 'old')
+    with patch.object(caching.DataVersion, 'get', return_value=2), \
+         patch.object(MellowChange, 'since') as mock_since:
+        assert get_versioned('key', lambda: 'new') == 'new'
+    mock_since.assert_not_called()
+
+
+def test_lru_cache_rekey_keeps_recency():
+    cache = LRUCache(3)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('c', 3)
+    cache.rekey({'a': 'a2', 'b': None})
+
+    assert cache.keys() == ['a2', 'c']
+    cache.set('d', 4)
+    cache.set('e', 5)
+    assert cache.keys() == ['c', 'd', 'e']
+
+
+def test_carry_over_moves_entries_that_changes_did_not_touch():
+    cache = LRUCache(10)
+    cache.set(('near', 1), 'near')
+    cache.set(('far', 1), 'far')
+    cache.set(('gone', 1), 'gone')
+    cache.set(('current', 2), 'current')
+    bounds = {'near': (0, 0, 1, 1), 'far': (5, 5, 6, 6), 'gone': None}
+
+    with patch.object(MellowChange, 'since', return_value=[change(2, (0.5, 0.5, 2, 2))]) as mock_since:
+        carry_over(cache, 2, lambda keys: [bounds[key[0]] for key in keys])
+
+    mock_since.assert_called_once_with(1, 2)
+    assert cache.keys() == [('far', 2), ('current', 2)]
+    assert cache.get(('far', 2)) == 'far'
+
+
+def test_carry_over_drops_everything_when_change_log_is_incomplete():
+    cache = LRUCache(10)
+    cache.set(('far', 1), 'far')
+    with patch.object(MellowChange, 'since', return_value=None):
+        carry_over(cache, 3, lambda keys: [(5, 5, 6, 6)] * len(keys))
+    assert len(cache) == 0
+
+
+def test_single_flight_shares_one_call_between_threads():
+    flights = caching.SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 'value'
+
+    results = []
+
+    def request():
+        results.append(flights.do('key', compute))
+
+    threads = [threading.Thread(target=request) for _ in range(4)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    # Give the other threads time to start waiting on the first one
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(results) == [('value', False)] + [('value', True)] * 3
+    assert len(flights) == 0
+
+
+def test_single_flight_shares_exceptions_and_forgets_failed_calls():
+    flights = caching.SingleFlight()
+
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        flights.do('key', fail)
+    assert flights.do('key', lambda: 'value') == ('value', False)
+
+
+def test_async_single_flight_shares_one_call_between_tasks():
+    flights = caching.AsyncSingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'value'
+
+    async def main():
+        return await asyncio.gather(*(flights.do('key', compute) for _ in range(4)))
+
+    results = asyncio.run(main())
+
+    assert len(calls) == 1
+    assert results == [('value', False)] + [('value', True)] * 3
+    assert len(flights) == 0
+
+
+def test_async_single_flight_retries_when_the_shared_call_is_cancelled():
+    flights = caching.AsyncSingleFlight()
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        return 'value'
+
+    async def main():
+        leader = asyncio.ensure_future(flights.do('key', compute))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.do('key', compute))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(main()) == ('value', False)
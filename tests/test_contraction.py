@@ -0,0 +1,62 @@
+import random
+from unittest.mock import patch
+
+import pytest
+
+from mbm.contraction import ContractionHierarchy, get_contraction_hierarchy
+from mbm.graph import RoutingGraph
+from mbm.models import DataVersion
+
+
+@pytest.fixture(scope='module')
+def grid_graph():
+    """A 15x15 grid with random costs where about a fifth of the edges are
+    one-way."""
+    rng = random.Random(0)
+    size = 15
+    edges = []
+    for i in range(size):
+        for j in range(size):
+            for a, b in ((i + 1, j), (i, j + 1)):
+                if a < size and b < size:
+                    cost = rng.uniform(1, 10)
+                    reverse_cost = -1 if rng.random() < 0.2 else rng.uniform(1, 10)
+                    edges.append((len(edges) + 1, i * size + j, a * size + b, cost, reverse_cost, 100))
+    return RoutingGraph.from_edges(edges)
+
+
+def test_contraction_hierarchy_matches_dijkstra(grid_graph):
+    hierarchy = ContractionHierarchy.build(grid_graph)
+    rng = random.Random(1)
+    for _ in range(200):
+        source = rng.randrange(grid_graph.num_vertices)
+        target = rng.randrange(grid_graph.num_vertices)
+        assert hierarchy.shortest_path(source, target) == grid_graph.shortest_path(source, target)
+
+
+def test_contraction_hierarchy_round_trips_through_file(grid_graph, tmp_path):
+    hierarchy = ContractionHierarchy.build(grid_graph, version=3)
+    path = str(tmp_path / 'ch.npz')
+    hierarchy.save(path)
+
+    loaded = ContractionHierarchy.load(path)
+    assert loaded.version == 3
+    assert loaded.shortest_path(0, 224) == hierarchy.shortest_path(0, 224)
+
+
+def test_contraction_hierarchy_returns_empty_for_unknown_vertices(grid_graph):
+    hierarchy = ContractionHierarchy.build(grid_graph)
+    assert hierarchy.shortest_path(0, 999) == []
+    assert hierarchy.shortest_path(0, 0) == []
+
+
+def test_stale_contraction_hierarchy_is_ignored_and_logged_once(grid_graph, tmp_path, settings, caplog):
+    settings.ROUTING_CH_PATH = str(tmp_path / 'ch.npz')
+    ContractionHierarchy.build(grid_graph, version=3).save(settings.ROUTING_CH_PATH)
+
+    with patch.object(DataVersion, 'get', return_value=3):
+        assert get_contraction_hierarchy().version == 3
+    with patch.object(DataVersion, 'get', return_value=4):
+        assert get_contraction_hierarchy() is None
+        assert get_contraction_hierarchy() is None
+    assert len([record for record in caplog.records if record.name == 'mbm.contraction']) == 1
@@ -0,0 +1,205 @@
+import os
+from unittest.mock import patch
+
+import numpy as np
+
+from mbm.graph import RoutingGraph, get_graph
+from mbm.models import DataVersion, MellowChange
+
+
+# A small graph with a short expensive edge and a long cheap detour between
+# vertices 1 and 3, plus a one-way edge from 3 to 4 and an island at 10-11.
+#
+#   (gid, source, target, cost, reverse_cost, length_m)
+EDGES = [
+    (100, 1, 3, 10.0, 10.0, 100),
+    (101, 1, 2, 1.0, 1.0, 80),
+    (102, 2, 3, 1.0, 1.0, 80),
+    (103, 3, 4, 1.0, -1.0, 50),
+    (104, 10, 11, 1.0, 1.0, 10),
+]
+
+
+def test_from_edges_builds_one_arc_per_traversable_direction():
+    graph = RoutingGraph.from_edges(EDGES)
+    assert graph.num_vertices == 6
+    # Every edge is two-way except 103
+    assert graph.num_arcs == 9
+
+
+def test_shortest_path_prefers_cheaper_detour():
+    graph = RoutingGraph.from_edges(EDGES)
+    assert graph.shortest_path(1, 3) == [101, 102]
+    assert graph.shortest_path(3, 1) == [102, 101]
+
+
+def test_shortest_path_respects_one_way_edges():
+    graph = RoutingGraph.from_edges(EDGES)
+    assert graph.shortest_path(1, 4) == [101, 102, 103]
+    assert graph.shortest_path(4, 1) == []
+
+
+def test_shortest_path_returns_empty_for_unreachable_or_unknown_vertices():
+    graph = RoutingGraph.from_edges(EDGES)
+    assert graph.shortest_path(1, 11) == []
+    assert graph.shortest_path(1, 999) == []
+    assert graph.shortest_path(1, 1) == []
+
+
+def test_strong_components_respect_one_way_edges():
+    graph = RoutingGraph.from_edges(EDGES)
+    labels = dict(zip(graph.vertex_ids.tolist(), graph.strong_components().tolist()))
+    # Vertices 1-3 can all reach each other, but 4 can only be entered
+    assert labels[1] == labels[2] == labels[3] == 0
+    assert len({labels[4], labels[10], labels[11], 0}) == 3
+    assert labels[10] == labels[11]
+
+
+def test_weak_components_ignore_edge_direction():
+    graph = RoutingGraph.from_edges(EDGES)
+    labels = dict(zip(graph.vertex_ids.tolist(), graph.weak_components().tolist()))
+    assert labels[1] == labels[2] == labels[3] == labels[4] == 0
+    assert labels[10] == labels[11] == 1
+
+
+def test_path_lengths_follow_cheapest_paths():
+    graph = RoutingGraph.from_edges(EDGES)
+    # The cheapest path from 1 to 3 is the 160m detour, not the 100m edge
+    assert graph.path_lengths(1, [1, 3, 4, 11, 999]) == {1: 0.0, 3: 160.0, 4: 210.0}
+
+
+def test_reachable_edges_follow_cheapest_paths_within_length():
+    graph = RoutingGraph.from_edges(EDGES)
+    # Vertex 3 is reached over the cheap detour, so 103 is 160m + 50m away
+    # even though the direct edge to 3 is shorter
+    assert graph.reachable_edges(1, 250) == {100: 100, 101: 80, 102: 160, 103: 210}
+    assert graph.reachable_edges(1, 200) == {100: 100, 101: 80, 102: 160}
+    assert graph.reachable_edges(4, 1000) == {}
+    assert graph.reachable_edges(99, 1000) == {}
+
+
+def test_snapshot_round_trips_and_swaps_atomically(tmp_path):
+    graph = RoutingGraph.from_edges(EDGES)
+    graph.lngs = np.arange(graph.num_vertices, dtype=np.float64)
+    graph.lats = -graph.lngs
+
+    first_path = graph.save_snapshot(str(tmp_path), version=3)
+    snapshot, version = RoutingGraph.open_snapshot(first_path)
+    assert version == 3
+    assert isinstance(snapshot.indptr, np.memmap)
+    assert snapshot.shortest_path(1, 4) == [101, 102, 103]
+    assert snapshot.lats.tolist() == graph.lats.tolist()
+
+    second_path = graph.save_snapshot(str(tmp_path), version=4)
+    assert (tmp_path / 'CURRENT').read_text() == os.path.basename(second_path)
+    assert not os.path.exists(first_path)
+
+
+def test_get_graph_prefers_current_snapshot(tmp_path, settings):
+    settings.ROUTING_SNAPSHOT_DIR = str(tmp_path)
+    graph = RoutingGraph.from_edges(EDGES)
+    graph.lngs = graph.lats = np.zeros(graph.num_vertices)
+    graph.save_snapshot(str(tmp_path), version=5)
+
+    with patch.object(DataVersion, 'get', return_value=5), \
+         patch('mbm.graph.load_graph') as mock_load:
+        assert isinstance(get_graph().indptr, np.memmap)
+    mock_load.assert_not_called()
+
+
+
+def test_get_graph_patches_costs_over_a_stale_snapshot(tmp_path, settings, caplog):
+    caplog.set_level('INFO', logger='mbm.graph')
+    settings.ROUTING_SNAPSHOT_DIR = str(tmp_path)
+    graph = RoutingGraph.from_edges(EDGES)
+    graph.lngs = graph.lats = np.zeros(graph.num_vertices)
+    graph.save_snapshot(str(tmp_path), version=5)
+
+    changes = [MellowChange(version=6, osm_ids=[7])]
+    with patch('mbm.graph._graph', None), \
+         patch('mbm.graph._graph_snapshot', None), \
+         patch.object(DataVersion, 'get', return_value=6), \
+         patch.object(MellowChange, 'since', return_value=changes), \
+         patch('mbm.graph.load_edge_costs', return_value=[(100, 1, 0.5, 0.5)]), \
+         patch('mbm.graph.load_graph') as mock_load:
+        patched = get_graph()
+        # The patched graph is reused, and the stale snapshot only logged once
+        assert get_graph() is patched
+    mock_load.assert_not_called()
+    assert len([record for record in caplog.records if record.name == 'mbm.graph']) == 1
+
+    # Only the costs are copied out of the snapshot
+    assert isinstance(patched.indptr, np.memmap)
+    assert not isinstance(patched.costs, np.memmap)
+    assert patched.shortest_path(1, 3) == [100]
+
+
+def test_get_graph_loads_graph_when_the_street_network_changed_since_the_snapshot(tmp_path, settings):
+    settings.ROUTING_SNAPSHOT_DIR = str(tmp_path)
+    graph = RoutingGraph.from_edges(EDGES)
+    graph.lngs = graph.lats = np.zeros(graph.num_vertices)
+    graph.save_snapshot(str(tmp_path), version=5)
+
+    changes = [MellowChange(version=6, osm_ids=[7], topology_changed=True)]
+    with patch('mbm.graph._graph', None), \
+         patch('mbm.graph._graph_snapshot', None), \
+         patch.object(DataVersion, 'get', return_value=6), \
+         patch.object(MellowChange, 'since', return_value=changes), \
+         patch('mbm.graph.load_graph', return_value=graph) as mock_load:
+        assert get_graph() is graph
+        assert get_graph() is graph
+    mock_load.assert_called_once()
+
+
+def test_update_costs_replaces_costs_in_both_directions():
+    graph = RoutingGraph.from_edges(EDGES)
+    old_costs = graph.costs
+    # Make the direct edge from 1 to 3 cheap in both directions
+    graph.update_costs([(100, 1, 0.5, 0.5)])
+    assert graph.shortest_path(1, 3) == [100]
+    assert graph.shortest_path(3, 1) == [100]
+    # The old costs array is left alone for searches already using it
+    assert old_costs is not graph.costs
+    assert 10.0 in old_costs
+
+
+def test_update_costs_keeps_directions_apart():
+    graph = RoutingGraph.from_edges(EDGES)
+    graph.update_costs([(100, 1, 0.5, 20.0)])
+    assert graph.shortest_path(1, 3) == [100]
+    assert graph.shortest_path(3, 1) == [102, 101]
+
+
+def test_get_graph_applies_logged_changes_instead_of_reloading(settings, tmp_path):
+    settings.ROUTING_SNAPSHOT_DIR = str(tmp_path)
+    graph = RoutingGraph.from_edges(EDGES)
+    changes = [MellowChange(version=11, osm_ids=[7])]
+    with patch('mbm.graph._graph', graph), \
+         patch('mbm.graph._graph_version', 10), \
+         patch('mbm.graph._graph_snapshot', None), \
+         patch.object(DataVersion, 'get', return_value=11), \
+         patch.object(MellowChange, 'since', return_value=changes), \
+         patch('mbm.graph.load_edge_costs', return_value=[(100, 1, 0.5, 0.5)]) as mock_costs, \
+         patch('mbm.graph.load_graph') as mock_load:
+        assert get_graph() is graph
+
+    mock_load.assert_not_called()
+    mock_costs.assert_called_once_with({7})
+    assert graph.shortest_path(1, 3) == [100]
+
+
+def test_get_graph_reloads_when_the_street_network_changed(settings, tmp_path):
+    settings.ROUTING_SNAPSHOT_DIR = str(tmp_path)
+    graph = RoutingGraph.from_edges(EDGES)
+    reloaded = RoutingGraph.from_edges(EDGES)
+    changes = [MellowChange(version=11, osm_ids=[7], topology_changed=True)]
+    with patch('mbm.graph._graph', graph), \
+         patch('mbm.graph._graph_version', 10), \
+         patch('mbm.graph._graph_snapshot', None), \
+         patch.object(DataVersion, 'get', return_value=11), \
+         patch.object(MellowChange, 'since', return_value=changes), \
+         patch('mbm.graph.load_edge_costs') as mock_costs, \
+         patch('mbm.graph.load_graph', return_value=reloaded):
+        assert get_graph() is reloaded
+
+    mock_costs.assert_not_called()
@@ -0,0 +1,69 @@
+import importlib
+import sys
+from unittest.mock import patch
+
+from mbm import listener
+from mbm.models import MellowChange
+
+
+def test_apply_change_keeps_cached_routes_that_the_change_did_not_touch(settings):
+    settings.ROUTING_BACKEND = 'memory'
+    listener.route_cache.clear()
+    listener.route_cache.set((1, 2, False, False, False, 1), 'near')
+    listener.route_cache.set((3, 4, False, False, False, 1), 'far')
+    changes = [MellowChange(version=2, min_lng=0.5, min_lat=0.5, max_lng=2, max_lat=2)]
+    with patch.object(listener, 'get_graph') as mock_get_graph, \
+         patch.object(MellowChange, 'since', return_value=changes), \
+         patch.object(listener.Route, 'get_search_bounds', return_value=[(0, 0, 1, 1), (5, 5, 6, 6)]) as mock_bounds:
+        listener.apply_change(2)
+
+    mock_bounds.assert_called_once_with([(1, 2), (3, 4)])
+    assert listener.route_cache.keys() == [(3, 4, False, False, False, 2)]
+    mock_get_graph.assert_called_once_with()
+    listener.route_cache.clear()
+
+
+def test_apply_change_keeps_cached_isochrones_that_the_change_did_not_touch(settings):
+    settings.ROUTING_BACKEND = 'pgrouting'
+    listener.isochrone_cache.clear()
+    listener.isochrone_cache.set((1, (5, 15), False, 1), 'near')
+    listener.isochrone_cache.set((3, (5,), True, 1), 'far')
+    changes = [MellowChange(version=2, min_lng=0.5, min_lat=0.5, max_lng=2, max_lat=2)]
+    with patch.object(MellowChange, 'since', return_value=changes), \
+         patch.object(listener.Isochrone, 'get_reach_bounds', return_value=[(0, 0, 1, 1), (5, 5, 6, 6)]) as mock_bounds:
+        listener.apply_change(2)
+
+    mock_bounds.assert_called_once_with([(1, 15), (3, 5)])
+    assert listener.isochrone_cache.keys() == [(3, (5,), True, 2)]
+    listener.isochrone_cache.clear()
+
+
+def test_apply_change_leaves_graph_alone_for_other_backends(settings):
+    settings.ROUTING_BACKEND = 'pgrouting'
+    with patch.object(listener, 'get_graph') as mock_get_graph:
+        listener.apply_change(2)
+
+    mock_get_graph.assert_not_called()
+
+
+def test_apply_change_reloads_everything_when_the_street_network_changed(settings):
+    settings.ROUTING_BACKEND = 'pgrouting'
+    settings.SNAPPING_BACKEND = 'memory'
+    listener.route_cache.clear()
+    with patch.object(listener, 'get_vertex_index') as mock_get_index:
+        listener.apply_change(2)
+        mock_get_index.assert_not_called()
+        listener.route_cache.set((1, 2, False, False, False, 2), 'route')
+        listener.apply_change(3, topology_changed=True)
+
+    assert len(listener.route_cache) == 0
+    mock_get_index.assert_called_once_with()
+
+
+def test_asgi_application_starts_the_listener(settings):
+    settings.MELLOW_CHANGE_LISTENER = True
+    sys.modules.pop('mbm.asgi', None)
+    with patch.object(listener, 'start_listener') as mock_start:
+        importlib.import_module('mbm.asgi')
+
+    mock_start.assert_called_once_with()
@@ -0,0 +1,57 @@
+import pytest
+
+from mbm import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics, 'REGISTRY', [])
+    return metrics.REGISTRY
+
+
+def test_histogram_renders_cumulative_buckets(registry):
+    histogram = metrics.Histogram('test_seconds', 'Test.', labels=('stage',), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, stage='a')
+
+    assert histogram.count(stage='a') == 4
+    assert metrics.render().splitlines() == [
+        '# HELP test_seconds Test.',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{stage="a",le="0.1"} 1',
+        'test_seconds_bucket{stage="a",le="1"} 3',
+        'test_seconds_bucket{stage="a",le="+Inf"} 4',
+        'test_seconds_sum{stage="a"} 6.05',
+        'test_seconds_count{stage="a"} 4',
+    ]
+
+
+def test_counter_requires_its_labels(registry):
+    counter = metrics.Counter('test_total', 'Test.', labels=('result',))
+    counter.inc(result='hit')
+    counter.inc(2, result='hit')
+    assert counter.value(result='hit') == 3
+    with pytest.raises(ValueError):
+        counter.inc(outcome='hit')
+
+
+def test_collected_metrics_are_read_when_rendered(registry):
+    values = {'size': 1}
+    metrics.Collected('test_size', 'Test.', lambda: [({}, values['size'])])
+    values['size'] = 5
+    assert metrics.render().splitlines()[-1] == 'test_size 5'
+
+
+def test_stage_timer_adds_up_repeated_stages(registry):
+    histogram = metrics.Histogram('test_seconds', 'Test.', labels=('stage',))
+    timer = metrics.StageTimer(histogram)
+    for _ in range(2):
+        with timer.stage('query'):
+            pass
+    with timer.stage('render'):
+        pass
+
+    assert histogram.count(stage='query') == 2
+    entries = timer.header().split(', ')
+    assert [entry.split(';')[0] for entry in entries] == ['query', 'render', 'total']
+    assert all(entry.split(';')[1].startswith('dur=') for entry in entries)
@@ -0,0 +1,103 @@
+import io
+
+import pytest
+
+from mbm.osm import (
+    NodeElement, WayElement, classify_way, edge_row, line_lengths,
+    one_way_type, parse_osm, split_way
+)
+
+OSC = b"""<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6">
+  <modify>
+    <node id="1" lat="41.9" lon="-87.6"/>
+  </modify>
+  <create>
+    <node id="10" lat="41.91" lon="-87.61">
+      <tag k="highway" v="stop"/>
+    </node>
+    <way id="100">
+      <nd ref="10"/>
+      <nd ref="1"/>
+      <tag k="highway" v="residential"/>
+      <tag k="name" v="West Foo Street"/>
+    </way>
+  </create>
+  <delete>
+    <node id="2"/>
+    <way id="101"/>
+    <relation id="1000"/>
+  </delete>
+</osmChange>
+"""
+
+TAG_CLASS = {'tag_id': 110, 'priority': 3, 'maxspeed': 36}
+
+
+def test_parse_osm_reads_actions_of_nodes_and_ways():
+    elements = list(parse_osm(io.BytesIO(OSC)))
+
+    assert elements == [
+        NodeElement(1, 'modify', (-87.6, 41.9)),
+        NodeElement(10, 'create', (-87.61, 41.91)),
+        WayElement(100, 'create', {'highway': 'residential', 'name': 'West Foo Street'}, [10, 1]),
+        NodeElement(2, 'delete', None),
+        WayElement(101, 'delete', {}, []),
+    ]
+
+
+def test_classify_way_uses_last_matching_tag():
+    tag_classes = {('highway', 'residential'): TAG_CLASS, ('cycleway', 'lane'): TAG_CLASS}
+
+    assert classify_way({'highway': 'residential', 'cycleway': 'lane'}, tag_classes) == ('cycleway', 'lane')
+    assert classify_way({'highway': 'residential', 'name': 'Foo'}, tag_classes) == ('highway', 'residential')
+    assert classify_way({'building': 'yes'}, tag_classes) is None
+
+
+@pytest.mark.parametrize('tags,expected', [
+    ({'oneway': 'yes'}, 'YES'),
+    ({'oneway': '-1'}, 'REVERSED'),
+    ({'oneway': 'no'}, 'NO'),
+    ({'junction': 'roundabout'}, 'YES'),
+    ({'junction': 'roundabout', 'oneway': 'no'}, 'NO'),
+    ({}, 'UNKNOWN'),
+])
+def test_one_way_type(tags, expected):
+    assert one_way_type(tags) == expected
+
+
+def test_split_way_splits_at_shared_nodes():
+    use_counts = {1: 1, 2: 2, 3: 1, 4: 3, 5: 1}
+
+    assert split_way([1, 2, 3, 4, 5], use_counts) == [(0, 1), (1, 3), (3, 4)]
+    assert split_way([1, 3, 5], use_counts) == [(0, 2)]
+
+
+def test_split_way_drops_segments_that_go_nowhere():
+    assert split_way([1, 1], {1: 2}) == []
+    assert split_way([1, 2, 2], {1: 1, 2: 3}) == [(0, 1)]
+
+
+def test_line_lengths_in_degrees_and_meters():
+    length, length_m = line_lengths([(-87.6, 41.9), (-87.6, 41.91), (-87.59, 41.91)])
+
+    assert length == pytest.approx(0.02)
+    # A hundredth of a degree is about 1.1km north-south and 830m east-west
+    assert length_m == pytest.approx(1112 + 827, rel=0.01)
+
+
+def test_edge_row_blocks_the_wrong_way_of_one_way_streets():
+    coords = [(-87.6, 41.9), (-87.6, 41.91)]
+
+    forward = edge_row(100, [1, 2], coords, {'oneway': 'yes', 'name': 'Foo'}, TAG_CLASS)
+    assert forward['cost'] > 0 > forward['reverse_cost']
+    assert forward['cost_s'] == pytest.approx(forward['length_m'] / 10)
+    assert (forward['one_way'], forward['oneway']) == (1, 'YES')
+    assert (forward['source_osm'], forward['target_osm']) == (1, 2)
+    assert forward['the_geom'] == 'LINESTRING(-87.6 41.9, -87.6 41.91)'
+
+    reverse = edge_row(100, [1, 2], coords, {'oneway': '-1'}, TAG_CLASS)
+    assert reverse['cost'] < 0 < reverse['reverse_cost']
+
+    both = edge_row(100, [1, 2], coords, {}, TAG_CLASS)
+    assert both['cost'] == both['reverse_cost'] == both['length']
@@ -0,0 +1,55 @@
+import json
+from unittest.mock import patch
+
+import pytest
+
+from mbm import replay
+
+
+def test_load_corpus_formats_request_arguments():
+    lines = [
+        '{"source": "-87.6,41.8", "target": [-87.7, 41.9], "compact": true}\n',
+        '\n',
+    ]
+    assert replay.load_corpus(lines) == [
+        {'source': '-87.6,41.8', 'target': '-87.7,41.9', 'compact': 'true'},
+    ]
+
+
+@pytest.mark.parametrize('line', ['not json', '[1, 2]', '{"source": "-87.6,41.8"}'])
+def test_load_corpus_rejects_invalid_lines(line):
+    with pytest.raises(ValueError, match='Line 1'):
+        replay.load_corpus([line])
+
+
+def route_body(bbox_expansions):
+    return json.dumps({'route': {'properties': {'bbox_expansions': bbox_expansions}}})
+
+
+def test_send_reports_errors_and_search_outcomes():
+    assert replay.send(lambda params: (200, route_body(3)), {})[1:] == (None, 'fallback')
+    assert replay.send(lambda params: (200, route_body(None)), {})[1:] == (None, 'graph')
+    assert replay.send(lambda params: (400, b'{}'), {})[1:] == ('http_400', None)
+    assert replay.send(lambda params: (200, b'<html>'), {})[1:] == ('invalid_response', None)
+
+    def fail(params):
+        raise RuntimeError
+    assert replay.send(fail, {})[1:] == ('RuntimeError', None)
+
+
+def test_replay_spreads_requests_across_threads():
+    requests = [{'source': str(idx), 'target': str(idx)} for idx in range(10)]
+
+    def route(params):
+        if params['source'] == '0':
+            return 500, b''
+        return 200, route_body(int(params['source']) % 2)
+
+    with patch.object(replay, 'get_router', return_value=route) as mock_router:
+        results = replay.replay(requests, base_url='http://localhost', concurrency=4)
+
+    assert mock_router.call_count == 4
+    assert results['requests'] == 10
+    assert results['errors'] == {'http_500': 1}
+    assert results['latency']['count'] == 9
+    assert results['search'] == {'bbox_expanded': 5, 'bbox_hit': 4}
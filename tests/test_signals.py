@@ -0,0 +1,62 @@
+from contextlib import contextmanager
+from unittest.mock import patch
+
+import pytest
+
+from mbm import signals
+
+
+@pytest.fixture
+def events():
+    """Patch the transaction and the refreshes to record the order they
+    happen in, rather than touching the database."""
+    events = []
+
+    @contextmanager
+    def atomic():
+        events.append('begin')
+        try:
+            yield
+        except Exception:
+            events.append('rollback')
+            raise
+        events.append('commit')
+
+    with patch.object(signals.transaction, 'atomic', atomic), \
+         patch.object(signals.RoutingEdge, 'refresh', side_effect=lambda ways: events.append(('edges', ways))), \
+         patch.object(signals.SimplifiedRoute, 'refresh', side_effect=lambda types: events.append(('simplified', types))), \
+         patch.object(signals.MellowChange, 'record', side_effect=lambda ways: events.append(('record', ways))):
+        yield events
+
+
+def test_batched_refreshes_run_once_inside_the_transaction(events):
+    with signals.batched_refresh():
+        signals.schedule_refresh([3, 1], {'street'})
+        signals.schedule_refresh([1, 2], {'route'})
+        with signals.batched_refresh():
+            signals.schedule_refresh([2], {'path', 'route'})
+
+    refreshes = [event for event in events if isinstance(event, tuple)]
+    assert refreshes == [
+        ('edges', [1, 2, 3]),
+        ('simplified', {'street', 'route', 'path'}),
+        ('record', [1, 2, 3]),
+    ]
+    # The refresh runs before the outermost transaction commits
+    assert events[-1] == 'commit'
+    assert events.index(('record', [1, 2, 3])) < len(events) - 1
+
+
+def test_batched_refresh_is_dropped_when_the_transaction_rolls_back(events):
+    with pytest.raises(ValueError):
+        with signals.batched_refresh():
+            signals.schedule_refresh([1], {'street'})
+            raise ValueError
+
+    assert events == ['begin', 'rollback']
+
+    # Later saves outside of a batch refresh straight away, without the
+    # rolled back ways
+    signals.schedule_refresh([2], {'route'})
+    assert ('edges', [2]) in events
+    assert ('edges', [1, 2]) not in events
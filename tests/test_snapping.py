@@ -0,0 +1,87 @@
+from unittest.mock import patch
+
+import numpy as np
+
+from mbm import snapping
+from mbm.models import DataVersion
+from mbm.snapping import VertexIndex
+
+
+def brute_force_nearest(vertex_ids, lngs, lats, lng, lat):
+    return int(vertex_ids[np.argmin(np.hypot(lngs - lng, lats - lat))])
+
+
+def test_vertex_index_matches_brute_force_search():
+    rng = np.random.default_rng(0)
+    lngs = rng.uniform(-87.9, -87.5, 2000)
+    lats = rng.uniform(41.6, 42.0, 2000)
+    vertex_ids = np.arange(2000) + 100
+    index = VertexIndex(vertex_ids, lngs, lats, cell_size=0.01)
+
+    query_lngs = rng.uniform(-88.0, -87.4, 200)
+    query_lats = rng.uniform(41.5, 42.1, 200)
+    expected = [
+        brute_force_nearest(vertex_ids, lngs, lats, lng, lat)
+        for lng, lat in zip(query_lngs, query_lats)
+    ]
+    assert index.nearest_many(query_lngs, query_lats) == expected
+
+
+def test_vertex_index_filters_by_component():
+    index = VertexIndex(
+        vertex_ids=[1, 2, 3],
+        lngs=[0.0, 0.1, 1.0],
+        lats=[0.0, 0.0, 0.0],
+        components=[5, 0, 0],
+        cell_size=0.05,
+    )
+    assert index.nearest(0.0, 0.0) == 1
+    assert index.nearest(0.0, 0.0, strong_component=0) == 2
+    assert index.nearest(0.0, 0.0, strong_component=7) is None
+
+
+def test_empty_vertex_index_returns_none():
+    index = VertexIndex([], [], [])
+    assert index.nearest(0.0, 0.0) is None
+
+
+def test_vertex_index_snaps_points_outside_the_grid():
+    rng = np.random.default_rng(1)
+    lngs = rng.uniform(-87.9, -87.5, 500)
+    lats = rng.uniform(41.6, 42.0, 500)
+    vertex_ids = np.arange(500)
+    index = VertexIndex(vertex_ids, lngs, lats, cell_size=0.01)
+
+    query_lngs = [-120.0, 0.0, -87.7, -87.7, 1e9]
+    query_lats = [41.8, 41.8, -45.0, 89.0, 1e9]
+    expected = [
+        brute_force_nearest(vertex_ids, lngs, lats, lng, lat)
+        for lng, lat in zip(query_lngs, query_lats)
+    ]
+    assert index.nearest_many(query_lngs, query_lats) == expected
+
+
+def test_vertex_index_nearest_many_filters_by_component():
+    index = VertexIndex(
+        vertex_ids=[1, 2, 3],
+        lngs=[0.0, 0.1, 1.0],
+        lats=[0.0, 0.0, 0.0],
+        components=[5, 0, 0],
+        cell_size=0.05,
+    )
+    assert index.nearest_many([0.0, 0.9], [0.0, 0.0], strong_component=0) == [2, 3]
+    assert index.nearest_many([0.0, 0.9], [0.0, 0.0], strong_component=7) == [None, None]
+
+
+def test_get_vertex_index_reloads_when_the_vertices_change():
+    snapping.clear_vertex_index()
+    with patch.object(DataVersion, 'get', return_value=1) as mock_version, \
+         patch.object(snapping, 'load_vertex_index', side_effect=lambda: VertexIndex([], [], [])) as mock_load:
+        index = snapping.get_vertex_index()
+        assert snapping.get_vertex_index() is index
+        mock_version.assert_called_with(DataVersion.VERTICES)
+
+        mock_version.return_value = 2
+        assert snapping.get_vertex_index() is not index
+    assert mock_load.call_count == 2
+    snapping.clear_vertex_index()
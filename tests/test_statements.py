@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+from mbm import statements, views
+
+
+def test_number_placeholders_numbers_from_start():
+    assert statements.number_placeholders('SELECT %s, %s') == 'SELECT $1, $2'
+    assert statements.number_placeholders('SELECT %s', start=3) == 'SELECT $3'
+
+
+def test_statement_prepares_and_executes_with_typed_params():
+    stmt = statements.Statement('mbm_test', 'SELECT $1 + $2', ('integer', 'float8'))
+
+    assert stmt.prepare_sql == 'PREPARE mbm_test (integer, float8) AS SELECT $1 + $2'
+    assert stmt.execute_sql == 'EXECUTE mbm_test (%s, %s)'
+
+
+def test_statement_is_built_once_per_name():
+    build = MagicMock(return_value='SELECT 1')
+
+    first = statements.statement('mbm_test_once', (), build)
+    second = statements.statement('mbm_test_once', (), build)
+
+    assert first is second
+    build.assert_called_once()
+
+
+class FakeConnection:
+    def __init__(self, **params):
+        self.closed = False
+
+
+def test_pool_bounds_and_reuses_connections():
+    opened = []
+
+    def connect(**params):
+        conn = FakeConnection(**params)
+        opened.append(conn)
+        return conn
+
+    pool = statements.ConnectionPool(2)
+    peak = []
+
+    def borrow():
+        with pool.connection():
+            peak.append(pool.in_use)
+            time.sleep(0.01)
+
+    with patch('mbm.statements.psycopg2.connect', side_effect=connect):
+        threads = [threading.Thread(target=borrow) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert max(peak) <= 2
+    assert len(opened) <= 2
+    assert (pool.size, pool.in_use) == (len(opened), 0)
+
+
+def test_pool_replaces_closed_connections():
+    pool = statements.ConnectionPool(1)
+
+    with patch('mbm.statements.psycopg2.connect', side_effect=FakeConnection) as connect:
+        with pool.connection() as conn:
+            conn.closed = True
+        with pool.connection():
+            pass
+
+    assert connect.call_count == 2
+
+
+def test_get_route_runs_prepared_statements_when_enabled(settings):
+    settings.PREPARED_ROUTING_QUERIES = True
+    route = views.Route()
+
+    row = ('[]', {'bbox_expansions': 1, 'bbox_buffer_ft': 1000}, 0, [], 3)
+    with patch('mbm.views.statements.fetchone', return_value=row) as fetchone, \
+            patch('mbm.views.connection') as connection:
+        route_json, num_edges = route._execute_route_query(1, 2, buffer_scale=2, bbox_expansions=1)
+
+    assert num_edges == 3
+    assert json.loads(route_json)['properties']['bbox_expansions'] == 1
+
+    statement, params = fetchone.call_args[0]
+    assert statement.name == 'mbm_route_bbox'
+    assert params == [1, 2, 2, 1]
+    connection.cursor.assert_not_called()
+
+
+def test_benchmark_statements_reads_coordinates_from_vertex_geometries():
+    from mbm.management.commands.benchmark_statements import Command
+
+    conn = MagicMock()
+    cursor = conn.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [(1, -87.6, 41.8), (2, -87.7, 41.9)]
+    cases = Command().get_cases(conn, pairs=1, seed=0)
+
+    # The synthetic city only has (id, the_geom) vertices
+    assert 'ST_X(the_geom), ST_Y(the_geom)' in cursor.execute.call_args_list[1][0][0]
+    assert [case[0] for case in cases] == ['nearest_vertex', 'route']
+    assert cases[0][3] == ['-87.6', '41.8']
+    assert cases[1][3] == [1, 2, 1, 0]
@@ -0,0 +1,125 @@
+import time
+from io import StringIO
+from unittest.mock import patch
+
+import pytest
+from django.core.cache import caches
+from django.core.management import call_command
+
+from mbm import tiered_cache
+from mbm.tiered_cache import LocalTier
+
+
+@pytest.fixture
+def tiered(settings):
+    settings.CACHES = {
+        'default': {
+            'BACKEND': 'mbm.tiered_cache.TieredCache',
+            'LOCATION': 'test_shared',
+            'OPTIONS': {'MAX_ENTRIES': 2, 'MAX_BYTES': 1024, 'LOCAL_TIMEOUT': 60},
+        },
+        'test_shared': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'test_tiered_cache',
+        },
+    }
+    tiered_cache._local_tiers.pop('test_shared', None)
+    cache = caches['default']
+    yield cache
+    cache.clear()
+    tiered_cache._local_tiers.pop('test_shared', None)
+
+
+def test_local_tier_evicts_by_entries_and_bytes():
+    tier = LocalTier(2, 10)
+    tier.set('a', b'1234', None)
+    tier.set('b', b'1234', None)
+    assert tier.get('a') == (True, b'1234')
+    tier.set('c', b'1234', None)
+
+    assert tier.get('b') == (False, None)
+    tier.set('d', b'123456', None)
+
+    assert tier.get('a') == (False, None)
+    assert tier.get('d') == (True, b'123456')
+    assert tier.stats()['evictions'] == 2
+    assert tier.bytes == 10
+
+
+def test_local_tier_expires_entries_and_skips_values_too_big_to_fit():
+    tier = LocalTier(2, 4)
+    tier.set('a', b'1', time.time() - 1)
+    tier.set('b', b'12345', None)
+    tier.set('c', b'1', time.time() + 0.01)
+    time.sleep(0.02)
+
+    assert tier.get('a') == (False, None)
+    assert tier.get('b') == (False, None)
+    assert tier.get('c') == (False, None)
+    assert tier.stats()['expirations'] == 1
+    assert len(tier) == 0
+
+
+def test_tiered_cache_reads_from_the_local_tier_first(tiered):
+    tiered.set('key', {'value': 1})
+    with patch.object(tiered.shared, 'get', wraps=tiered.shared.get) as shared_get:
+        assert tiered.get('key') == {'value': 1}
+    shared_get.assert_not_called()
+
+
+def test_tiered_cache_fills_the_local_tier_from_the_shared_tier(tiered):
+    tiered.shared.set('key', 'shared')
+
+    assert tiered.get('key') == 'shared'
+    assert tiered.local.get(tiered.shared.make_key('key'))[0]
+    assert tiered.get('missing', 'default') == 'default'
+    assert tiered.stats()['shared']['misses'] >= 1
+
+
+def test_tiered_cache_does_not_share_mutable_values(tiered):
+    value = {'value': 1}
+    tiered.set('key', value)
+    value['value'] = 2
+    tiered.get('key')['value'] = 3
+
+    assert tiered.get('key') == {'value': 1}
+
+
+def test_tiered_cache_delete_removes_from_both_tiers(tiered):
+    tiered.set('key', 'value')
+    tiered.delete('key')
+
+    assert tiered.get('key') is None
+    assert tiered.shared.get('key') is None
+
+
+def test_tiered_cache_keys_versions_separately(tiered):
+    tiered.set('key', 'one', version=1)
+    tiered.set('key', 'two', version=2)
+
+    assert tiered.get('key', version=1) == 'one'
+    assert tiered.get('key', version=2) == 'two'
+
+
+def test_tiered_cache_drops_local_tier_when_another_process_clears(tiered):
+    tiered.set('key', 'value')
+    # Another process clears the cache and bumps the generation
+    tiered.shared.clear()
+    tiered.shared.set(tiered_cache.GENERATION_KEY, 'other', None)
+
+    assert tiered.get('key') == 'value'
+    tiered.local.checked_at = None
+    assert tiered.get('key') is None
+
+
+def test_clear_cache_reports_the_shared_tier_and_bumps_the_generation(tiered):
+    tiered.set('key', 'value')
+    out = StringIO()
+
+    call_command('clear_cache', stdout=out)
+
+    assert 'local:' not in out.getvalue()
+    assert 'shared: alias=test_shared' in out.getvalue()
+    assert f'Bumped the generation to {tiered.local.generation}.' in out.getvalue()
+    assert len(tiered.local) == 0
+    assert tiered.get('key') is None
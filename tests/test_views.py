@@ -1,6 +1,15 @@
+import asyncio
+import json
+import threading
+import time
+from contextlib import contextmanager
+
 import pytest
-from unittest.mock import patch, call
-from mbm import views
+from unittest.mock import MagicMock, patch, call
+
+from mbm import forms, views
+from mbm.models import SimplifiedRoute
+from mbm.snapping import VertexIndex
 
 
 @pytest.mark.parametrize('dist_in_meters,expected', [
@@ -63,6 +72,31 @@ def test_get_major_streets_does_not_return_unnamed_streets():
     assert route.get_major_streets(rows, total_length) == []
 
 
+@pytest.mark.parametrize('dist_in_meters,expected', [
+    (0, ('0.0 miles', '<1 minute')),
+    # Halves round to even with Python's round(), not away from zero like
+    # ROUND() in Postgres
+    (views.METERS_PER_MILE * 0.25, ('0.2 miles', '2 minutes')),
+    (views.METERS_PER_MILE * 0.75, ('0.8 miles', '4 minutes')),
+])
+def test_format_distance_edge_cases(dist_in_meters, expected):
+    route = views.Route()
+    assert route.format_distance(dist_in_meters) == expected
+
+def test_get_major_streets_returns_empty_for_empty_route():
+    route = views.Route()
+    assert route.get_major_streets([], 0) == []
+
+def test_get_major_streets_skips_empty_names():
+    route = views.Route()
+    rows = [
+        {'name': 'Short Street', 'length_m': 100},
+        {'name': '', 'length_m': 1000},
+    ]
+    total_length = sum(row['length_m'] for row in rows)
+    assert route.get_major_streets(rows, total_length) == []
+
+
 def test_build_route_query_with_bbox_includes_bbox_cte():
     route = views.Route()
     sql = route._build_route_query(1, 2, use_bbox=True)
@@ -70,6 +104,13 @@ def test_build_route_query_with_bbox_includes_bbox_cte():
     assert 'JOIN bbox ON' in sql
 
 
+def test_build_route_query_with_bbox_scales_buffer():
+    route = views.Route()
+    sql = route._build_route_query(1, 2, use_bbox=True, buffer_scale=4)
+    assert '* 4' in sql
+    assert 'AS bbox_buffer_ft' in sql
+
+
 def test_build_route_query_without_bbox_excludes_bbox_cte():
     route = views.Route()
     sql = route._build_route_query(1, 2, use_bbox=False)
@@ -80,7 +121,16 @@ def test_build_route_query_without_bbox_excludes_bbox_cte():
 def test_build_route_query_without_bbox_queries_all_ways():
     route = views.Route()
     sql = route._build_route_query(1, 2, use_bbox=False)
-    assert 'LEFT JOIN mellow USING(osm_id)' in sql
+    assert 'FROM mbm_routingedge\n' in sql
+    assert 'WHERE' not in sql
+
+
+def test_build_route_query_reads_precomputed_costs():
+    route = views.Route()
+    for use_bbox in (True, False):
+        sql = route._build_route_query(1, 2, use_bbox=use_bbox)
+        assert 'UNNEST(ways)' not in sql
+        assert 'CASE' not in sql
 
 
 def test_build_route_query_both_modes_include_cost_logic():
@@ -91,55 +141,669 @@ def test_build_route_query_both_modes_include_cost_logic():
         assert 'reverse_cost' in sql
 
 
-# Fixture representing a dummy row that the routing algorithm might return as
-# part of a route
-STUB_ROWS = [
-    {'name': 'Main St', 'length_m': 500, 'geometry': '{"type":"LineString","coordinates":[]}', 'type': 'street'}
-]
+def test_build_route_query_selects_path_steps():
+    route = views.Route()
+    sql = route._build_route_query(1, 2, use_bbox=False)
+    assert 'path.edge AS edge_id' in sql
+    assert 'ST_AsGeoJSON' not in sql
+
+
+def test_build_route_document_query_leaves_summary_to_python():
+    route = views.Route()
+    sql = route._build_route_document_query('SELECT 1')
+    assert 'json_agg(feature ORDER BY seq, part)' in sql
+    assert "json_build_object('name', name, 'length_m', length_m)" in sql
+    assert "' miles'" not in sql
+    assert 'used_bbox' not in sql
+    assert 'ST_LineMerge' not in sql
+
+
+def test_route_from_row_adds_summary_to_features():
+    route = views.Route()
+    row = (
+        '[{"type": "Feature"}]',
+        {'bbox_expansions': 1, 'bbox_buffer_ft': 2640, 'used_bbox': True},
+        1000,
+        [{'name': 'Street A', 'length_m': 800}, {'name': 'Street B', 'length_m': 200}],
+        4,
+    )
+    serialized, num_edges = route._route_from_row(row)
+    assert num_edges == 4
+    assert json.loads(serialized) == {
+        'type': 'FeatureCollection',
+        'properties': {
+            'distance': '0.6 miles',
+            'time': '4 minutes',
+            'major_streets': ['Street A'],
+            'bbox_expansions': 1,
+            'bbox_buffer_ft': 2640,
+            'used_bbox': True,
+        },
+        'features': [{'type': 'Feature'}],
+    }
+
+
+def test_build_route_document_query_compact_modes():
+    route = views.Route()
+    sql = route._build_route_document_query('SELECT 1', compact=True)
+    assert 'ST_LineMerge' in sql
+    assert f'ST_AsGeoJSON(line.geom, {views.COMPACT_PRECISION})' in sql
+    assert 'ST_AsEncodedPolyline' not in sql
+
+    sql = route._build_route_document_query('SELECT 1', compact=True, polyline=True)
+    assert 'ST_AsEncodedPolyline' in sql
+    assert "'geometry', NULL" in sql
+
+
+def test_build_route_document_query_with_bbox_appends_bbox_feature():
+    route = views.Route()
+    sql = route._build_route_document_query('SELECT 1', bbox_sql='SELECT 2', show_bbox=True)
+    assert "'type', 'bbox'" in sql
+    assert "'used_bbox', %s::boolean" in sql
+
+
+def test_execute_route_document_query_passes_properties_as_params():
+    route = views.Route()
+    with patch.object(views, 'connection') as mock_connection:
+        cursor = mock_connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = ('[]', {}, 0, [], 0)
+        result = route._execute_route_document_query(
+            'SELECT 1', [1, 2], bbox_expansions=1, used_bbox=True, show_bbox=True
+        )
+
+    assert json.loads(result[0])['features'] == []
+    assert result[1] == 0
+    assert cursor.execute.call_args[0][1] == [1, 2, 1, True]
+
+
+def test_execute_edge_query_reports_no_bbox_expansions(settings):
+    settings.PREPARED_ROUTING_QUERIES = False
+    route = views.Route()
+    with patch.object(views, 'connection') as mock_connection:
+        cursor = mock_connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = ('[]', {}, 0, [], 0)
+        route._execute_edge_query([10, 11])
+
+    # A null bbox_expansions tells routes found in process apart from routes
+    # found in the first bounding box
+    assert cursor.execute.call_args[0][1] == [[10, 11], None]
+
+
+# Stub of a serialized route that `_execute_route_query` might return
+STUB_ROUTE = '{"type":"FeatureCollection","properties":{},"features":[]}'
 
 
 def test_get_route_uses_bbox_when_route_found():
     route = views.Route()
-    with patch.object(route, '_execute_route_query', return_value=STUB_ROWS) as mock_exec, \
-         patch.object(route, '_execute_bbox_query', return_value={}):
+    with patch.object(route, '_execute_route_query', return_value=(STUB_ROUTE, 1)) as mock_exec:
         result = route.get_route(1, 2)
 
-    mock_exec.assert_called_once_with(1, 2, use_bbox=True)
-    assert result['properties'].get('used_bbox') is None  # not set when show_bbox=False
+    mock_exec.assert_called_once_with(
+        1, 2, use_bbox=True, buffer_scale=1, bbox_expansions=0,
+        show_bbox=False, compact=False, polyline=False
+    )
+    assert result == STUB_ROUTE
 
 
-def test_get_route_falls_back_when_bbox_returns_no_rows():
+def test_get_route_expands_bbox_before_falling_back():
     route = views.Route()
-    side_effects = [[], STUB_ROWS]
+    side_effects = [('empty', 0), (STUB_ROUTE, 1)]
     with patch.object(route, '_execute_route_query', side_effect=side_effects) as mock_exec:
         result = route.get_route(1, 2)
 
-    assert mock_exec.call_count == 2
+    options = {'show_bbox': False, 'compact': False, 'polyline': False}
     assert mock_exec.call_args_list == [
-        call(1, 2, use_bbox=True),
-        call(1, 2, use_bbox=False),
+        call(1, 2, use_bbox=True, buffer_scale=1, bbox_expansions=0, **options),
+        call(1, 2, use_bbox=True, buffer_scale=2, bbox_expansions=1, **options),
     ]
-    assert len(result['features']) == 1
+    assert result == STUB_ROUTE
 
 
-def test_get_route_show_bbox_true_used_bbox_true_when_route_found_in_bbox():
+def test_get_route_falls_back_when_bbox_returns_no_rows():
     route = views.Route()
-    bbox_feature = {'type': 'Feature', 'geometry': {}, 'properties': {'type': 'bbox'}}
-    with patch.object(route, '_execute_route_query', return_value=STUB_ROWS), \
-         patch.object(route, '_execute_bbox_query', return_value=bbox_feature):
+    side_effects = [('empty', 0), ('empty', 0), ('empty', 0), (STUB_ROUTE, 1)]
+    with patch.object(route, '_execute_route_query', side_effect=side_effects) as mock_exec:
         result = route.get_route(1, 2, show_bbox=True)
 
-    assert result['properties']['used_bbox'] is True
-    assert bbox_feature in result['features']
+    options = {'show_bbox': True, 'compact': False, 'polyline': False}
+    assert mock_exec.call_args_list == [
+        call(1, 2, use_bbox=True, buffer_scale=1, bbox_expansions=0, **options),
+        call(1, 2, use_bbox=True, buffer_scale=2, bbox_expansions=1, **options),
+        call(1, 2, use_bbox=True, buffer_scale=4, bbox_expansions=2, **options),
+        call(1, 2, use_bbox=False, bbox_expansions=3, **options),
+    ]
+    assert result == STUB_ROUTE
 
 
-def test_get_route_show_bbox_true_used_bbox_false_when_fallback_fires():
+def test_execute_route_query_only_shows_bbox_when_requested():
     route = views.Route()
-    with patch.object(route, '_execute_route_query', side_effect=[[], STUB_ROWS]), \
-         patch.object(route, '_execute_bbox_query') as mock_bbox_feature:
+    with patch.object(route, '_execute_route_document_query', return_value=(STUB_ROUTE, 1)) as mock_doc:
+        route._execute_route_query(1, 2, use_bbox=True, show_bbox=False)
+        assert mock_doc.call_args[1]['bbox_sql'] is None
+
+        route._execute_route_query(1, 2, use_bbox=True, show_bbox=True)
+        assert 'buffer_ft' in mock_doc.call_args[1]['bbox_sql']
+
+        route._execute_route_query(1, 2, use_bbox=False, show_bbox=True)
+        assert mock_doc.call_args[1]['bbox_sql'] is None
+        assert mock_doc.call_args[1]['used_bbox'] is False
+
+
+def test_get_route_uses_graph_when_memory_backend_enabled(settings):
+    settings.ROUTING_BACKEND = 'memory'
+    route = views.Route()
+    with patch.object(views, 'get_graph') as mock_graph, \
+         patch.object(route, '_execute_edge_query', return_value=(STUB_ROUTE, 1)) as mock_edges, \
+         patch.object(route, '_execute_route_query') as mock_exec:
+        mock_graph.return_value.shortest_path.return_value = [10, 11]
         result = route.get_route(1, 2, show_bbox=True)
 
-    assert result['properties']['used_bbox'] is False
-    mock_bbox_feature.assert_not_called()
-    assert not any(f.get('properties', {}).get('type') == 'bbox' for f in result['features'])
+    mock_graph.return_value.shortest_path.assert_called_once_with(1, 2)
+    mock_edges.assert_called_once_with([10, 11], show_bbox=True, compact=False, polyline=False)
+    mock_exec.assert_not_called()
+    assert result == STUB_ROUTE
+
+
+def test_get_route_falls_back_to_pgrouting_when_graph_finds_no_path(settings):
+    settings.ROUTING_BACKEND = 'memory'
+    route = views.Route()
+    with patch.object(views, 'get_graph') as mock_graph, \
+         patch.object(route, '_execute_edge_query') as mock_edges, \
+         patch.object(route, '_execute_route_query', return_value=(STUB_ROUTE, 1)) as mock_exec:
+        mock_graph.return_value.shortest_path.return_value = []
+        assert route.get_route(1, 2) == STUB_ROUTE
+
+    mock_edges.assert_not_called()
+    assert mock_exec.call_count == 1
+    assert mock_exec.call_args[1]['use_bbox'] is True
+
+
+def test_get_route_falls_back_to_pgrouting_when_hierarchy_is_stale(settings):
+    settings.ROUTING_BACKEND = 'ch'
+    route = views.Route()
+    with patch.object(views, 'get_contraction_hierarchy', return_value=None), \
+         patch.object(route, '_execute_route_query', return_value=(STUB_ROUTE, 1)) as mock_exec:
+        route.get_route(1, 2)
+
+    assert mock_exec.call_count == 1
+    assert mock_exec.call_args[1]['use_bbox'] is True
+
+
+def test_get_search_bounds_uses_the_largest_bbox_and_skips_missing_vertices():
+    route = views.Route()
+    with patch.object(views, 'connection') as mock_connection:
+        cursor = mock_connection.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [(2, -87.7, 41.8, -87.6, 41.9)]
+        assert route.get_search_bounds([(1, 2), (3, 4)]) == [None, (-87.7, 41.8, -87.6, 41.9)]
+
+    sql, params = cursor.execute.call_args[0]
+    assert 'pair.source' in sql
+    assert f'* {views.BBOX_EXPANSION_FACTOR ** views.BBOX_MAX_EXPANSIONS}' in sql
+    assert params == [[1, 3], [2, 4]]
+
+
+def test_get_cached_route_reuses_result_until_mellow_version_changes():
+    route = views.Route()
+    views.route_cache.clear()
+    with patch.object(views.DataVersion, 'get', return_value=1) as mock_version, \
+         patch.object(route, 'get_route', return_value=STUB_ROUTE) as mock_get_route:
+        route.get_cached_route(1, 2)
+        route.get_cached_route(1, 2)
+        assert mock_get_route.call_count == 1
+
+        route.get_cached_route(1, 2, show_bbox=True)
+        assert mock_get_route.call_count == 2
+
+        mock_version.return_value = 2
+        route.get_cached_route(1, 2)
+        assert mock_get_route.call_count == 3
+
+
+def test_ensure_reachable_resnaps_vertices_outside_main_component():
+    route = views.Route()
+    components = {1: (0, 0), 2: (7, 3)}
+    with patch.object(views.VertexComponent, 'for_vertices', return_value=components), \
+         patch.object(route, 'get_nearest_vertex_id', return_value=5) as mock_snap:
+        result = route.ensure_reachable(['1', '1'], 1, ['2', '2'], 2)
+
+    mock_snap.assert_called_once_with(['2', '2'], strong_component=0)
+    assert result == (1, 5)
+
+
+def test_ensure_reachable_keeps_vertices_in_same_weak_component():
+    route = views.Route()
+    components = {1: (0, 0), 2: (7, 0)}
+    with patch.object(views.VertexComponent, 'for_vertices', return_value=components), \
+         patch.object(route, 'get_nearest_vertex_id') as mock_snap:
+        result = route.ensure_reachable(['1', '1'], 1, ['2', '2'], 2)
+
+    mock_snap.assert_not_called()
+    assert result == (1, 2)
+
+
+def test_ensure_reachable_is_a_no_op_without_components():
+    route = views.Route()
+    with patch.object(views.VertexComponent, 'for_vertices', return_value={}), \
+         patch.object(route, 'get_nearest_vertex_id') as mock_snap:
+        assert route.ensure_reachable(['1', '1'], 1, ['2', '2'], 2) == (1, 2)
+
+    mock_snap.assert_not_called()
+
+
+def test_route_matrix_parses_coordinate_lists():
+    matrix = views.RouteMatrix()
+    assert matrix.get_coord_list('1,2;3.5,4', 'origins') == [['1', '2'], ['3.5', '4']]
+    assert matrix.get_coord_list([[1, 2], '3,4'], 'origins') == [['1', '2'], ['3', '4']]
+    with pytest.raises(views.ParseError):
+        matrix.get_coord_list('1,2;foo', 'origins')
+    with pytest.raises(views.ParseError):
+        matrix.get_coord_list(None, 'origins')
+
+
+def test_route_matrix_streams_one_row_per_origin():
+    matrix = views.RouteMatrix()
+    lengths = {10: {20: 1609.344}, 11: {}}
+    with patch.object(matrix, 'get_nearest_vertex_ids', side_effect=[[10, 11], [20, 11]]), \
+         patch.object(matrix, '_execute_matrix_query', return_value=lengths) as mock_query:
+        response = matrix.get_matrix_response([['1', '2'], ['3', '4']], [['5', '6'], ['3', '4']])
+        body = json.loads(b''.join(response.streaming_content))
+
+    mock_query.assert_called_once_with([10, 11], {20, 11})
+    assert body == {
+        'origin_vertex_ids': [10, 11],
+        'destination_vertex_ids': [20, 11],
+        'rows': [
+            {'distances_m': [1609.3, None], 'times_min': [6.0, None]},
+            {'distances_m': [None, 0.0], 'times_min': [None, 0.0]},
+        ],
+    }
+
+
+def test_get_nearest_vertex_id_uses_vertex_index_when_enabled(settings):
+    settings.SNAPPING_BACKEND = 'memory'
+    route = views.Route()
+    index = VertexIndex([7, 8], [-87.6, -87.7], [41.9, 41.8])
+    with patch.object(views, 'get_vertex_index', return_value=index):
+        assert route.get_nearest_vertex_id(['41.91', '-87.61']) == 7
+        assert route.get_nearest_vertex_ids([['-87.61', '41.91'], ['-87.7', '41.8']]) == [7, 8]
+
+
+def test_route_tile_rejects_tiles_outside_the_grid(rf):
+    with pytest.raises(views.Http404):
+        views.route_tile(rf.get('/'), 2, 4, 0)
+
+
+def test_route_tile_caches_tiles_by_bounds(rf):
+    with patch.object(views.MellowRoute, 'tile', return_value=b'tile') as mock_tile, \
+         patch.object(views, 'get_versioned', side_effect=lambda key, compute, **kwargs: compute()) as mock_cache:
+        response = views.route_tile(rf.get('/'), 14, 4202, 6086)
+
+    mock_tile.assert_called_once_with(14, 4202, 6086)
+    assert mock_cache.call_args[0][0] == 'route-tile:14:4202:6086'
+    assert mock_cache.call_args[1]['bounds'] == views.tile_bounds(14, 4202, 6086)
+    assert response.content == b'tile'
+    assert response['Content-Type'] == 'application/vnd.mapbox-vector-tile'
+
+
+def test_tile_bounds_cover_the_tile_and_its_buffer():
+    min_lng, min_lat, max_lng, max_lat = views.tile_bounds(1, 0, 0)
+    assert min_lng < -180 < 0 < max_lng
+    assert min_lat < 0 < max_lat == pytest.approx(85.0511, abs=1e-4)
+
+
+def test_route_list_parses_bbox_and_zoom(rf):
+    view = views.RouteList()
+    request = view.initialize_request(rf.get('/', {'bbox': '-87.7,41.8,-87.6,41.9', 'zoom': '12'}))
+    with patch.object(views.MellowRoute, 'all', return_value={}) as mock_all, \
+         patch.object(views, 'get_versioned', side_effect=lambda key, compute, **kwargs: compute()) as mock_cache:
+        view.get(request)
+    mock_all.assert_called_once_with(bbox=(-87.7, 41.8, -87.6, 41.9), zoom=12)
+    assert mock_cache.call_args[1]['bounds'] == (-87.7, 41.8, -87.6, 41.9)
+
+
+@pytest.mark.parametrize('params', [
+    {'bbox': '-87.7,41.8,-87.6'},
+    {'bbox': '-87.6,41.8,-87.7,41.9'},
+    {'zoom': 'far'},
+    {'zoom': '30'},
+])
+def test_route_list_rejects_invalid_bbox_and_zoom(rf, params):
+    view = views.RouteList()
+    request = view.initialize_request(rf.get('/', params))
+    with pytest.raises(views.ParseError):
+        view.get(request)
+
+
+@pytest.mark.parametrize('zoom,expected', [
+    (None, 0),
+    (18, 0),
+    (15, 0.00002),
+    (11, 0.0005),
+    (3, 0.002),
+])
+def test_simplified_route_tolerance_for_zoom(zoom, expected):
+    assert SimplifiedRoute.tolerance_for_zoom(zoom) == expected
+
+
+def test_route_get_splices_serialized_route_into_response(rf):
+    view = views.Route()
+    request = view.initialize_request(rf.get('/', {'source': '-87.6,41.8', 'target': '-87.7,41.9', 'geometry': 'polyline'}))
+    with patch.object(view, 'get_nearest_vertex_id', side_effect=[1, 2]), \
+         patch.object(view, 'ensure_reachable', return_value=(1, 2)), \
+         patch.object(view, 'get_cached_route', return_value=STUB_ROUTE) as mock_route:
+        response = view.get(request)
+
+    mock_route.assert_called_once_with(1, 2, show_bbox=False, compact=True, polyline=True)
+    body = json.loads(response.content)
+    assert body['source_vertex_id'] == 1
+    assert body['route'] == json.loads(STUB_ROUTE)
+    stages = [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+    assert stages == ['snap_source', 'snap_target', 'reachability', 'render', 'total']
+
+
+def test_get_route_counts_search_outcomes():
+    route = views.Route()
+    fallbacks = views.ROUTE_SEARCHES.value(outcome='fallback')
+    side_effects = [('empty', 0), ('empty', 0), ('empty', 0), (STUB_ROUTE, 4)]
+    with patch.object(route, '_execute_route_query', side_effect=side_effects):
+        route.get_route(1, 2)
+
+    assert views.ROUTE_SEARCHES.value(outcome='fallback') == fallbacks + 1
+    assert set(route.timer.stages) == {'bbox_query', 'fallback_query'}
+
+
+def test_metrics_view_renders_prometheus_text(rf):
+    request = rf.get('/metrics/')
+    request.user = MagicMock(is_staff=True)
+    response = views.metrics_view(request)
+    assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+    body = response.content.decode()
+    assert '# TYPE mbm_route_stage_seconds histogram' in body
+    assert '# TYPE mbm_route_cache_lookups_total counter' in body
+
+
+def test_metrics_view_requires_staff_or_token(rf, settings):
+    settings.METRICS_TOKEN = None
+    request = rf.get('/metrics/', HTTP_AUTHORIZATION='Bearer ')
+    request.user = MagicMock(is_staff=False)
+    assert views.metrics_view(request).status_code == 403
+
+    settings.METRICS_TOKEN = 'scrape'
+    request = rf.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong')
+    request.user = MagicMock(is_staff=False)
+    assert views.metrics_view(request).status_code == 403
+
+    request = rf.get('/metrics/', HTTP_AUTHORIZATION='Bearer scrape')
+    request.user = MagicMock(is_staff=False)
+    assert views.metrics_view(request).status_code == 200
+
+
+def test_way_tile_only_serves_the_picker_zoom_level(rf):
+    request = rf.get('/')
+    request.user = MagicMock(is_authenticated=True)
+    with pytest.raises(views.Http404):
+        views.way_tile(request, forms.WAY_TILE_ZOOM - 1, 0, 0)
+    with pytest.raises(views.Http404):
+        views.way_tile(request, forms.WAY_TILE_ZOOM, 2 ** forms.WAY_TILE_ZOOM, 0)
+
+
+def test_way_tile_caches_tiles(rf):
+    request = rf.get('/')
+    request.user = MagicMock(is_authenticated=True)
+    z = forms.WAY_TILE_ZOOM
+    with patch.object(views.Edge, 'way_tile', return_value='{"features":[]}') as mock_tile, \
+         patch.object(views, 'cache') as mock_cache:
+        mock_cache.get.return_value = None
+        response = views.way_tile(request, z, 1, 2)
+
+    mock_tile.assert_called_once_with(z, 1, 2)
+    mock_cache.set.assert_called_once_with(f'way-tile:{z}:1:2', '{"features":[]}', views.WAY_TILE_CACHE_TIMEOUT)
+    assert response.content == b'{"features":[]}'
+    assert 'private' in response['Cache-Control']
+
+
+def test_way_picker_only_renders_selected_ways():
+    widget = forms.MellowRouteMultipleChoiceWidget()
+    features = [{'type': 'Feature', 'geometry': None, 'properties': {'id': '7'}}]
+    with patch.object(forms.Edge, 'way_features', return_value=features) as mock_features:
+        html = widget.render('ways', [7, 9])
+
+    mock_features.assert_called_once_with(['7', '9'])
+    assert html.count('<option') == 2
+    assert '/api/ways/tiles/{z}/{x}/{y}.json' in html
+
+
+def test_mellow_route_list_reads_cached_neighborhood_overview(rf):
+    overview = {
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature',
+            'geometry': None,
+            'properties': {'slug': 'logan-square', 'name': 'Logan Square', 'num_ways': 3, 'length_mi': 1.2},
+        }],
+    }
+    view = views.MellowRouteList()
+    view.setup(rf.get('/neighborhoods/'))
+    with patch.object(views, 'get_versioned', return_value=overview) as mock_cache:
+        context = view.get_context_data()
+
+    assert mock_cache.call_args[0][:2] == ('neighborhoods', views.MellowRoute.neighborhoods)
+    assert context['neighborhoods'] == [overview['features'][0]['properties']]
+    assert json.loads(context['neighborhoods_json']) == overview
+
+
+class FakePool:
+    """Stands in for the async connection pool, answering queries by table."""
+    def __init__(self, vertex_ids):
+        self.vertex_ids = list(vertex_ids)
+        self.snapping = 0
+        self.max_snapping = 0
+        self.queries = []
+
+    async def fetchone(self, sql, params=None):
+        self.queries.append(sql)
+        if 'vert.the_geom <->' in sql:
+            self.snapping += 1
+            self.max_snapping = max(self.max_snapping, self.snapping)
+            await asyncio.sleep(0.01)
+            self.snapping -= 1
+            return (self.vertex_ids.pop(0),)
+        if 'mbm_dataversion' in sql:
+            return (3,)
+        # A row of the route document query for a two-edge route
+        return ('[]', {'bbox_expansions': 0, 'bbox_buffer_ft': None}, 0, [], 2)
+
+    async def fetchall(self, sql, params=None):
+        self.queries.append(sql)
+        if 'mbm_simplifiedroute' in sql:
+            return [('street', '{"type": "MultiLineString", "coordinates": []}')]
+        return []
+
+
+def test_async_route_snaps_source_and_target_concurrently(rf, settings):
+    settings.ROUTING_BACKEND = 'pgrouting'
+    settings.SNAPPING_BACKEND = 'database'
+    pool = FakePool([11, 12])
+    views.route_cache.clear()
+    with patch.object(views, 'get_pool', return_value=pool):
+        response = asyncio.run(views.async_route(rf.get('/', {'source': '-87.6,41.8', 'target': '-87.7,41.9'})))
+
+    assert response.status_code == 200
+    assert pool.max_snapping == 2
+    body = json.loads(response.content)
+    assert (body['source_vertex_id'], body['target_vertex_id']) == (11, 12)
+    assert body['route']['features'] == []
+    assert body['route']['properties']['distance'] == '0.0 miles'
+    stages = [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+    assert stages == ['snap', 'reachability', 'cache', 'bbox_query', 'render', 'total']
+
+
+def test_async_route_reports_bad_requests_as_json(rf):
+    response = asyncio.run(views.async_route(rf.get('/', {'source': '-87.6,41.8'})))
+
+    assert response.status_code == 400
+    assert json.loads(response.content) == {'detail': 'Request is missing required key: target'}
+
+
+def test_async_route_list_queries_the_pool_on_a_cache_miss(rf):
+    pool = FakePool([])
+
+    async def get_versioned_async(key, compute, bounds=None, timeout=None):
+        return await compute()
+
+    with patch.object(views, 'get_pool', return_value=pool), \
+         patch.object(views, 'get_versioned_async', side_effect=get_versioned_async):
+        response = asyncio.run(views.async_route_list(rf.get('/', {'zoom': '12'})))
+
+    assert response.status_code == 200
+    assert json.loads(response.content)['features'][0]['properties'] == {'type': 'street'}
+    assert response['Cache-Control'] == f'public, max-age={views.BROWSER_CACHE_MAX_AGE}'
+
+
+
+def test_get_cached_route_coalesces_concurrent_requests():
+    route = views.Route()
+    views.route_cache.clear()
+    searching = threading.Event()
+    release = threading.Event()
+
+    def get_route(*args, **kwargs):
+        searching.set()
+        release.wait()
+        return STUB_ROUTE
+
+    results = []
+
+    def request():
+        results.append(views.Route().get_cached_route(1, 2))
+
+    before = views.ROUTE_REQUESTS_COALESCED.value(scope='process')
+    with patch.object(views.DataVersion, 'get', return_value=1), \
+         patch.object(views.Route, 'get_route', side_effect=get_route) as mock_get_route:
+        threads = [threading.Thread(target=request) for _ in range(3)]
+        threads[0].start()
+        searching.wait()
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+    assert mock_get_route.call_count == 1
+    assert results == [STUB_ROUTE] * 3
+    assert views.ROUTE_REQUESTS_COALESCED.value(scope='process') - before == 2
+
+
+def test_get_cached_route_shares_routes_across_workers(settings):
+    settings.COALESCE_ROUTES_ACROSS_WORKERS = True
+    route = views.Route()
+    views.route_cache.clear()
+    shared = {'coalesced-route:1:2:False:False:False:1': 'from another worker'}
+    shared_cache = MagicMock(get=shared.get)
+
+    @contextmanager
+    def advisory_lock(name):
+        yield name in shared
+
+    with patch.object(views.DataVersion, 'get', return_value=1), \
+         patch.object(views, 'advisory_lock', advisory_lock), \
+         patch.object(views, 'shared_cache', return_value=shared_cache), \
+         patch.object(route, 'get_route', return_value=STUB_ROUTE) as mock_get_route:
+        assert route.get_cached_route(1, 2) == 'from another worker'
+        assert route.get_cached_route(1, 3) == STUB_ROUTE
+
+    mock_get_route.assert_called_once_with(1, 3, show_bbox=False, compact=False, polyline=False)
+    shared_cache.set.assert_called_once_with(
+        'coalesced-route:1:3:False:False:False:1',
+        STUB_ROUTE,
+        views.COALESCED_ROUTE_CACHE_TIMEOUT
+    )
+
+
+def test_isochrone_parses_minutes_and_geometry(rf):
+    view = views.Isochrone.as_view()
+
+    for params in (
+        {'minutes': '5,abc'},
+        {'minutes': '0'},
+        {'minutes': '61'},
+        {'minutes': '1,2,3,4,5,6,7'},
+        {'geometry': 'polygon'},
+    ):
+        response = view(rf.get('/api/isochrone/', {'source': '41.91,-87.65', **params}))
+        assert response.status_code == 400
+
+    isochrone = views.Isochrone()
+    assert isochrone.get_minutes_from_request(rf.get('/', {'minutes': '15,5,7.5,5'})) == [5, 7.5, 15]
+    assert isochrone.get_minutes_from_request(rf.get('/')) == [5, 10, 15]
+
+
+def test_isochrone_searches_once_for_every_limit(settings):
+    settings.ROUTING_BACKEND = 'memory'
+    isochrone = views.Isochrone()
+    graph = MagicMock()
+    graph.reachable_edges.return_value = {100: 500.0, 101: 4000.0}
+
+    with patch.object(views, 'get_graph', return_value=graph), \
+         patch.object(views, 'connection') as mock_connection:
+        cursor = mock_connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = ('{"type": "FeatureCollection"}',)
+        assert isochrone.get_isochrone(1, [5, 15], hull=True) == '{"type": "FeatureCollection"}'
+
+    max_length = isochrone.get_meters(15)
+    graph.reachable_edges.assert_called_once_with(1, max_length)
+    sql, params = cursor.execute.call_args[0]
+    assert 'ST_ConcaveHull' in sql
+    assert 'pgr_drivingDistance' not in sql
+    assert params == [[100, 101], [500.0, 4000.0], [5, 15], [isochrone.get_meters(5), max_length]]
+
+
+def test_isochrone_searches_in_postgres_with_the_pgrouting_backend(settings):
+    settings.ROUTING_BACKEND = 'pgrouting'
+    isochrone = views.Isochrone()
+
+    with patch.object(views, 'get_graph') as mock_get_graph, \
+         patch.object(views, 'connection') as mock_connection:
+        cursor = mock_connection.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = ('{"type": "FeatureCollection"}',)
+        isochrone.get_isochrone(1, [5, 15])
+
+    mock_get_graph.assert_not_called()
+    sql, params = cursor.execute.call_args[0]
+    assert sql.lstrip().startswith('WITH RECURSIVE')
+    assert 'pgr_drivingDistance' in sql
+    # The edges query that pgRouting runs is formatted in SQL, not by psycopg2
+    assert '%%1$s' in sql
+    max_length = isochrone.get_meters(15)
+    assert params == [1, max_length, [5, 15], [isochrone.get_meters(5), max_length]]
+    assert sql.count('%s') == len(params)
+
+
+def test_isochrone_edges_are_banded_by_limit():
+    isochrone = views.Isochrone()
+
+    assert 'previous_length_m' in isochrone._build_isochrone_query(hull=False).split('LEFT JOIN reached')[1]
+    assert 'previous_length_m' not in isochrone._build_isochrone_query(hull=True).split('LEFT JOIN reached')[1]
+
+
+def test_isochrone_is_cached_per_vertex_and_limits(rf, settings):
+    settings.SNAPPING_BACKEND = 'database'
+    views.isochrone_cache.clear()
+    view = views.Isochrone.as_view()
+
+    with patch.object(views.Isochrone, 'get_nearest_vertex_id', return_value=7), \
+         patch.object(views.Isochrone, 'ensure_in_main_component', side_effect=lambda coord, vertex: vertex), \
+         patch.object(views.DataVersion, 'get', return_value=1), \
+         patch.object(views.Isochrone, 'get_isochrone', return_value='{"features": []}') as mock_isochrone:
+        response = view(rf.get('/api/isochrone/', {'source': '41.91,-87.65', 'minutes': '10,5'}))
+        view(rf.get('/api/isochrone/', {'source': '41.91,-87.65', 'minutes': '5,10'}))
 
+    assert response.status_code == 200
+    assert json.loads(response.content) == {
+        'source': ['41.91', '-87.65'],
+        'source_vertex_id': 7,
+        'isochrone': {'features': []},
+    }
+    mock_isochrone.assert_called_once_with(7, [5, 10], hull=False)
+    assert views.isochrone_cache.get((7, (5, 10), False, 1)) == '{"features": []}'